@@ -5,18 +5,53 @@
 #   This is a generated file. Any modifications may be overwritten.
 #   -------------------------------------------------------------
 from __future__ import annotations
-from typing import Any, Unpack, Self, Protocol, Literal, Annotated, get_origin, get_args, get_type_hints, cast, overload, runtime_checkable, Required
+from typing import IO, Any, Unpack, Self, Protocol, Literal, Annotated, get_origin, get_args, get_type_hints, cast, overload, runtime_checkable, Required
 from typing_extensions import TypedDict
-from collections.abc import Iterable, Mapping
-from types import UnionType
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterable, Mapping, Sequence
+from types import ModuleType, UnionType
 from io import StringIO
 from pathlib import Path
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 from warnings import warn
+from array import array
 from base64 import b64encode
-from dataclasses import dataclass
-from re import compile
+from dataclasses import asdict, dataclass, field
+from functools import partial, wraps
+from re import compile, escape
 from datetime import timedelta
+from time import perf_counter
+from importlib import import_module
+import heapq
+import math
+import os
+import sys
+import time
+
+
+class _LazyModule:
+    '''A module that is imported the first time one of its attributes is used.
+
+    The module then replaces the global it is bound to, so later uses do not go through this object.
+    '''
+
+    def __init__(self, name: str, alias: str) -> None:
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr: str) -> Any:
+        module = import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+# Running, checking and serializing an application need these, building an apphost does not, so they
+# are only imported when first used to keep ``import aspyre`` as fast as the builder alone needs.
+asyncio: Any = _LazyModule("asyncio", "asyncio")
+futures: Any = _LazyModule("concurrent.futures", "futures")
+hashlib: Any = _LazyModule("hashlib", "hashlib")
+json: Any = _LazyModule("json", "json")
+tempfile: Any = _LazyModule("tempfile", "tempfile")
 
 
 __VERSION__ = "13.0.1.0"
@@ -30,6 +65,8 @@ def _valid_var_name(name: str) -> str:
 
 
 def _validate_type(arg: Any, expected_type: Any) -> bool:
+    if isinstance(arg, Placeholder):
+        return arg.accepts(expected_type)
     if get_origin(expected_type) is Iterable:
         item_type = get_args(expected_type)[0]
         if not isinstance(arg, Iterable):
@@ -100,12 +137,28 @@ def _format_value(value: Any, default: Any = None) -> str:
     return str(value)
 
 
+# The characters that cannot appear unescaped in a regular C# string literal.
+_CSHARP_SPECIAL = compile(r'[\\"\x00-\x1f\x7f\x85\u2028\u2029]')
+_CSHARP_SPECIAL_ESCAPES = {
+    "\\": "\\\\", '"': '\\"', "\0": "\\0", "\a": "\\a", "\b": "\\b", "\f": "\\f",
+    "\n": "\\n", "\r": "\\r", "\t": "\\t", "\v": "\\v"}
+
+
+def _escape_special(match: Any) -> str:
+    char = match.group()
+    return _CSHARP_SPECIAL_ESCAPES.get(char) or f"\\u{ord(char):04x}"
+
+
+def _escape_csharp(value: str) -> str:
+    return _CSHARP_SPECIAL.sub(_escape_special, value)
+
+
 def _format_string(value: Any, default: Any = None) -> str:
     if value is None:
         if default is not None:
             return _format_string(default)
         return "(string?)null"
-    return f'"{value}"'
+    return f'"{_escape_csharp(str(value))}"'
 
 
 def _format_string_array(strings: Iterable[str] | None) -> str:
@@ -147,6 +200,929 @@ def _format_cert(value: bytes | str | Iterable[bytes | str] | None) -> str:
     return f'new List<X509Certificate2> {{ {formatted_items} }}'
 
 
+def _format_args(builder: StringIO, owner: str, args: Iterable[str] | None) -> str:
+    if args is None:
+        return _format_string_array(None)
+    args = list(args)
+    formatted = _format_string_array(args)
+    if isinstance(builder, _ApphostWriter):
+        return builder.externalize(owner, "args", args, formatted)
+    return formatted
+
+
+def _format_env_value(builder: StringIO, owner: str, name: str, value: str | None) -> str:
+    formatted = _format_string(value, None)
+    if value is not None and isinstance(builder, _ApphostWriter):
+        return builder.externalize(owner, f"env.{name}", value, formatted)
+    return formatted
+
+
+def _format_port(builder: StringIO, owner: str, endpoint: str, port: int | None) -> str:
+    if isinstance(builder, _ApphostWriter) and builder.port_planner is not None and not isinstance(port, Placeholder):
+        if port is None:
+            return builder.port_planner.request(owner, endpoint)
+        builder.port_planner.declare(owner, endpoint, port)
+    return _format_value(port, None)
+
+
+def _format_replicas(builder: StringIO, owner: str, replicas: int | None) -> str:
+    if (
+        isinstance(builder, _ApphostWriter) and builder.port_planner is not None and
+        replicas is not None and not isinstance(replicas, Placeholder)
+    ):
+        builder.port_planner.reserve_replicas(owner, replicas)
+    return _format_value(replicas, None)
+
+
+_PLANNED_PORT = compile(r'__ASPYRE_PORT_([0-9]+)__')
+
+
+class PortPlanner:
+    '''Assigns host ports to endpoints that are declared without one.
+
+    Each endpoint is keyed by ``<resource>/<endpoint name>``, and its preferred port is derived from a
+    hash of that key, so the assignment is stable across runs and mostly unaffected by resources being
+    added or removed elsewhere in the topology. Collisions are resolved by probing for the next free port.
+    Resources with replicas get a block of consecutive ports, one per replica. Ports are resolved when
+    the application is built, at which point conflicting explicit ports raise a ValueError.
+    '''
+
+    def __init__(self, ranges: Iterable[tuple[int, int]] = ((20000, 29999),)) -> None:
+        self.ranges = [(start, end) for start, end in ranges]
+        if not self.ranges or any(start > end or start < 1 or end > 65535 for start, end in self.ranges):
+            raise ValueError(f"Invalid port ranges: {self.ranges}")
+        self._explicit: list[tuple[str, str, int]] = []
+        self._requests: list[tuple[str, str]] = []
+        self._replicas: dict[str, int] = {}
+        self._planned: list[int] | None = None
+        self._assignments: dict[str, int] = {}
+
+    def request(self, owner: str, endpoint: str) -> str:
+        self._requests.append((owner, endpoint))
+        self._planned = None
+        return f"__ASPYRE_PORT_{len(self._requests) - 1}__"
+
+    def declare(self, owner: str, endpoint: str, port: int) -> None:
+        self._explicit.append((owner, endpoint, port))
+        self._planned = None
+
+    def reserve_replicas(self, owner: str, replicas: int) -> None:
+        self._replicas[owner] = max(replicas, 1)
+        self._planned = None
+
+    def resolve(self) -> dict[str, int]:
+        '''Returns the port of every planned and explicit endpoint, keyed by ``<resource>/<endpoint>``.'''
+        if self._planned is not None:
+            return self._assignments
+        used: dict[int, str] = {}
+        assignments: dict[str, int] = {}
+        conflicts = []
+        for owner, endpoint, port in self._explicit:
+            key = f"{owner}/{endpoint}"
+            for replica_port in range(port, port + self._replicas.get(owner, 1)):
+                if (other := used.get(replica_port)) is not None and other != key:
+                    conflicts.append(f"port {replica_port} is used by both '{other}' and '{key}'")
+                used[replica_port] = key
+            assignments[key] = port
+        if conflicts:
+            raise ValueError("Conflicting endpoint ports: " + "; ".join(conflicts))
+        ports = [port for start, end in self.ranges for port in range(start, end + 1)]
+        planned = []
+        for owner, endpoint in self._requests:
+            key = f"{owner}/{endpoint}"
+            count = self._replicas.get(owner, 1)
+            digest = hashlib.sha256(key.encode("utf-8")).digest()
+            offset = int.from_bytes(digest[:8], "big") % len(ports)
+            for probe in range(len(ports)):
+                position = (offset + probe) % len(ports)
+                block = ports[position:position + count]
+                if len(block) == count and block[-1] - block[0] == count - 1 and not any(p in used for p in block):
+                    break
+            else:
+                raise ValueError(f"No free port left in {self.ranges} for endpoint '{key}'.")
+            for port in block:
+                used[port] = key
+            assignments.setdefault(key, block[0])
+            planned.append(block[0])
+        self._planned = planned
+        self._assignments = assignments
+        return assignments
+
+    def render(self, source: str) -> str:
+        '''Replaces the placeholders emitted for planned endpoints with their assigned ports.'''
+        self.resolve()
+        return _PLANNED_PORT.sub(lambda match: str(self.planned_port(int(match.group(1)))), source)
+
+    def planned_port(self, index: int) -> int:
+        '''Returns the port assigned to the endpoint of the placeholder numbered ``index`` by ``request()``.'''
+        self.resolve()
+        return cast(list[int], self._planned)[index]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "ranges": self.ranges,
+            "explicit": self._explicit,
+            "requests": self._requests,
+            "replicas": self._replicas,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> PortPlanner:
+        planner = cls(tuple(tuple(port_range) for port_range in data["ranges"]))
+        planner._explicit = [tuple(explicit) for explicit in data["explicit"]]
+        planner._requests = [tuple(request) for request in data["requests"]]
+        planner._replicas = dict(data["replicas"])
+        return planner
+
+
+_PAYLOADS_FILE = "apphost.payloads.json"
+_PAYLOADS_HELPER = (
+    "\nvar aspyrePayloads = JsonDocument.Parse(File.ReadAllText(Path.Combine(AspyreSourceDirectory(), "
+    f'"{_PAYLOADS_FILE}"))).RootElement;'
+    "\nstring[] AspyrePayloadArgs(string key) => "
+    "aspyrePayloads.GetProperty(key).EnumerateArray().Select(item => item.GetString()!).ToArray();"
+    "\nstring AspyrePayloadString(string key) => aspyrePayloads.GetProperty(key).GetString()!;"
+    "\nstatic string AspyreSourceDirectory([System.Runtime.CompilerServices.CallerFilePath] string path = \"\") => "
+    "Path.GetDirectoryName(path)!;"
+)
+
+
+_PLACEHOLDER = compile(r'__aspyre_placeholder_([0-9]+)__')
+_PLACEHOLDER_TYPES = (str, int, float, bool)
+
+
+def _placeholder_value_matches(value: Any, value_type: type) -> bool:
+    # Booleans are ints to isinstance(), but are emitted as true and false.
+    return isinstance(value, value_type) and (value_type is bool or not isinstance(value, bool))
+
+
+def _placeholder_matches(value_type: type, expected_type: Any) -> bool:
+    if expected_type is None or get_origin(expected_type) in (Iterable, Mapping):
+        return False
+    if get_origin(expected_type) is Literal:
+        return any(_placeholder_value_matches(value, value_type) for value in get_args(expected_type))
+    if subtypes := get_args(expected_type):
+        return any(_placeholder_matches(value_type, subtype) for subtype in subtypes)
+    if value_type is bool and expected_type is not bool:
+        return False
+    try:
+        return isinstance(expected_type, type) and issubclass(value_type, expected_type)
+    except TypeError:
+        # Protocols with data members do not support issubclass().
+        return False
+
+
+class Placeholder:
+    '''A named value that is left open in the generated apphost and filled in when a BuilderPlan is rendered.
+
+    Placeholders can be passed wherever a string, number or boolean is accepted. The builder validates them
+    against the declared type, and records the expected types of every use so that rendered values can be
+    checked against them without re-running the builder.
+    '''
+
+    def __init__(self, name: str, value_type: type, index: int, default: Any = None) -> None:
+        if value_type not in _PLACEHOLDER_TYPES:
+            raise TypeError(f"Unsupported placeholder type '{value_type.__name__}' for '{name}'.")
+        if not name.isidentifier():
+            raise ValueError(f"Invalid placeholder name '{name}'. Placeholder names must be identifiers.")
+        self.name = name
+        self.type = value_type
+        self.index = index
+        self.default = default
+        self.expected: list[Any] = []
+
+    def __str__(self) -> str:
+        return f"__aspyre_placeholder_{self.index}__"
+
+    def __repr__(self) -> str:
+        return f"Placeholder({self.name!r}, {self.type.__name__})"
+
+    def accepts(self, expected_type: Any) -> bool:
+        if _placeholder_matches(self.type, expected_type):
+            self.expected.append(expected_type)
+            return True
+        return False
+
+    def to_dict(self) -> dict[str, Any]:
+        # Only the literal values of the recorded uses need to be kept, the declared type covers the rest.
+        literals = []
+        for expected in self.expected:
+            options = (expected,) if get_origin(expected) is Literal else get_args(expected)
+            values = [value for option in options if get_origin(option) is Literal for value in get_args(option)]
+            if values:
+                literals.append(values)
+        return {"name": self.name, "type": self.type.__name__, "default": self.default, "literals": literals}
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any], index: int) -> Placeholder:
+        types = {value_type.__name__: value_type for value_type in _PLACEHOLDER_TYPES}
+        placeholder = cls(data["name"], types[data["type"]], index, data["default"])
+        placeholder.expected = [Literal[tuple(values)] for values in data["literals"]]
+        return placeholder
+
+    def format(self, value: Any) -> str:
+        if not _placeholder_value_matches(value, self.type) or not all(_validate_type(value, expected) for expected in self.expected):
+            raise TypeError(f"Invalid value for placeholder '{self.name}': {value!r}")
+        if isinstance(value, bool):
+            return _format_bool(value)
+        if isinstance(value, str):
+            # String placeholders are always emitted inside a string literal.
+            return _escape_csharp(value)
+        return str(value)
+
+
+class _ApphostWriter(StringIO):
+    '''Buffer for the generated apphost source that also records the structured call of every statement.
+
+    The emitted source follows a fixed grammar: a resource is declared with ``var name = target.AddX(...)``,
+    followed by chained ``.WithX(...)`` lines and a ``;``, and later calls are written as ``name.WithX(...);``.
+    Pragmas that disable a warning precede the statement they apply to, and the matching restore follows it.
+    Every statement is parsed into a call as it is written, and attributed to its resource, so that the
+    topology, or a subset of its resources, can be rendered and inspected without re-running the builder.
+
+    When a payload threshold is set, any args list or environment value whose C# literal is longer
+    than the threshold is stored in a JSON side file, and only a lookup by key is emitted in its place.
+    Values that contain a placeholder are always emitted inline.
+    '''
+
+    def __init__(self, *, payload_threshold: int | None = None, port_planner: PortPlanner | None = None) -> None:
+        super().__init__()
+        self.payload_threshold = payload_threshold
+        self.payloads: dict[str, list[str] | str] = {}
+        self.port_planner = port_planner
+        self.resources: dict[str, Resource] = {}
+        self.stats: BuilderStats | None = None
+        self.hooks: _Hooks | None = None
+        self.restart_policies: dict[str, RestartPolicy] = {}
+        self._segments: list[str] = []
+        # The call of every segment that is a statement, and the layout of those that need one to be rendered.
+        self._calls: list[dict[str, Any] | None] = []
+        self._layouts: dict[int, dict[str, Any]] = {}
+        # The segments whose call has a planned port, which is resolved when the calls are read.
+        self._planned: set[int] = set()
+        self._owned: dict[str | None, list[int]] = {}
+        self._owner: str | None = None
+        self._pending: list[int] = []
+        # The variable of the declaration whose chained calls are being written, and the statements that
+        # middleware made in the meantime, which are written once the declaration is closed.
+        self._declared: str | None = None
+        self._deferred: list[tuple[str, dict[str, Any], dict[str, Any] | None]] = []
+
+    def write(self, text: str, /) -> int:
+        start = perf_counter() if self.stats is not None else 0.0
+        call = layout = None
+        if text.startswith("\n") and not text.startswith("\n#"):
+            owner = self._owner if text.startswith("\n    .") else None
+            call, layout = _parse_statement(text, owner, self.payloads)
+        if call is not None and self.hooks is not None and (self.hooks.method_call or self.hooks.middleware):
+            self._write_through_hooks(text, call, layout)
+        else:
+            self._append(text, call, layout)
+        if self.stats is not None:
+            self.stats.record_write(None if call is None else call["method"], start)
+        return len(text)
+
+    def _write_through_hooks(self, text: str, call: dict[str, Any], layout: dict[str, Any] | None) -> None:
+        hooks = cast(_Hooks, self.hooks)
+        written = MethodCall(call["target"], call["method"], call["args"], call.get("assign"))
+        for callback in hooks.method_call:
+            callback(written)
+
+        def proceed(method_call: MethodCall, index: int = 0) -> None:
+            if index < len(hooks.middleware):
+                hooks.middleware[index](method_call, lambda next_call: proceed(next_call, index + 1))
+            elif method_call is written:
+                self._append(text, call, layout)
+            else:
+                self._emit(method_call, call, layout)
+        proceed(written)
+        if written.assign is not None and self._declared != written.assign:
+            raise ValueError(f"Middleware skipped {written.method}() of '{written.assign}', calls that add a resource must proceed.")
+
+    def _emit(self, method_call: MethodCall, written: dict[str, Any], layout: dict[str, Any] | None) -> None:
+        '''Writes a call that middleware made or rewrote, chained to the open declaration of its target if there is one.'''
+        if method_call.assign is not None and method_call.assign != written.get("assign"):
+            raise ValueError(f"Middleware cannot add resource '{method_call.assign}', add it with the builder.")
+        call: dict[str, Any] = {"target": method_call.target, "method": method_call.method, "args": dict(method_call.args)}
+        if method_call.assign is not None:
+            call["assign"] = method_call.assign
+        if layout is not None and method_call.method == written["method"]:
+            # Typed nulls still apply to null arguments, and payloads to the arguments that are unchanged.
+            args, original = call["args"], written["args"]
+            layout = {
+                "stringNulls": [name for name in layout.get("stringNulls", ()) if name in args and args[name] is None],
+                "payloads": {name: key for name, key in layout.get("payloads", {}).items() if args.get(name) == original[name]},
+            }
+            layout = {key: value for key, value in layout.items() if value} or None
+        else:
+            layout = None
+        chained = method_call.assign is None and method_call.target == self._declared
+        text = _render_statement(call, layout, chained=chained)
+        if self._declared is not None and not chained and method_call.assign is None:
+            self._deferred.append((text, call, layout))
+        else:
+            self._append(text, call, layout)
+
+    def _append(self, text: str, call: dict[str, Any] | None, layout: dict[str, Any] | None) -> int:
+        index = len(self._segments)
+        if text.startswith("\n#pragma warning disable"):
+            self._pending.append(index)
+            self._segments.append(text)
+            self._calls.append(None)
+            return super().write(text)
+        if call is not None and not text.startswith("\n    ."):
+            self._owner = call.get("assign", call["target"])
+        elif call is None and not text.startswith("\n#") and text != ";":
+            self._owner = None
+        owned = self._owned.setdefault(self._owner, [])
+        if self._pending:
+            owned.extend(self._pending)
+            self._pending.clear()
+        owned.append(index)
+        self._segments.append(text)
+        self._calls.append(call)
+        if layout is not None:
+            self._layouts[index] = layout
+        if call is not None and "__ASPYRE_PORT_" in text:
+            self._planned.add(index)
+        written = super().write(text)
+        if call is not None and "assign" in call:
+            self._declared = call["assign"]
+        elif text == ";":
+            self._declared = None
+            while self._deferred:
+                self._append(*self._deferred.pop(0))
+        return written
+
+    def add_resource(self, resource: Resource) -> None:
+        '''Registers a resource once its declaration has been written, and runs the resource-added hooks.'''
+        self.resources[resource.name] = resource
+        if self.hooks is not None:
+            for callback in self.hooks.resource_added:
+                callback(resource)
+
+    def owners(self) -> list[str]:
+        return [owner for owner in self._owned if owner is not None]
+
+    def calls(self, owner: str) -> list[dict[str, Any]]:
+        '''Returns the calls written for a single resource, with planned ports left unresolved.'''
+        return [call for index in self._owned.get(owner, ()) if (call := self._calls[index]) is not None]
+
+    def references(self, owner: str) -> set[str]:
+        '''Returns the variables of the resources that the statements of a resource refer to.'''
+        references = set()
+        for call in self.calls(owner):
+            references.add(call["target"])
+            references.update(_resource_references(list(call["args"].values())))
+        references.discard(owner)
+        references.discard("builder")
+        return references
+
+    def _indices(self, owners: Iterable[str] | None) -> Iterable[int]:
+        if owners is None:
+            return range(len(self._segments))
+        return heapq.merge(*(self._owned[owner] for owner in (None, *owners) if owner in self._owned))
+
+    def topology(
+            self,
+            owners: Iterable[str] | None = None,
+            rewrite: Callable[[dict[str, Any]], dict[str, Any]] | None = None) -> list[dict[str, Any]]:
+        '''Returns the calls of all resources, or of the given ones, in the order they were written.
+
+        Planned ports are resolved. ``rewrite`` is called with every call and returns it or a replacement.
+        '''
+        calls = []
+        for index in self._indices(owners):
+            if (call := self._calls[index]) is None:
+                continue
+            if rewrite is not None:
+                call = rewrite(call)
+            if index in self._planned and self.port_planner is not None:
+                call = _resolve_planned_ports(call, self.port_planner)
+            calls.append(call)
+        return calls
+
+    def render(
+            self,
+            owners: Iterable[str] | None = None,
+            rewrite: Callable[[dict[str, Any]], dict[str, Any]] | None = None) -> str:
+        '''Returns the source of all resources, or of the given ones, with the statements ``rewrite`` replaces re-rendered.'''
+        if owners is None and rewrite is None:
+            source = self.getvalue()
+        else:
+            segments = []
+            for index in self._indices(owners):
+                segment = self._segments[index]
+                if rewrite is not None and (call := self._calls[index]) is not None and (replaced := rewrite(call)) is not call:
+                    segment = _render_statement(replaced, self._layouts.get(index), chained=segment.startswith("\n    ."))
+                segments.append(segment)
+            source = "".join(segments)
+        if self.port_planner is not None:
+            return self.port_planner.render(source)
+        return source
+
+    def to_dict(self) -> dict[str, Any]:
+        '''Returns the options of the writer and its calls, with what is needed to render them as they were written.
+
+        A call chained to a declaration is marked as ``chained``. The codes of the warnings disabled before a
+        call are listed in ``disable``, and those restored after it, once its statement is closed, in ``restore``.
+        '''
+        calls: list[dict[str, Any]] = []
+        disable: list[str] = []
+        for index, segment in enumerate(self._segments):
+            if segment.startswith("\n#pragma warning disable "):
+                disable.append(segment[len("\n#pragma warning disable "):])
+            elif segment.startswith("\n#pragma warning restore ") and calls:
+                calls[-1].setdefault("restore", []).append(segment[len("\n#pragma warning restore "):])
+            elif (call := self._calls[index]) is not None:
+                entry = {**call, **self._layouts.get(index, {})}
+                if segment.startswith("\n    ."):
+                    entry["chained"] = True
+                if disable:
+                    entry["disable"] = disable
+                    disable = []
+                calls.append(entry)
+        return {
+            "payloadThreshold": self.payload_threshold,
+            "payloads": self.payloads,
+            "ports": None if self.port_planner is None else self.port_planner.to_dict(),
+            "restartPolicies": {name: asdict(policy) for name, policy in self.restart_policies.items()},
+            "calls": calls,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any], resources: Mapping[str, str]) -> _ApphostWriter:
+        '''Restores a writer from its calls and the type of each resource, without replaying the builder calls.'''
+        ports = data["ports"]
+        writer = cls(
+            payload_threshold=data["payloadThreshold"],
+            port_planner=None if ports is None else PortPlanner.from_dict(ports))
+        writer.payloads = dict(data["payloads"])
+        writer.restart_policies = {name: RestartPolicy(**policy) for name, policy in data.get("restartPolicies", {}).items()}
+        writer._append(_APPHOST_HEADER, None, None)
+        declared = False
+        for entry in data["calls"]:
+            if declared and not entry.get("chained"):
+                writer._append(";", None, None)
+                declared = False
+            for code in entry.get("disable", ()):
+                writer._append(f"\n#pragma warning disable {code}", None, None)
+            call = {key: entry[key] for key in ("target", "method", "args", "assign") if key in entry}
+            layout = {key: entry[key] for key in ("stringNulls", "payloads") if key in entry} or None
+            writer._append(_render_statement(call, layout, chained=bool(entry.get("chained"))), call, layout)
+            declared = declared or "assign" in call
+            for code in entry.get("restore", ()):
+                if declared:
+                    writer._append(";", None, None)
+                    declared = False
+                writer._append(f"\n#pragma warning restore {code}", None, None)
+        if declared:
+            writer._append(";", None, None)
+        classes: dict[str, type] = {}
+        pending: list[type] = [_BaseResource]
+        while pending:
+            resource_class = pending.pop()
+            pending.extend(resource_class.__subclasses__())
+            classes[resource_class.__name__] = resource_class
+        for name, class_name in resources.items():
+            if class_name not in classes:
+                raise ValueError(f"Unknown resource type '{class_name}' for resource '{name}'.")
+            # The name and the writer are the only state of a resource, its options are in the calls.
+            resource = classes[class_name].__new__(classes[class_name])
+            resource.name = name
+            resource._builder = writer
+            writer.resources[name] = resource
+        return writer
+
+    def externalize(self, owner: str, kind: str, value: list[str] | str, formatted: str) -> str:
+        if self.payload_threshold is None or len(formatted) <= self.payload_threshold:
+            return formatted
+        if any(isinstance(item, Placeholder) for item in (value if isinstance(value, list) else [value])):
+            # Placeholders are filled in in the source, so values that contain one stay inline.
+            return formatted
+        key = f"{owner}.{kind}"
+        index = 1
+        while key in self.payloads:
+            index += 1
+            key = f"{owner}.{kind}.{index}"
+        self.payloads[key] = value
+        if isinstance(value, str):
+            return f"AspyrePayloadString({_format_string(key)})"
+        return f"AspyrePayloadArgs({_format_string(key)})"
+
+
+_IDENTIFIER = compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_ENUM_MEMBER = compile(r'^[A-Z][A-Za-z0-9_]*\.[A-Za-z_][A-Za-z0-9_]*$')
+_INTEGER = compile(r'^-?[0-9]+$')
+_NUMBER = compile(r'^-?[0-9]+\.[0-9]+$')
+_CSHARP_ESCAPE = compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|x[0-9A-Fa-f]{1,4}|.)')
+_CSHARP_ESCAPES = {"'": "'", **{escape[1]: char for char, escape in _CSHARP_SPECIAL_ESCAPES.items()}}
+_APPHOST_HEADER = "var builder = DistributedApplication.CreateBuilder(args);\n"
+# A statement of the apphost: a declaration, a call on a resource, or a call chained to a declaration.
+_STATEMENT = compile(r'\n(?:var ([A-Za-z_]\w*) = ([A-Za-z_]\w*)\.|([A-Za-z_]\w*)\.|    \.)([A-Za-z_]\w*)\(')
+_ARGUMENT_TOKEN = compile(r'"(?:[^"\\]|\\.)*"|[()\[\]{},]')
+
+
+def _split_arguments(source: str, start: int) -> tuple[list[str], int]:
+    '''Splits the arguments that follow an opening bracket at ``start``, and returns them with the end of the closing one.'''
+    parts = []
+    depth = 0
+    for match in _ARGUMENT_TOKEN.finditer(source, start):
+        char = match.group()[0]
+        if char in "([{":
+            depth += 1
+        elif char in ")]}":
+            if not depth:
+                parts.append(source[start:match.start()])
+                return [part for part in parts if part.strip()], match.end()
+            depth -= 1
+        elif char == "," and not depth:
+            parts.append(source[start:match.start()])
+            start = match.end()
+    raise ValueError(f"Unbalanced brackets in {source!r}")
+
+
+def _parse_csharp_value(expression: str, payloads: Mapping[str, Any]) -> Any:
+    expression = expression.strip()
+    if expression in ("null", "(string?)null"):
+        return None
+    if expression in ("true", "false"):
+        return expression == "true"
+    if expression.startswith('"') and expression.endswith('"') and len(expression) >= 2:
+        return _CSHARP_ESCAPE.sub(_unescape_csharp, expression[1:-1])
+    if _INTEGER.match(expression):
+        return int(expression)
+    if _NUMBER.match(expression):
+        return float(expression)
+    for prefix in ("new string[] {", "new List<X509Certificate2> {"):
+        if expression.startswith(prefix) and expression.endswith("}"):
+            items = [_parse_csharp_value(item, payloads) for item in _split_arguments(expression, len(prefix))[0]]
+            return items if prefix.startswith("new string") else {"certificates": items}
+    if "(" in expression and expression.endswith(")"):
+        function, _, argument = expression[:-1].partition("(")
+        if function == "Convert.FromBase64String":
+            return {"base64": _parse_csharp_value(argument, payloads)}
+        if function == "X509CertificateLoader.LoadCertificate":
+            return {"certificate": _parse_csharp_value(argument, payloads)}
+        if function == "X509CertificateLoader.LoadCertificateFromFile":
+            return {"certificateFile": _parse_csharp_value(argument, payloads)}
+        if function in ("AspyrePayloadArgs", "AspyrePayloadString"):
+            return payloads[_parse_csharp_value(argument, payloads)]
+    if expression.endswith(".Resource") and _IDENTIFIER.match(expression[:-len(".Resource")]):
+        return {"resource": expression[:-len(".Resource")], "member": "Resource"}
+    if _ENUM_MEMBER.match(expression):
+        return {"enum": expression}
+    if match := _PLANNED_PORT.fullmatch(expression):
+        return {"plannedPort": int(match.group(1))}
+    if match := _PLACEHOLDER.fullmatch(expression):
+        return {"placeholder": int(match.group(1))}
+    if _IDENTIFIER.match(expression):
+        return {"resource": expression}
+    return {"expression": expression}
+
+
+def _unescape_csharp(match: Any) -> str:
+    escape = match.group(1)
+    if escape[0] in "uUx":
+        return chr(int(escape[1:], 16))
+    if escape not in _CSHARP_ESCAPES:
+        raise ValueError(f"Unsupported escape sequence in a C# string: \\{escape}")
+    return _CSHARP_ESCAPES[escape]
+
+
+def _format_call_value(value: Any) -> str:
+    '''Formats a parsed call argument as the C# expression it was parsed from.'''
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return _format_bool(value)
+    if isinstance(value, str):
+        return _format_string(value)
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, list):
+        return f"new string[] {{ {', '.join(_format_call_value(item) for item in value)} }}"
+    if "resource" in value:
+        return value["resource"] + (f".{value['member']}" if "member" in value else "")
+    if "enum" in value:
+        return value["enum"]
+    if "base64" in value:
+        return f"Convert.FromBase64String({_format_call_value(value['base64'])})"
+    if "certificate" in value:
+        return f"X509CertificateLoader.LoadCertificate({_format_call_value(value['certificate'])})"
+    if "certificateFile" in value:
+        return f"X509CertificateLoader.LoadCertificateFromFile({_format_call_value(value['certificateFile'])})"
+    if "certificates" in value:
+        return f"new List<X509Certificate2> {{ {', '.join(_format_call_value(item) for item in value['certificates'])} }}"
+    if "plannedPort" in value:
+        return f"__ASPYRE_PORT_{value['plannedPort']}__"
+    if "placeholder" in value:
+        return f"__aspyre_placeholder_{value['placeholder']}__"
+    return value["expression"]
+
+
+def _parse_statement(
+        statement: str,
+        owner: str | None,
+        payloads: Mapping[str, Any]) -> tuple[dict[str, Any], dict[str, Any] | None]:
+    '''Parses a statement written by the builder into a structured call, and the layout of its arguments.
+
+    A call chained to a declaration targets the declared variable, which is equivalent because the fluent
+    methods return their target. The layout records the arguments that are a typed null or a payload
+    lookup, which the structured arguments do not distinguish.
+    '''
+    match = _STATEMENT.match(statement)
+    if match is None:
+        raise ValueError(f"Unexpected apphost statement {statement!r}")
+    assign, target, resource, method = match.groups()
+    arguments, end = _split_arguments(statement, match.end())
+    if statement[end:] != ("" if resource is None else ";"):
+        raise ValueError(f"Unexpected apphost statement {statement!r}")
+    args = {}
+    layout: dict[str, Any] | None = None
+    for argument in arguments:
+        name, _, expression = argument.partition(":")
+        name, expression = name.strip(), expression.strip()
+        if expression == "(string?)null":
+            layout = layout or {}
+            layout.setdefault("stringNulls", []).append(name)
+        elif expression.startswith(("AspyrePayloadArgs(", "AspyrePayloadString(")):
+            layout = layout or {}
+            layout.setdefault("payloads", {})[name] = _parse_csharp_value(expression[expression.index("(") + 1:-1], payloads)
+        args[name] = _parse_csharp_value(expression, payloads)
+    call: dict[str, Any] = {"target": target or resource or owner, "method": method, "args": args}
+    if assign:
+        call["assign"] = assign
+    return call, layout
+
+
+def _render_statement(call: Mapping[str, Any], layout: Mapping[str, Any] | None, *, chained: bool) -> str:
+    '''Formats a structured call as the statement that ``_parse_statement()`` parses it from.'''
+    arguments = []
+    for name, value in call["args"].items():
+        if layout is not None and name in layout.get("payloads", ()):
+            function = "AspyrePayloadArgs" if isinstance(value, list) else "AspyrePayloadString"
+            expression = f"{function}({_format_string(layout['payloads'][name])})"
+        elif value is None and layout is not None and name in layout.get("stringNulls", ()):
+            expression = "(string?)null"
+        else:
+            expression = _format_call_value(value)
+        arguments.append(f"{name}: {expression}")
+    invocation = f"{call['method']}({', '.join(arguments)})"
+    if "assign" in call:
+        return f"\nvar {call['assign']} = {call['target']}.{invocation}"
+    if chained:
+        return f"\n    .{invocation}"
+    return f"\n{call['target']}.{invocation};"
+
+
+def _resolve_planned_ports(value: Any, port_planner: PortPlanner) -> Any:
+    '''Replaces the planned ports in parsed call arguments with their assigned ports.'''
+    if isinstance(value, list):
+        return [_resolve_planned_ports(item, port_planner) for item in value]
+    if isinstance(value, dict):
+        if set(value) == {"plannedPort"}:
+            return port_planner.planned_port(value["plannedPort"])
+        return {key: _resolve_planned_ports(item, port_planner) for key, item in value.items()}
+    return value
+
+
+def _fill_placeholders(value: Any, values: Sequence[Any]) -> Any:
+    '''Replaces the placeholders in parsed call arguments with their values.'''
+    if isinstance(value, str):
+        return _PLACEHOLDER.sub(lambda match: str(values[int(match.group(1))]), value)
+    if isinstance(value, list):
+        return [_fill_placeholders(item, values) for item in value]
+    if isinstance(value, dict):
+        if set(value) == {"placeholder"}:
+            return values[value["placeholder"]]
+        return {key: _fill_placeholders(item, values) for key, item in value.items()}
+    return value
+
+
+def _unsupported_expressions(value: Any) -> Iterable[str]:
+    '''Yields the C# expressions in parsed call arguments that the data-driven apphost cannot evaluate.'''
+    if isinstance(value, dict):
+        if set(value) == {"expression"}:
+            yield value["expression"]
+        else:
+            for item in value.values():
+                yield from _unsupported_expressions(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _unsupported_expressions(item)
+
+
+def _integration_packages() -> list[str]:
+    packages = set()
+    pending: list[type] = [_BaseResource]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        if isinstance(package := cls.__dict__.get("package"), property):
+            packages.add(package.fget(None))
+    return sorted(packages)
+
+
+_TOPOLOGY_FILE = "topology.json"
+_DATA_DRIVEN_APPHOST = '''
+using System.Reflection;
+using System.Runtime.CompilerServices;
+using System.Security.Cryptography.X509Certificates;
+using System.Text.Json;
+
+// Generic apphost generated by aspyre. The resources are read from topology.json at startup,
+// so editing the topology does not require this file to be recompiled.
+var builder = DistributedApplication.CreateBuilder(args);
+using var topology = JsonDocument.Parse(File.ReadAllText(Path.Combine(AspyreSourceDirectory(), "topology.json")));
+var extensions = new[] { ASSEMBLIES }
+    .Select(Assembly.Load)
+    .SelectMany(assembly => assembly.GetExportedTypes())
+    .Where(type => type.IsAbstract && type.IsSealed)
+    .SelectMany(type => type.GetMethods(BindingFlags.Public | BindingFlags.Static))
+    .Where(method => method.IsDefined(typeof(ExtensionAttribute), false))
+    .ToLookup(method => method.Name);
+var variables = new Dictionary<string, object> { ["builder"] = builder };
+foreach (var call in topology.RootElement.GetProperty("calls").EnumerateArray())
+{
+    var target = variables[call.GetProperty("target").GetString()!];
+    var result = AspyreInvoke(target, call.GetProperty("method").GetString()!, call.GetProperty("args"));
+    if (call.TryGetProperty("assign", out var assign))
+    {
+        variables[assign.GetString()!] = result!;
+    }
+}
+
+builder.Build().Run();
+
+object? AspyreInvoke(object target, string name, JsonElement args)
+{
+    var names = args.EnumerateObject().Select(arg => arg.Name).ToHashSet();
+    foreach (var candidate in extensions[name])
+    {
+        var method = candidate;
+        if (method.IsGenericMethodDefinition)
+        {
+            var resourceType = target.GetType().GetInterfaces()
+                .FirstOrDefault(type => type.IsGenericType && type.GetGenericTypeDefinition() == typeof(IResourceBuilder<>))
+                ?.GetGenericArguments()[0];
+            if (resourceType is null || method.GetGenericArguments().Length != 1)
+            {
+                continue;
+            }
+            try
+            {
+                method = method.MakeGenericMethod(resourceType);
+            }
+            catch (ArgumentException)
+            {
+                continue;
+            }
+        }
+        var parameters = method.GetParameters();
+        if (parameters.Length == 0 || !parameters[0].ParameterType.IsInstanceOfType(target))
+        {
+            continue;
+        }
+        if (!names.All(arg => parameters.Skip(1).Any(parameter => parameter.Name == arg)))
+        {
+            continue;
+        }
+        var values = new object?[parameters.Length];
+        values[0] = target;
+        var matched = true;
+        for (var index = 1; index < parameters.Length && matched; index++)
+        {
+            var parameter = parameters[index];
+            if (args.TryGetProperty(parameter.Name!, out var value))
+            {
+                matched = AspyreTryConvert(value, parameter.ParameterType, out values[index]);
+            }
+            else if (parameter.HasDefaultValue)
+            {
+                values[index] = parameter.DefaultValue;
+            }
+            else
+            {
+                matched = false;
+            }
+        }
+        if (matched)
+        {
+            return method.Invoke(null, values);
+        }
+    }
+    throw new InvalidOperationException($"No overload of '{name}' matches the arguments recorded in topology.json.");
+}
+
+bool AspyreTryConvert(JsonElement value, Type type, out object? result)
+{
+    var underlying = Nullable.GetUnderlyingType(type) ?? type;
+    result = null;
+    switch (value.ValueKind)
+    {
+        case JsonValueKind.Null:
+            return !type.IsValueType || underlying != type;
+        case JsonValueKind.True:
+        case JsonValueKind.False:
+            result = value.GetBoolean();
+            return underlying == typeof(bool);
+        case JsonValueKind.String:
+            result = value.GetString();
+            return underlying == typeof(string);
+        case JsonValueKind.Number:
+            if (!underlying.IsPrimitive || underlying == typeof(bool) || underlying == typeof(char))
+            {
+                return false;
+            }
+            result = Convert.ChangeType(value.GetDouble(), underlying);
+            return true;
+        case JsonValueKind.Array:
+            if (!type.IsAssignableFrom(typeof(string[])))
+            {
+                return false;
+            }
+            result = value.EnumerateArray().Select(item => item.GetString()!).ToArray();
+            return true;
+    }
+    if (value.TryGetProperty("enum", out var member))
+    {
+        var parts = member.GetString()!.Split('.');
+        if (!underlying.IsEnum || underlying.Name != parts[0])
+        {
+            return false;
+        }
+        result = Enum.Parse(underlying, parts[1]);
+        return true;
+    }
+    if (value.TryGetProperty("resource", out var variable))
+    {
+        result = variables[variable.GetString()!];
+        if (value.TryGetProperty("member", out var property))
+        {
+            result = result.GetType().GetProperty(property.GetString()!)!.GetValue(result);
+        }
+        return type.IsInstanceOfType(result);
+    }
+    if (value.TryGetProperty("base64", out var base64))
+    {
+        result = Convert.FromBase64String(base64.GetString()!);
+        return type.IsAssignableFrom(typeof(byte[]));
+    }
+    if (value.TryGetProperty("certificate", out var certificate))
+    {
+        result = X509CertificateLoader.LoadCertificate(Convert.FromBase64String(certificate.GetProperty("base64").GetString()!));
+        return type.IsInstanceOfType(result);
+    }
+    if (value.TryGetProperty("certificateFile", out var certificateFile))
+    {
+        result = X509CertificateLoader.LoadCertificateFromFile(certificateFile.GetString()!);
+        return type.IsInstanceOfType(result);
+    }
+    if (value.TryGetProperty("certificates", out var certificates))
+    {
+        var items = new List<X509Certificate2>();
+        foreach (var item in certificates.EnumerateArray())
+        {
+            if (!AspyreTryConvert(item, typeof(X509Certificate2), out var loaded))
+            {
+                return false;
+            }
+            items.Add((X509Certificate2)loaded!);
+        }
+        result = items;
+        return type.IsInstanceOfType(result);
+    }
+    throw new NotSupportedException($"Unsupported value in topology.json: {value}");
+}
+
+static string AspyreSourceDirectory([CallerFilePath] string path = "") => Path.GetDirectoryName(path)!;
+'''
+
+
+def _data_driven_apphost() -> str:
+    packages = _integration_packages()
+    assemblies = ", ".join(_format_string(package.split()[1].partition("@")[0]) for package in packages)
+    return (
+        f"#:sdk Aspire.AppHost.Sdk@{__VERSION__}\n" +
+        "\n".join(packages) +
+        _DATA_DRIVEN_APPHOST.replace("ASSEMBLIES", assemblies)
+    )
+
+
+def _write_if_changed(path: Path, content: str) -> bool:
+    '''Write the file only when its content differs, so unchanged outputs keep their timestamps.'''
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return True
+
+
 @dataclass
 class Warnings:
     experimental: str | None
@@ -663,6 +1639,8 @@ class _BaseResource:
         self._builder.write(";")
         if kwargs:
             raise TypeError(f"Unexpected keyword arguments: {list(kwargs.keys())}")
+        if isinstance(__builder, _ApphostWriter):
+            __builder.add_resource(self)
 
 
     def with_dockerfile_base_image(self, *, build_image: str | None = None, runtime_image: str | None = None) -> Self:
@@ -1145,7 +2123,7 @@ class ContainerResource(_BaseResource):
         if _env := kwargs.pop("env", None):
             if _validate_tuple_types(_env, (str, str)):
                 name, value, = cast(tuple[str, str], _env)
-                __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, value: {_format_string(value, None)})')
+                __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, value: {_format_env_value(__builder, __name, name, value)})')
             elif _validate_tuple_types(_env, (str, ExternalServiceResource)):
                 name, external_service, = cast(tuple[str, ExternalServiceResource], _env)
                 __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, externalService: {external_service.name})')
@@ -1160,7 +2138,7 @@ class ContainerResource(_BaseResource):
         if _args := kwargs.pop("args", None):
             if _validate_type(_args, Iterable[str]):
                 args = cast(Iterable[str], _args)
-                __builder.write(f'\n    .WithArgs(args: {_format_string_array(args)})')
+                __builder.write(f'\n    .WithArgs(args: {_format_args(__builder, __name, args)})')
             else:
                 raise TypeError("Invalid type for option 'args'")
         if _reference_env := kwargs.pop("reference_env", None):
@@ -1201,7 +2179,7 @@ class ContainerResource(_BaseResource):
                 is_proxied = cast(EndpointParameters, _endpoint).get("is_proxied")
                 is_external = cast(EndpointParameters, _endpoint).get("is_external")
                 protocol = cast(EndpointParameters, _endpoint).get("protocol")
-                __builder.write(f'\n    .WithEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)})')
+                __builder.write(f'\n    .WithEndpoint(port: {_format_port(__builder, __name, name or scheme or "tcp", port)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)})')
             elif _endpoint is True:
                 __builder.write(f'\n    .WithEndpoint()')
             else:
@@ -1213,7 +2191,7 @@ class ContainerResource(_BaseResource):
                 name = cast(HttpEndpointParameters, _http_endpoint).get("name")
                 env = cast(HttpEndpointParameters, _http_endpoint).get("env")
                 is_proxied = cast(HttpEndpointParameters, _http_endpoint).get("is_proxied")
-                __builder.write(f'\n    .WithHttpEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
+                __builder.write(f'\n    .WithHttpEndpoint(port: {_format_port(__builder, __name, name or "http", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
             elif _http_endpoint is True:
                 __builder.write(f'\n    .WithHttpEndpoint()')
             else:
@@ -1225,7 +2203,7 @@ class ContainerResource(_BaseResource):
                 name = cast(HttpsEndpointParameters, _https_endpoint).get("name")
                 env = cast(HttpsEndpointParameters, _https_endpoint).get("env")
                 is_proxied = cast(HttpsEndpointParameters, _https_endpoint).get("is_proxied")
-                __builder.write(f'\n    .WithHttpsEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
+                __builder.write(f'\n    .WithHttpsEndpoint(port: {_format_port(__builder, __name, name or "https", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
             elif _https_endpoint is True:
                 __builder.write(f'\n    .WithHttpsEndpoint()')
             else:
@@ -1513,7 +2491,7 @@ class ContainerResource(_BaseResource):
     def with_env(self, *args, **kwargs) -> Self:
         if _validate_tuple_types(args + (), (str, str | None)):
             name, value, = cast(tuple[str, str], args)
-            self._builder.write(f'\n{self.name}.WithEnvironment(name: {_format_string(name, None)}, value: {_format_string(value, None)});')
+            self._builder.write(f'\n{self.name}.WithEnvironment(name: {_format_string(name, None)}, value: {_format_env_value(self._builder, self.name, name, value)});')
             return self
         elif _validate_tuple_types(args + (), (str, ExternalServiceResource)):
             name, external_service, = cast(tuple[str, ExternalServiceResource], args)
@@ -1532,7 +2510,7 @@ class ContainerResource(_BaseResource):
 
     def with_args(self, args: Iterable[str], /) -> Self:
         if _validate_type(args, Iterable[str]):
-            self._builder.write(f'\n{self.name}.WithArgs(args: {_format_string_array(args)});')
+            self._builder.write(f'\n{self.name}.WithArgs(args: {_format_args(self._builder, self.name, args)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -1584,21 +2562,21 @@ class ContainerResource(_BaseResource):
 
     def with_endpoint(self, *, port: int | None = None, target_port: int | None = None, scheme: str | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True, is_external: bool | None = None, protocol: ProtocolType | None = None) -> Self:
         if _validate_tuple_types((port, target_port, scheme, name, env, is_proxied, is_external, protocol), (int | None, int | None, str | None, str | None, str | None, bool | Literal[True], bool | None, ProtocolType | None)):
-            self._builder.write(f'\n{self.name}.WithEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)});')
+            self._builder.write(f'\n{self.name}.WithEndpoint(port: {_format_port(self._builder, self.name, name or scheme or "tcp", port)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)});')
             return self
         else:
             raise TypeError("No matching overload found.")
 
     def with_http_endpoint(self, *, port: int | None = None, target_port: int | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True) -> Self:
         if _validate_tuple_types((port, target_port, name, env, is_proxied), (int | None, int | None, str | None, str | None, bool | Literal[True])):
-            self._builder.write(f'\n{self.name}.WithHttpEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
+            self._builder.write(f'\n{self.name}.WithHttpEndpoint(port: {_format_port(self._builder, self.name, name or "http", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
             return self
         else:
             raise TypeError("No matching overload found.")
 
     def with_https_endpoint(self, *, port: int | None = None, target_port: int | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True) -> Self:
         if _validate_tuple_types((port, target_port, name, env, is_proxied), (int | None, int | None, str | None, str | None, bool | Literal[True])):
-            self._builder.write(f'\n{self.name}.WithHttpsEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
+            self._builder.write(f'\n{self.name}.WithHttpsEndpoint(port: {_format_port(self._builder, self.name, name or "https", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -1746,7 +2724,7 @@ class ProjectResource(_BaseResource):
         if _replicas := kwargs.pop("replicas", None):
             if _validate_type(_replicas, int):
                 replicas = cast(int, _replicas)
-                __builder.write(f'\n    .WithReplicas(replicas: {_format_value(replicas, None)})')
+                __builder.write(f'\n    .WithReplicas(replicas: {_format_replicas(__builder, __name, replicas)})')
             else:
                 raise TypeError("Invalid type for option 'replicas'")
         if _disable_forwarded_headers := kwargs.pop("disable_forwarded_headers", None):
@@ -1770,7 +2748,7 @@ class ProjectResource(_BaseResource):
         if _env := kwargs.pop("env", None):
             if _validate_tuple_types(_env, (str, str)):
                 name, value, = cast(tuple[str, str], _env)
-                __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, value: {_format_string(value, None)})')
+                __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, value: {_format_env_value(__builder, __name, name, value)})')
             elif _validate_tuple_types(_env, (str, ExternalServiceResource)):
                 name, external_service, = cast(tuple[str, ExternalServiceResource], _env)
                 __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, externalService: {external_service.name})')
@@ -1785,7 +2763,7 @@ class ProjectResource(_BaseResource):
         if _args := kwargs.pop("args", None):
             if _validate_type(_args, Iterable[str]):
                 args = cast(Iterable[str], _args)
-                __builder.write(f'\n    .WithArgs(args: {_format_string_array(args)})')
+                __builder.write(f'\n    .WithArgs(args: {_format_args(__builder, __name, args)})')
             else:
                 raise TypeError("Invalid type for option 'args'")
         if _reference_env := kwargs.pop("reference_env", None):
@@ -1826,7 +2804,7 @@ class ProjectResource(_BaseResource):
                 is_proxied = cast(EndpointParameters, _endpoint).get("is_proxied")
                 is_external = cast(EndpointParameters, _endpoint).get("is_external")
                 protocol = cast(EndpointParameters, _endpoint).get("protocol")
-                __builder.write(f'\n    .WithEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)})')
+                __builder.write(f'\n    .WithEndpoint(port: {_format_port(__builder, __name, name or scheme or "tcp", port)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)})')
             elif _endpoint is True:
                 __builder.write(f'\n    .WithEndpoint()')
             else:
@@ -1838,7 +2816,7 @@ class ProjectResource(_BaseResource):
                 name = cast(HttpEndpointParameters, _http_endpoint).get("name")
                 env = cast(HttpEndpointParameters, _http_endpoint).get("env")
                 is_proxied = cast(HttpEndpointParameters, _http_endpoint).get("is_proxied")
-                __builder.write(f'\n    .WithHttpEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
+                __builder.write(f'\n    .WithHttpEndpoint(port: {_format_port(__builder, __name, name or "http", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
             elif _http_endpoint is True:
                 __builder.write(f'\n    .WithHttpEndpoint()')
             else:
@@ -1850,7 +2828,7 @@ class ProjectResource(_BaseResource):
                 name = cast(HttpsEndpointParameters, _https_endpoint).get("name")
                 env = cast(HttpsEndpointParameters, _https_endpoint).get("env")
                 is_proxied = cast(HttpsEndpointParameters, _https_endpoint).get("is_proxied")
-                __builder.write(f'\n    .WithHttpsEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
+                __builder.write(f'\n    .WithHttpsEndpoint(port: {_format_port(__builder, __name, name or "https", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
             elif _https_endpoint is True:
                 __builder.write(f'\n    .WithHttpsEndpoint()')
             else:
@@ -1974,7 +2952,7 @@ class ProjectResource(_BaseResource):
 
     def with_replicas(self, replicas: int, /) -> Self:
         if _validate_type(replicas, int):
-            self._builder.write(f'\n{self.name}.WithReplicas(replicas: {_format_value(replicas, None)});')
+            self._builder.write(f'\n{self.name}.WithReplicas(replicas: {_format_replicas(self._builder, self.name, replicas)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -2021,7 +2999,7 @@ class ProjectResource(_BaseResource):
     def with_env(self, *args, **kwargs) -> Self:
         if _validate_tuple_types(args + (), (str, str | None)):
             name, value, = cast(tuple[str, str], args)
-            self._builder.write(f'\n{self.name}.WithEnvironment(name: {_format_string(name, None)}, value: {_format_string(value, None)});')
+            self._builder.write(f'\n{self.name}.WithEnvironment(name: {_format_string(name, None)}, value: {_format_env_value(self._builder, self.name, name, value)});')
             return self
         elif _validate_tuple_types(args + (), (str, ExternalServiceResource)):
             name, external_service, = cast(tuple[str, ExternalServiceResource], args)
@@ -2040,7 +3018,7 @@ class ProjectResource(_BaseResource):
 
     def with_args(self, args: Iterable[str], /) -> Self:
         if _validate_type(args, Iterable[str]):
-            self._builder.write(f'\n{self.name}.WithArgs(args: {_format_string_array(args)});')
+            self._builder.write(f'\n{self.name}.WithArgs(args: {_format_args(self._builder, self.name, args)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -2092,21 +3070,21 @@ class ProjectResource(_BaseResource):
 
     def with_endpoint(self, *, port: int | None = None, target_port: int | None = None, scheme: str | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True, is_external: bool | None = None, protocol: ProtocolType | None = None) -> Self:
         if _validate_tuple_types((port, target_port, scheme, name, env, is_proxied, is_external, protocol), (int | None, int | None, str | None, str | None, str | None, bool | Literal[True], bool | None, ProtocolType | None)):
-            self._builder.write(f'\n{self.name}.WithEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)});')
+            self._builder.write(f'\n{self.name}.WithEndpoint(port: {_format_port(self._builder, self.name, name or scheme or "tcp", port)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)});')
             return self
         else:
             raise TypeError("No matching overload found.")
 
     def with_http_endpoint(self, *, port: int | None = None, target_port: int | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True) -> Self:
         if _validate_tuple_types((port, target_port, name, env, is_proxied), (int | None, int | None, str | None, str | None, bool | Literal[True])):
-            self._builder.write(f'\n{self.name}.WithHttpEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
+            self._builder.write(f'\n{self.name}.WithHttpEndpoint(port: {_format_port(self._builder, self.name, name or "http", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
             return self
         else:
             raise TypeError("No matching overload found.")
 
     def with_https_endpoint(self, *, port: int | None = None, target_port: int | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True) -> Self:
         if _validate_tuple_types((port, target_port, name, env, is_proxied), (int | None, int | None, str | None, str | None, bool | Literal[True])):
-            self._builder.write(f'\n{self.name}.WithHttpsEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
+            self._builder.write(f'\n{self.name}.WithHttpsEndpoint(port: {_format_port(self._builder, self.name, name or "https", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -2262,6 +3240,7 @@ class ExecutableResourceOptions(_BaseResourceOptions, total=False):
     certificate_trust_scope: CertificateTrustScope
     compute_env: ComputeEnvironmentResource
     http_probe: Annotated[ProbeType | HttpProbeParameters, Warnings(experimental="ASPIREPROBES001")]
+    restart: RestartPolicy | Literal["no", "on-failure", "always"]
 
 
 class ExecutableResource(_BaseResource):
@@ -2270,6 +3249,7 @@ class ExecutableResource(_BaseResource):
         return "#:package Aspire.Hosting@13.0.1.0"
 
     def __init__(self, __name: str, __builder: StringIO, **kwargs: Unpack[ExecutableResourceOptions]) -> None:
+        _restart = kwargs.pop("restart", None)
         if _publish_as_docker_file := kwargs.pop("publish_as_docker_file", None):
             if _publish_as_docker_file is True:
                 __builder.write(f'\n    .PublishAsDockerFile()')
@@ -2298,7 +3278,7 @@ class ExecutableResource(_BaseResource):
         if _env := kwargs.pop("env", None):
             if _validate_tuple_types(_env, (str, str)):
                 name, value, = cast(tuple[str, str], _env)
-                __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, value: {_format_string(value, None)})')
+                __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, value: {_format_env_value(__builder, __name, name, value)})')
             elif _validate_tuple_types(_env, (str, ExternalServiceResource)):
                 name, external_service, = cast(tuple[str, ExternalServiceResource], _env)
                 __builder.write(f'\n    .WithEnvironment(name: {_format_string(name, None)}, externalService: {external_service.name})')
@@ -2313,7 +3293,7 @@ class ExecutableResource(_BaseResource):
         if _args := kwargs.pop("args", None):
             if _validate_type(_args, Iterable[str]):
                 args = cast(Iterable[str], _args)
-                __builder.write(f'\n    .WithArgs(args: {_format_string_array(args)})')
+                __builder.write(f'\n    .WithArgs(args: {_format_args(__builder, __name, args)})')
             else:
                 raise TypeError("Invalid type for option 'args'")
         if _reference_env := kwargs.pop("reference_env", None):
@@ -2354,7 +3334,7 @@ class ExecutableResource(_BaseResource):
                 is_proxied = cast(EndpointParameters, _endpoint).get("is_proxied")
                 is_external = cast(EndpointParameters, _endpoint).get("is_external")
                 protocol = cast(EndpointParameters, _endpoint).get("protocol")
-                __builder.write(f'\n    .WithEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)})')
+                __builder.write(f'\n    .WithEndpoint(port: {_format_port(__builder, __name, name or scheme or "tcp", port)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)})')
             elif _endpoint is True:
                 __builder.write(f'\n    .WithEndpoint()')
             else:
@@ -2366,7 +3346,7 @@ class ExecutableResource(_BaseResource):
                 name = cast(HttpEndpointParameters, _http_endpoint).get("name")
                 env = cast(HttpEndpointParameters, _http_endpoint).get("env")
                 is_proxied = cast(HttpEndpointParameters, _http_endpoint).get("is_proxied")
-                __builder.write(f'\n    .WithHttpEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
+                __builder.write(f'\n    .WithHttpEndpoint(port: {_format_port(__builder, __name, name or "http", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
             elif _http_endpoint is True:
                 __builder.write(f'\n    .WithHttpEndpoint()')
             else:
@@ -2378,7 +3358,7 @@ class ExecutableResource(_BaseResource):
                 name = cast(HttpsEndpointParameters, _https_endpoint).get("name")
                 env = cast(HttpsEndpointParameters, _https_endpoint).get("env")
                 is_proxied = cast(HttpsEndpointParameters, _https_endpoint).get("is_proxied")
-                __builder.write(f'\n    .WithHttpsEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
+                __builder.write(f'\n    .WithHttpsEndpoint(port: {_format_port(__builder, __name, name or "https", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)})')
             elif _https_endpoint is True:
                 __builder.write(f'\n    .WithHttpsEndpoint()')
             else:
@@ -2493,11 +3473,23 @@ class ExecutableResource(_BaseResource):
             else:
                 raise TypeError("Invalid type for option 'http_probe'")
         super().__init__(__name, __builder, **kwargs)
+        if _restart is not None:
+            self.with_restart_policy(_restart)
 
     def publish_as_docker_file(self) -> Self:
         self._builder.write(f'\n{self.name}.PublishAsDockerFile();')
         return self
 
+    def with_restart_policy(self, policy: RestartPolicy | Literal["no", "on-failure", "always"], /) -> Self:
+        '''Sets how ``run(engine="python")`` restarts the process; this is not part of the apphost.'''
+        if isinstance(policy, str):
+            policy = RestartPolicy(policy)
+        if not isinstance(policy, RestartPolicy):
+            raise TypeError("No matching overload found.")
+        if isinstance(self._builder, _ApphostWriter):
+            self._builder.restart_policies[self.name] = policy
+        return self
+
     def with_command(self, command: str, /) -> Self:
         if _validate_type(command, str):
             self._builder.write(f'\n{self.name}.WithCommand(command: {_format_string(command, None)});')
@@ -2546,7 +3538,7 @@ class ExecutableResource(_BaseResource):
     def with_env(self, *args, **kwargs) -> Self:
         if _validate_tuple_types(args + (), (str, str | None)):
             name, value, = cast(tuple[str, str], args)
-            self._builder.write(f'\n{self.name}.WithEnvironment(name: {_format_string(name, None)}, value: {_format_string(value, None)});')
+            self._builder.write(f'\n{self.name}.WithEnvironment(name: {_format_string(name, None)}, value: {_format_env_value(self._builder, self.name, name, value)});')
             return self
         elif _validate_tuple_types(args + (), (str, ExternalServiceResource)):
             name, external_service, = cast(tuple[str, ExternalServiceResource], args)
@@ -2565,7 +3557,7 @@ class ExecutableResource(_BaseResource):
 
     def with_args(self, args: Iterable[str], /) -> Self:
         if _validate_type(args, Iterable[str]):
-            self._builder.write(f'\n{self.name}.WithArgs(args: {_format_string_array(args)});')
+            self._builder.write(f'\n{self.name}.WithArgs(args: {_format_args(self._builder, self.name, args)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -2617,21 +3609,21 @@ class ExecutableResource(_BaseResource):
 
     def with_endpoint(self, *, port: int | None = None, target_port: int | None = None, scheme: str | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True, is_external: bool | None = None, protocol: ProtocolType | None = None) -> Self:
         if _validate_tuple_types((port, target_port, scheme, name, env, is_proxied, is_external, protocol), (int | None, int | None, str | None, str | None, str | None, bool | Literal[True], bool | None, ProtocolType | None)):
-            self._builder.write(f'\n{self.name}.WithEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)});')
+            self._builder.write(f'\n{self.name}.WithEndpoint(port: {_format_port(self._builder, self.name, name or scheme or "tcp", port)}, targetPort: {_format_value(target_port, None)}, scheme: {_format_string(scheme, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)}, isExternal: {_format_value(is_external, None)}, protocol: {_format_value(protocol, None)});')
             return self
         else:
             raise TypeError("No matching overload found.")
 
     def with_http_endpoint(self, *, port: int | None = None, target_port: int | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True) -> Self:
         if _validate_tuple_types((port, target_port, name, env, is_proxied), (int | None, int | None, str | None, str | None, bool | Literal[True])):
-            self._builder.write(f'\n{self.name}.WithHttpEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
+            self._builder.write(f'\n{self.name}.WithHttpEndpoint(port: {_format_port(self._builder, self.name, name or "http", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
             return self
         else:
             raise TypeError("No matching overload found.")
 
     def with_https_endpoint(self, *, port: int | None = None, target_port: int | None = None, name: str | None = None, env: str | None = None, is_proxied: bool = True) -> Self:
         if _validate_tuple_types((port, target_port, name, env, is_proxied), (int | None, int | None, str | None, str | None, bool | Literal[True])):
-            self._builder.write(f'\n{self.name}.WithHttpsEndpoint(port: {_format_value(port, None)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
+            self._builder.write(f'\n{self.name}.WithHttpsEndpoint(port: {_format_port(self._builder, self.name, name or "https", port)}, targetPort: {_format_value(target_port, None)}, name: {_format_string(name, None)}, env: {_format_string(env, None)}, isProxied: {_format_bool(is_proxied, True)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -2882,7 +3874,7 @@ class PostgresServerResource(ContainerResource):
         if _host_port := kwargs.pop("host_port", None):
             if _validate_type(_host_port, int):
                 port = cast(int, _host_port)
-                __builder.write(f'\n    .WithHostPort(port: {_format_value(port, None)})')
+                __builder.write(f'\n    .WithHostPort(port: {_format_port(__builder, __name, "host", port)})')
             else:
                 raise TypeError("Invalid type for option 'host_port'")
         if _pg_admin := kwargs.pop("pg_admin", None):
@@ -2954,7 +3946,7 @@ class PostgresServerResource(ContainerResource):
 
     def with_host_port(self, port: int | None = None, /) -> Self:
         if _validate_type(port, int):
-            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_value(port, None)});')
+            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_port(self._builder, self.name, "host", port)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -2989,14 +3981,14 @@ class PgAdminContainerResource(ContainerResource):
         if _host_port := kwargs.pop("host_port", None):
             if _validate_type(_host_port, int):
                 port = cast(int, _host_port)
-                __builder.write(f'\n    .WithHostPort(port: {_format_value(port, None)})')
+                __builder.write(f'\n    .WithHostPort(port: {_format_port(__builder, __name, "host", port)})')
             else:
                 raise TypeError("Invalid type for option 'host_port'")
         super().__init__(__name, __builder, **kwargs)
 
     def with_host_port(self, port: int | None = None, /) -> Self:
         if _validate_type(port, int):
-            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_value(port, None)});')
+            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_port(self._builder, self.name, "host", port)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -3016,14 +4008,14 @@ class PgWebContainerResource(ContainerResource):
         if _host_port := kwargs.pop("host_port", None):
             if _validate_type(_host_port, int):
                 port = cast(int, _host_port)
-                __builder.write(f'\n    .WithHostPort(port: {_format_value(port, None)})')
+                __builder.write(f'\n    .WithHostPort(port: {_format_port(__builder, __name, "host", port)})')
             else:
                 raise TypeError("Invalid type for option 'host_port'")
         super().__init__(__name, __builder, **kwargs)
 
     def with_host_port(self, port: int | None = None, /) -> Self:
         if _validate_type(port, int):
-            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_value(port, None)});')
+            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_port(self._builder, self.name, "host", port)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -3218,7 +4210,7 @@ class RedisResource(ContainerResource):
         if _host_port := kwargs.pop("host_port", None):
             if _validate_type(_host_port, int):
                 port = cast(int, _host_port)
-                __builder.write(f'\n    .WithHostPort(port: {_format_value(port, None)})')
+                __builder.write(f'\n    .WithHostPort(port: {_format_port(__builder, __name, "host", port)})')
             else:
                 raise TypeError("Invalid type for option 'host_port'")
         if _connection_string_redirection := kwargs.pop("connection_string_redirection", None):
@@ -3275,7 +4267,7 @@ class RedisResource(ContainerResource):
 
     def with_host_port(self, port: int | None = None, /) -> Self:
         if _validate_type(port, int):
-            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_value(port, None)});')
+            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_port(self._builder, self.name, "host", port)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -3302,14 +4294,14 @@ class RedisCommanderResource(ContainerResource):
         if _host_port := kwargs.pop("host_port", None):
             if _validate_type(_host_port, int):
                 port = cast(int, _host_port)
-                __builder.write(f'\n    .WithHostPort(port: {_format_value(port, None)})')
+                __builder.write(f'\n    .WithHostPort(port: {_format_port(__builder, __name, "host", port)})')
             else:
                 raise TypeError("Invalid type for option 'host_port'")
         super().__init__(__name, __builder, **kwargs)
 
     def with_host_port(self, port: int | None = None, /) -> Self:
         if _validate_type(port, int):
-            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_value(port, None)});')
+            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_port(self._builder, self.name, "host", port)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -3331,7 +4323,7 @@ class RedisInsightResource(ContainerResource):
         if _host_port := kwargs.pop("host_port", None):
             if _validate_type(_host_port, int):
                 port = cast(int, _host_port)
-                __builder.write(f'\n    .WithHostPort(port: {_format_value(port, None)})')
+                __builder.write(f'\n    .WithHostPort(port: {_format_port(__builder, __name, "host", port)})')
             else:
                 raise TypeError("Invalid type for option 'host_port'")
         if _data_volume := kwargs.pop("data_volume", None):
@@ -3353,7 +4345,7 @@ class RedisInsightResource(ContainerResource):
 
     def with_host_port(self, port: int | None = None, /) -> Self:
         if _validate_type(port, int):
-            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_value(port, None)});')
+            self._builder.write(f'\n{self.name}.WithHostPort(port: {_format_port(self._builder, self.name, "host", port)});')
             return self
         else:
             raise TypeError("No matching overload found.")
@@ -3374,50 +4366,2854 @@ class RedisInsightResource(ContainerResource):
             raise TypeError("No matching overload found.")
 
 
-class DistributedApplication:
+# The file of a GenerationCache that holds the total size of its entries.
+_CACHE_SIZE_FILE = "size"
 
-    def __init__(self, apphost_path: Path) -> None:
-        self.apphost_path = apphost_path
 
-    def run(self) -> None:
-        '''Runs the distributed application.'''
-        pass
+class GenerationCache:
+    '''An on-disk cache of the files generated by builder scripts, shared between processes.
 
+    Entries are keyed by ``key()``, and record the fingerprints of the modules the script imported; an
+    entry is only used while those modules are unchanged. Every entry is a single JSON file named after
+    its key, written to a temporary file first and then moved into place, so concurrent builds never see
+    a partial entry. Entries are touched when they are used, and the least recently used ones are
+    evicted once the cache grows beyond ``max_bytes``. The total size of the entries is kept in a file
+    next to them, so storing an entry only lists the directory when the cache is full; the total is an
+    estimate while processes write at the same time, and is recounted whenever the directory is listed.
+    '''
 
-class DistributedApplicationBuilder:
-    def __init__(self, *args) -> None:
-        self._dependencies = []
-        self._builder = StringIO()
-        self._builder.write("var builder = DistributedApplication.CreateBuilder(args);\n")
+    def __init__(self, directory: str | Path, *, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
 
-    def build(self, *, output_dir: str | None = None) -> DistributedApplication:
-        csharp = self._builder.getvalue()
-        csharp += "\n\nbuilder.Build().Run();\n"
-        csharp = (
+    @staticmethod
+    def key(spec: str, options: Mapping[str, Any]) -> str:
+        '''Returns the key of a builder script or module built with ``options``, by the current library and Python.'''
+        location, _ = _split_spec(spec)
+        if _is_script(location):
+            source = _file_digest(location)
+        else:
+            # A module is found relative to the working directory, and fingerprinted once it is imported.
+            source = os.getcwd()
+        state = [__VERSION__, sys.version, spec, source, options]
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> dict[str, str] | None:
+        '''Returns the files of the entry, or None when there is none or a module it depends on changed.'''
+        path = self.directory / f"{key}.json"
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            for module, digest in entry["modules"].items():
+                if _file_digest(module) != digest:
+                    return None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return entry["files"]
+
+    def put(self, key: str, files: Mapping[str, str], modules: Iterable[str] = ()) -> None:
+        '''Stores the files, to be used while the module files they were generated with are unchanged.'''
+        entry = {"modules": {module: _file_digest(module) for module in modules}, "files": files}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{key}.json"
+        try:
+            replaced = path.stat().st_size
+        except FileNotFoundError:
+            replaced = 0
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            size = os.path.getsize(temp_path)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        size_path = self.directory / _CACHE_SIZE_FILE
+        try:
+            total: int | None = int(size_path.read_text(encoding="utf-8")) + size - replaced
+        except (OSError, ValueError):
+            total = None
+        if total is None or total > self.max_bytes:
+            total = self._evict()
+        size_path.write_text(str(total), encoding="utf-8")
+
+    def _evict(self) -> int:
+        '''Removes the least recently used entries until the cache fits in ``max_bytes``, and returns its size.'''
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+def _file_digest(path: str | Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _apphost_files(
+        source: str,
+        calls: list[dict[str, Any]] | None,
+        packages: Iterable[str],
+        payloads: Mapping[str, Any],
+        *,
+        data_driven: bool = False) -> dict[str, str]:
+    files = {}
+    if data_driven:
+        # The apphost only depends on the library version, so it is left untouched (and is not
+        # recompiled) when the topology changes. Externalized payloads are inlined into the topology.
+        calls = cast(list[dict[str, Any]], calls)
+        for call in calls:
+            for expression in _unsupported_expressions(call["args"]):
+                raise ValueError(
+                    f"{call.get('assign', call['target'])}.{call['method']}() is passed {expression!r}, "
+                    "which the data-driven apphost cannot evaluate; build without data_driven.")
+        topology = {"version": __VERSION__, "calls": calls}
+        payloads = {}
+        files["apphost.cs"] = _data_driven_apphost()
+        files[_TOPOLOGY_FILE] = json.dumps(topology, indent=2) + "\n"
+    else:
+        csharp = source + "\n\nbuilder.Build().Run();\n"
+        header = "\nusing System.Security.Cryptography.X509Certificates;"
+        if payloads:
+            header += "\nusing System.Text.Json;\n" + _PAYLOADS_HELPER
+        files["apphost.cs"] = (
             f"#:sdk Aspire.AppHost.Sdk@{__VERSION__}\n" +
-            "\n".join(set(sorted(self._dependencies))) +
-            "\nusing System.Security.Cryptography.X509Certificates;" +
+            "\n".join(sorted(set(packages))) +
+            header +
             "\n\n" + csharp
         )
+    if payloads:
+        files[_PAYLOADS_FILE] = json.dumps(payloads, indent=2) + "\n"
+    return files
+
+
+def _write_apphost(
+        output_path: Path,
+        source: str,
+        calls: list[dict[str, Any]] | None,
+        packages: Iterable[str],
+        payloads: Mapping[str, Any],
+        *,
+        data_driven: bool = False) -> None:
+    _write_apphost_files(output_path, _apphost_files(source, calls, packages, payloads, data_driven=data_driven))
+
+
+def _write_apphost_files(output_path: Path, files: Mapping[str, str]) -> None:
+    output_path.mkdir(parents=True, exist_ok=True)
+    # An unchanged apphost keeps its timestamp, so it is not recompiled.
+    for name, content in files.items():
+        _write_if_changed(output_path / name, content)
+    payloads_path = output_path / _PAYLOADS_FILE
+    if _PAYLOADS_FILE not in files and payloads_path.exists():
+        payloads_path.unlink()
+
+
+def _render_plan_variant(
+        job: tuple[str, tuple[dict[str, Any], ...], tuple[str, ...], Mapping[str, Any], bool, Path, list[str], list[Any]]) -> Path:
+    source, calls, packages, payloads, data_driven, output_path, formatted, values = job
+    _write_apphost(
+        output_path,
+        _PLACEHOLDER.sub(lambda match: formatted[int(match.group(1))], source),
+        [_fill_placeholders(call, values) for call in calls] if data_driven else None,
+        packages,
+        payloads,
+        data_driven=data_driven)
+    return output_path / "apphost.cs"
+
+
+_STATE_FILE = "apphost.state.json"
+_BUILDER_SCHEMA = 3
+
+
+def _topology_state(calls: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    '''Groups the calls by resource, keyed by the method and its first string or resource argument.'''
+    resources: dict[str, dict[str, Any]] = {}
+    for call in calls:
+        properties = resources.setdefault(call.get("assign", call["target"]).replace("_", "-"), {})
+        key = call["method"]
+        if "assign" not in call and call["args"]:
+            first = next(iter(call["args"].values()))
+            if isinstance(first, str):
+                key = f"{key}({first})"
+            elif isinstance(first, dict) and "resource" in first:
+                key = f"{key}({first['resource'].replace('_', '-')})"
+        unique, index = key, 1
+        while unique in properties:
+            index += 1
+            unique = f"{key}#{index}"
+        properties[unique] = call["args"]
+    return {"version": __VERSION__, "resources": resources}
+
+
+@dataclass(frozen=True)
+class TopologyDiff:
+    '''The resources that were added, removed or modified between two topology states.
+
+    ``modified`` maps the name of each modified resource to the properties that changed.
+    '''
+    added: tuple[str, ...] = ()
+    removed: tuple[str, ...] = ()
+    modified: Mapping[str, tuple[str, ...]] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.modified)
+
+    def __str__(self) -> str:
+        if not self:
+            return "No topology changes."
+        lines = ["Topology changes:"]
+        lines.extend(f"  + {name}" for name in self.added)
+        lines.extend(f"  - {name}" for name in self.removed)
+        lines.extend(f"  ~ {name}: {', '.join(properties)}" for name, properties in self.modified.items())
+        return "\n".join(lines)
+
+    @property
+    def affected(self) -> tuple[str, ...]:
+        '''The names of the resources that were added or modified, which need to be (re)started.'''
+        return tuple(sorted((*self.added, *self.modified)))
+
+
+class AspyreLintWarning(Warning):
+    '''Warning for performance problems found by ``build(lint="warn")``.'''
+
+
+@dataclass(frozen=True)
+class LintFinding:
+    '''A performance problem found in a topology, reported against the resource that causes it.'''
+    rule: str
+    severity: Literal["info", "warning"]
+    resource: str
+    message: str
+
+    def __str__(self) -> str:
+        return f"{self.resource}: {self.message} ({self.rule})"
+
+
+LintRule = Callable[[Mapping[str, Any]], Iterable[LintFinding]]
+
+
+def _state_calls(properties: Mapping[str, Any], method: str) -> list[dict[str, Any]]:
+    return [args for key, args in properties.items() if key.partition("(")[0].partition("#")[0] == method]
+
+
+def _state_declaration(properties: Mapping[str, Any]) -> str | None:
+    return next((key for key in properties if key.startswith("Add")), None)
+
+
+def _lint_pull_policy_always(state: Mapping[str, Any]) -> Iterable[LintFinding]:
+    for name, properties in state["resources"].items():
+        for args in _state_calls(properties, "WithImagePullPolicy"):
+            if args.get("pullPolicy") == {"enum": "ImagePullPolicy.Always"}:
+                yield LintFinding(
+                    "pull-policy-always", "warning", name,
+                    "The image is pulled on every start; use the 'Missing' pull policy and pin the image instead.")
+
+
+def _lint_unpinned_image(state: Mapping[str, Any]) -> Iterable[LintFinding]:
+    for name, properties in state["resources"].items():
+        if _state_declaration(properties) != "AddContainer" or _state_calls(properties, "WithImageSHA256"):
+            continue
+        image, tag = properties["AddContainer"].get("image"), properties["AddContainer"].get("tag")
+        for args in _state_calls(properties, "WithImage"):
+            image, tag = args.get("image"), args.get("tag")
+        for args in _state_calls(properties, "WithImageTag"):
+            tag = args.get("tag")
+        if not isinstance(image, str) or "@" in image:
+            continue
+        if tag is None and ":" in image.rpartition("/")[2]:
+            tag = image.rpartition(":")[2]
+        if tag in (None, "latest"):
+            yield LintFinding(
+                "unpinned-image", "warning", name,
+                f"The image '{image}' is not pinned, so it may be pulled again whenever the tag moves; pin a version tag or digest.")
+
+
+# Resources that are considered healthy as soon as they are running, unless a health check is added.
+_WITHOUT_HEALTH_CHECKS = {
+    "AddContainer", "AddDockerfile", "AddExecutable", "AddProject", "AddCSharpApp",
+    "AddPythonApp", "AddPythonModule", "AddPythonExecutable", "AddUvicornApp",
+}
+
+
+def _lint_wait_without_health_check(state: Mapping[str, Any]) -> Iterable[LintFinding]:
+    resources = state["resources"]
+    waiters: dict[str, list[str]] = {}
+    for name, properties in resources.items():
+        for args in _state_calls(properties, "WaitFor"):
+            if isinstance(dependency := args.get("dependency"), dict) and "resource" in dependency:
+                waiters.setdefault(dependency["resource"].replace("_", "-"), []).append(name)
+    for dependency, names in waiters.items():
+        properties = resources.get(dependency, {})
+        if _state_declaration(properties) not in _WITHOUT_HEALTH_CHECKS:
+            continue
+        if _state_calls(properties, "WithHttpHealthCheck") or _state_calls(properties, "WithHealthCheck"):
+            continue
+        yield LintFinding(
+            "wait-without-health-check", "warning", dependency,
+            f"Waited for by {', '.join(names)}, but has no health check, so readiness cannot be detected; "
+            "add an HTTP health check.")
+
+
+_DATABASES = {"AddPostgres", "AddRedis"}
+
+
+def _lint_session_database(state: Mapping[str, Any]) -> Iterable[LintFinding]:
+    for name, properties in state["resources"].items():
+        if _state_declaration(properties) not in _DATABASES:
+            continue
+        lifetimes = [args.get("lifetime") for args in _state_calls(properties, "WithLifetime")]
+        if not lifetimes or lifetimes[-1] != {"enum": "ContainerLifetime.Persistent"}:
+            yield LintFinding(
+                "session-database", "info", name,
+                "The database container is recreated on every run; use a persistent lifetime to keep it between runs.")
+
+
+def serial_wait_chains(max_length: int = 3) -> LintRule:
+    '''Returns a rule that reports chains of more than ``max_length`` resources each waiting for the next.'''
+    def _lint_serial_wait_chain(state: Mapping[str, Any]) -> Iterable[LintFinding]:
+        waits: dict[str, list[str]] = {}
+        for name, properties in state["resources"].items():
+            for args in (*_state_calls(properties, "WaitFor"), *_state_calls(properties, "WaitForCompletion")):
+                if isinstance(dependency := args.get("dependency"), dict) and "resource" in dependency:
+                    waits.setdefault(name, []).append(dependency["resource"].replace("_", "-"))
+        chains: dict[str, list[str]] = {}
+
+        def chain(name: str) -> list[str]:
+            if name not in chains:
+                chains[name] = [name]
+                longest = max((chain(dependency) for dependency in waits.get(name, ())), key=len, default=[])
+                chains[name] = [name, *longest]
+            return chains[name]
+
+        waited_for = {dependency for dependencies in waits.values() for dependency in dependencies}
+        for name in waits:
+            if name not in waited_for and len(resources := chain(name)) > max_length:
+                yield LintFinding(
+                    "serial-wait-chain", "info", name,
+                    f"Starts after a chain of {len(resources)} resources started one by one: {' -> '.join(resources)}.")
+    return _lint_serial_wait_chain
+
+
+LINT_RULES: list[LintRule] = [
+    _lint_pull_policy_always,
+    _lint_unpinned_image,
+    _lint_wait_without_health_check,
+    _lint_session_database,
+    serial_wait_chains(),
+]
+
+
+def lint_state(state: Mapping[str, Any], rules: Iterable[LintRule] | None = None) -> list[LintFinding]:
+    '''Runs performance rules, by default ``LINT_RULES``, over a topology state as returned by ``builder.state()``.'''
+    return [finding for rule in (LINT_RULES if rules is None else rules) for finding in rule(state)]
+
+
+def _report_findings(findings: list[LintFinding], mode: Literal["warn", "error"]) -> None:
+    if mode not in ("warn", "error"):
+        raise ValueError(f"Invalid lint mode '{mode}', expected 'warn' or 'error'.")
+    failures = [finding for finding in findings if finding.severity == "warning"] if mode == "error" else []
+    if failures:
+        raise ValueError("Performance lint failed:\n" + "\n".join(f"  {finding}" for finding in failures))
+    for finding in findings:
+        warn(str(finding), category=AspyreLintWarning, stacklevel=3)
+
+
+def _in_namespace(prefix: str, name: str) -> bool:
+    return name == prefix or name.startswith(f"{prefix}-")
+
+
+# The uses of a resource of another shard that its connection string or external service stub supports,
+# as (method, argument). References to an external service stub by ``source`` are rewritten.
+_SHARD_STUB_USES = {
+    "connection": {
+        ("WaitFor", "dependency"), ("WaitForStart", "dependency"), ("WithRelationship", "resource"),
+        ("WithReferenceRelationship", "resource"), ("WithParentRelationship", "parent"),
+        ("WithChildRelationship", "child"), ("WithReference", "source"), ("WithEnvironment", "resource"),
+    },
+    "external": {
+        ("WaitFor", "dependency"), ("WaitForStart", "dependency"), ("WithRelationship", "resource"),
+        ("WithReferenceRelationship", "resource"), ("WithParentRelationship", "parent"),
+        ("WithChildRelationship", "child"), ("WithReference", "source"), ("WithReference", "externalService"),
+        ("WithEnvironment", "externalService"),
+    },
+}
+
+
+def _resource_references(value: Any) -> set[str]:
+    '''Returns the variables of the resources that a parsed call argument refers to.'''
+    if isinstance(value, list):
+        return set().union(*(_resource_references(item) for item in value))
+    if isinstance(value, dict):
+        if "resource" in value:
+            return {value["resource"]}
+        return set().union(*(_resource_references(item) for item in value.values()))
+    return set()
+
+
+def _reference_external_services(external: set[str], call: dict[str, Any]) -> dict[str, Any]:
+    '''Rewrites a reference by ``source`` to a resource of another shard into one to its external service stub.'''
+    args = call["args"]
+    if (
+        call["method"] == "WithReference" and set(args) in ({"source"}, {"source", "name"}) and
+        isinstance(source := args["source"], dict) and set(source) == {"resource"} and source["resource"] in external
+    ):
+        return {**call, "args": {"externalService": source}}
+    return call
+
+
+def _write_shard(job: tuple[Path, str, list[dict[str, Any]] | None, tuple[str, ...], Mapping[str, Any], bool]) -> Path:
+    output_path, source, calls, packages, payloads, data_driven = job
+    _write_apphost(output_path, source, calls, packages, payloads, data_driven=data_driven)
+    return output_path / "apphost.cs"
+
+
+@dataclass(frozen=True)
+class BuilderPlan:
+    '''A frozen builder whose placeholders are filled in when it is rendered.
+
+    The topology is validated once, when the builder script runs and the plan is frozen. Rendering a
+    variant only checks the placeholder values and substitutes them into the generated source, or into
+    the calls of a data-driven plan.
+    '''
+    source: str
+    packages: tuple[str, ...]
+    payloads: Mapping[str, Any]
+    placeholders: tuple[Placeholder, ...]
+    data_driven: bool = False
+    calls: tuple[dict[str, Any], ...] = ()
+
+    def _job(self, output_dir: str | Path, values: Mapping[str, Any]) -> tuple:
+        names = {placeholder.name for placeholder in self.placeholders}
+        if unknown := set(values) - names:
+            raise TypeError(f"Unknown placeholders: {sorted(unknown)}")
+        formatted = []
+        filled = []
+        for placeholder in self.placeholders:
+            value = values.get(placeholder.name, placeholder.default)
+            if value is None:
+                raise TypeError(f"Missing value for placeholder '{placeholder.name}'.")
+            formatted.append(placeholder.format(value))
+            filled.append(value)
+        return (self.source, self.calls, self.packages, self.payloads, self.data_driven, Path(output_dir), formatted, filled)
+
+    def render(self, output_dir: str | Path, /, **values: Any) -> DistributedApplication:
+        '''Renders the apphost for one set of placeholder values.'''
+        return DistributedApplication(apphost_path=_render_plan_variant(self._job(output_dir, values)))
+
+    def render_many(
+            self,
+            variants: Iterable[tuple[str | Path, Mapping[str, Any]]],
+            *,
+            max_workers: int | None = None) -> list[DistributedApplication]:
+        '''Renders many variants, given as ``(output_dir, values)`` pairs, across a pool of worker processes.
+
+        All values are validated before any variant is rendered.
+        '''
+        jobs = [self._job(output_dir, values) for output_dir, values in variants]
+        if max_workers == 1 or len(jobs) < 2:
+            paths = [_render_plan_variant(job) for job in jobs]
+        else:
+            with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                paths = list(executor.map(_render_plan_variant, jobs))
+        return [DistributedApplication(apphost_path=path) for path in paths]
+
+
+@runtime_checkable
+class AppHostRunner(Protocol):
+    '''Runs a built application; any object with this ``run`` method can be passed to ``DistributedApplication.run``.'''
+
+    def run(self, app: DistributedApplication) -> int:
+        '''Runs the application until it exits, and returns its exit code.'''
+        ...
+
+
+class DotnetRunner(AppHostRunner):
+    '''Compiles an apphost with ``dotnet build`` and runs the compiled output.
+
+    The compiled output is kept in ``build_dir`` (by default ``.apphost`` next to the apphost) together
+    with a fingerprint of ``apphost.cs``, which includes its ``#:`` package header, and is reused while
+    it is unchanged. ``command`` replaces ``dotnet``, which is how tests substitute a stub executable; it
+    defaults to the ``ASPYRE_APPHOST_COMMAND`` environment variable. The output of the apphost is
+    passed through, or to ``on_output`` line by line. SIGINT and SIGTERM are forwarded to the apphost,
+    which is killed if it has not exited ``shutdown_timeout`` seconds later.
+    '''
+
+    def __init__(
+            self,
+            command: str | Iterable[str] | None = None,
+            *,
+            build_dir: str | os.PathLike[str] | None = None,
+            on_output: Callable[[str], None] | None = None,
+            shutdown_timeout: float = 10.0) -> None:
+        import shlex
+        if command is None:
+            command = os.environ.get("ASPYRE_APPHOST_COMMAND", "dotnet")
+        self.command = shlex.split(command) if isinstance(command, str) else [os.fspath(part) for part in command]
+        if not self.command:
+            raise ValueError("The apphost command must not be empty.")
+        self.build_dir = Path(build_dir) if build_dir is not None else None
+        self.on_output = on_output
+        self.shutdown_timeout = shutdown_timeout
+
+    def fingerprint(self, apphost_path: Path) -> str:
+        '''Returns a hash of everything that the compiled output of the apphost depends on.'''
+        source = apphost_path.read_text()
+        digest = hashlib.sha256()
+        for part in (__VERSION__, json.dumps(self.command), source):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def compile(self, apphost_path: Path) -> Path | int:
+        '''Returns the compiled apphost, building it if needed, or the exit code of a failed build.'''
+        build_dir = self.build_dir or apphost_path.parent / ".apphost"
+        output = build_dir / "bin"
+        compiled = output / f"{apphost_path.stem}.dll"
+        fingerprint_path = build_dir / "fingerprint"
+        fingerprint = self.fingerprint(apphost_path)
+        if compiled.exists() and fingerprint_path.exists() and fingerprint_path.read_text() == fingerprint:
+            return compiled
+        fingerprint_path.unlink(missing_ok=True)
+        returncode = self._execute([*self.command, "build", str(apphost_path), "-o", str(output)])
+        if returncode != 0:
+            return returncode
+        if not compiled.exists():
+            raise RuntimeError(f"Building '{apphost_path}' did not produce '{compiled}'.")
+        fingerprint_path.write_text(fingerprint)
+        return compiled
+
+    def run(self, app: DistributedApplication) -> int:
+        compiled = self.compile(app.apphost_path)
+        if isinstance(compiled, int):
+            return compiled
+        return self._execute([*self.command, str(compiled)], cwd=app.apphost_path.parent)
+
+    def _execute(self, args: list[str], cwd: Path | None = None) -> int:
+        import signal
+        import subprocess
+        import threading
+        pipe = subprocess.PIPE if self.on_output is not None else None
+        process = subprocess.Popen(args, cwd=cwd, stdout=pipe, stderr=subprocess.STDOUT if pipe else None, text=True)
+        stopping = threading.Event()
+
+        def forward(signum: int, frame: Any) -> None:
+            stopping.set()
+            if process.poll() is None:
+                process.send_signal(signum)
+
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, forward)
+        def stream(output: IO[str], on_output: Callable[[str], None]) -> None:
+            for line in output:
+                on_output(line.rstrip("\n"))
+
+        reader = None
+        if process.stdout is not None:
+            reader = threading.Thread(target=stream, args=(process.stdout, self.on_output), daemon=True)
+            reader.start()
+        try:
+            while True:
+                try:
+                    return process.wait(timeout=self.shutdown_timeout if stopping.is_set() else 0.1)
+                except subprocess.TimeoutExpired:
+                    if stopping.is_set():
+                        process.kill()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            if reader is not None:
+                reader.join()
+
+
+@dataclass
+class LocalProcess:
+    '''A resource that ``ProcessRunner`` runs as a local process.'''
+    name: str
+    args: list[str]
+    working_dir: str
+    env: dict[str, str]
+    # The resources to wait for, with the exit code to wait for, or None to wait until it is started.
+    waits: list[tuple[str, int | None]] = field(default_factory=list)
+    endpoints: dict[str, str] = field(default_factory=dict)
+    checks: list[HealthCheck] = field(default_factory=list)
+    restart: RestartPolicy | None = None
+
+
+@dataclass(frozen=True)
+class RestartPolicy:
+    '''How the python engine restarts a local process after it exits.
+
+    With ``"on-failure"`` the process is restarted when it exits with a non-zero code, with ``"always"``
+    whenever it exits. Restarts are delayed by ``backoff_base`` seconds, doubled for every restart in
+    a row up to ``backoff_cap``. A run that lasts ``reset_after`` seconds resets the count, and the
+    process is not restarted again after ``max_retries`` restarts in a row. From
+    ``crash_loop_threshold`` restarts in a row, the resource is reported as ``"crash-loop"``.
+    '''
+    mode: Literal["no", "on-failure", "always"] = "on-failure"
+    max_retries: int | None = 5
+    backoff_base: float = 0.5
+    backoff_cap: float = 30.0
+    reset_after: float = 60.0
+    crash_loop_threshold: int = 3
+
+    def __post_init__(self) -> None:
+        if self.mode not in ("no", "on-failure", "always"):
+            raise ValueError(f"Invalid restart mode '{self.mode}', expected 'no', 'on-failure' or 'always'.")
+        if (self.max_retries is not None and self.max_retries < 0) or self.crash_loop_threshold < 1:
+            raise ValueError("max_retries must not be negative and crash_loop_threshold must be at least 1.")
+        if self.backoff_base < 0 or self.backoff_cap < self.backoff_base or self.reset_after < 0:
+            raise ValueError("Backoff and reset durations must not be negative, and the cap not below the base.")
+
+    def should_restart(self, exit_code: int) -> bool:
+        return self.mode == "always" or (self.mode == "on-failure" and exit_code != 0)
+
+    def delay(self, restarts: int) -> float:
+        '''Returns the delay before restart number ``restarts`` in a row.'''
+        return min(self.backoff_cap, self.backoff_base * 2 ** min(restarts - 1, 64))
+
+
+@dataclass(frozen=True)
+class HealthCheck:
+    '''An HTTP health check or probe of a resource, as evaluated by ``HealthMonitor``.
+
+    ``kind`` is ``"health"`` for ``with_http_health_check``, or the probe type in lower case for
+    ``with_http_probe``. A ``tcp://`` URL is checked by connecting to it. Liveness checks do not gate
+    readiness, but a failing one makes the resource unhealthy. A check fails after ``failure_threshold``
+    consecutive failed requests, and passes after ``success_threshold`` consecutive successful ones.
+    '''
+    resource: str
+    url: str
+    kind: Literal["health", "startup", "readiness", "liveness"] = "health"
+    status_code: int | None = None
+    initial_delay: float = 0.0
+    period: float = 5.0
+    timeout: float = 1.0
+    failure_threshold: int = 3
+    success_threshold: int = 1
+
+    def passes(self, status: int) -> bool:
+        return status == self.status_code if self.status_code is not None else 200 <= status < 300
+
+
+_PROCESS_RESOURCES = {"AddExecutable", "AddPythonApp", "AddPythonModule", "AddPythonExecutable", "AddUvicornApp"}
+_VALUE_RESOURCES = {"AddParameter", "AddConnectionString", "AddExternalService"}
+
+
+def _topology_resources(calls: Iterable[Mapping[str, Any]]) -> tuple[
+        dict[str, tuple[str, dict[str, Any]]], dict[str, list[tuple[str, dict[str, Any]]]], dict[str, str]]:
+    '''Groups the calls of a topology by resource variable: declarations, configuration calls and names.'''
+    declarations: dict[str, tuple[str, dict[str, Any]]] = {}
+    configuration: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+    for call in calls:
+        if "assign" in call and call["target"] == "builder":
+            declarations[call["assign"]] = (call["method"], call["args"])
+            configuration[call["assign"]] = []
+        elif call["target"] in configuration:
+            configuration[call["target"]].append((call["method"], call["args"]))
+    names = {var: args.get("name", var.replace("_", "-")) for var, (_, args) in declarations.items()}
+    return declarations, configuration, names
+
+
+def _declared_endpoints(
+        args: Mapping[str, Any],
+        configuration: Iterable[tuple[str, Mapping[str, Any]]]) -> list[tuple[str, str, int | None, str | None]]:
+    '''Returns the name, scheme, port (None if not known) and port environment variable of each endpoint of a resource.
+
+    A ``port`` argument of the declaration is a ``tcp`` endpoint.
+    '''
+    endpoints: list[tuple[str, str, int | None, str | None]] = []
+    if isinstance(args.get("port"), int):
+        endpoints.append(("tcp", "tcp", args["port"], None))
+    for name, options in configuration:
+        if name in ("WithEndpoint", "WithHttpEndpoint", "WithHttpsEndpoint"):
+            scheme = {"WithHttpEndpoint": "http", "WithHttpsEndpoint": "https"}.get(name) or options.get("scheme") or "tcp"
+            port = options.get("port") or options.get("targetPort")
+            endpoints.append((options.get("name") or scheme, scheme, port if isinstance(port, int) else None, options.get("env")))
+    return endpoints
+
+
+def _resource_endpoints(
+        args: Mapping[str, Any],
+        configuration: Iterable[tuple[str, Mapping[str, Any]]],
+        env: dict[str, str] | None = None,
+        *,
+        planned: Mapping[str, int] | None = None) -> dict[str, str]:
+    '''Returns the URLs of the endpoints of a resource that have a known port.
+
+    Endpoints without a port take theirs from ``planned``, by endpoint name, and ports are set in ``env``
+    for endpoints that declare an environment variable.
+    '''
+    endpoints = {}
+    for name, scheme, port, variable in _declared_endpoints(args, configuration):
+        if port is None and (port := (planned or {}).get(name)) is None:
+            continue
+        endpoints[name] = f"{scheme}://localhost:{port}"
+        if env is not None and variable:
+            env[variable] = str(port)
+    return endpoints
+
+
+def _resource_checks(
+        resource: str,
+        endpoints: Mapping[str, str],
+        configuration: Iterable[tuple[str, Mapping[str, Any]]]) -> list[HealthCheck]:
+    checks = []
+    for name, options in configuration:
+        if name not in ("WithHttpHealthCheck", "WithHttpProbe"):
+            continue
+        endpoint = options.get("endpointName")
+        base = endpoints.get(endpoint) if endpoint else next(
+            (url for url in endpoints.values() if url.startswith("http")), None)
+        if base is None:
+            raise ValueError(f"Resource '{resource}' has no HTTP endpoint '{endpoint or 'http'}' with a known port to check.")
+        url = base + "/" + (options.get("path") or "").lstrip("/")
+        if name == "WithHttpHealthCheck":
+            checks.append(HealthCheck(resource, url, status_code=options.get("statusCode")))
+        else:
+            probe = {
+                "initial_delay": options.get("initialDelaySeconds"),
+                "period": options.get("periodSeconds"),
+                "timeout": options.get("timeoutSeconds"),
+                "failure_threshold": options.get("failureThreshold"),
+                "success_threshold": options.get("successThreshold"),
+            }
+            kind = options["type"]["enum"].rpartition(".")[2].lower()
+            checks.append(HealthCheck(
+                resource, url, kind, **{key: value for key, value in probe.items() if value is not None}))
+    return checks
+
+
+def _local_processes(
+        calls: Iterable[Mapping[str, Any]],
+        base_dir: Path,
+        environ: Mapping[str, str],
+        restart_policies: Mapping[str, RestartPolicy] | None = None) -> dict[str, LocalProcess]:
+    '''Resolves the executable and Python app resources of a topology into the processes to start.
+
+    Parameters, connection strings and external services are resolved to values: from the topology
+    where it has one, and otherwise from ``environ`` as the apphost reads them from configuration.
+    Relative directories are relative to ``base_dir``, the directory of the apphost.
+    '''
+    declarations, configuration, names = _topology_resources(calls)
+    unsupported = sorted(
+        names[var] for var, (method, _) in declarations.items()
+        if method not in _PROCESS_RESOURCES and method not in _VALUE_RESOURCES)
+    if unsupported:
+        raise ValueError(f"Resources cannot be run as local processes: {', '.join(unsupported)}")
+
+    def directory(path: str) -> str:
+        return str(base_dir / path)
+
+    # Endpoints without a port get one planned from the names of the resource and the endpoint, which
+    # does not change between runs and is not the port of another endpoint.
+    planner = PortPlanner()
+    for var, (method, args) in declarations.items():
+        if method in _PROCESS_RESOURCES:
+            for endpoint, _, port, _ in _declared_endpoints(args, configuration[var]):
+                if port is None:
+                    planner.request(names[var], endpoint)
+                else:
+                    planner.declare(names[var], endpoint, port)
+    ports = planner.resolve()
+
+    processes: dict[str, LocalProcess] = {}
+    for var, (method, args) in declarations.items():
+        if method not in _PROCESS_RESOURCES:
+            continue
+        if method == "AddExecutable":
+            process = LocalProcess(
+                names[var], [args["command"], *(args.get("args") or ())], directory(args["workingDirectory"]), {})
+        else:
+            app_dir = directory(args["appDirectory"])
+            venv = next(
+                (options["virtualEnvironmentPath"] for name, options in configuration[var]
+                 if name == "WithVirtualEnvironment"), ".venv")
+            bin_dir = Path(app_dir, venv, "Scripts" if os.name == "nt" else "bin")
+            python = str(bin_dir / "python") if (bin_dir / "python").exists() else sys.executable
+            if method == "AddPythonApp":
+                command = [python, args["scriptPath"]]
+            elif method == "AddPythonModule":
+                command = [python, "-m", args["moduleName"]]
+            elif method == "AddUvicornApp":
+                command = [python, "-m", "uvicorn", args["app"]]
+            else:
+                executable = bin_dir / args["executableName"]
+                command = [str(executable) if executable.exists() else args["executableName"]]
+            process = LocalProcess(names[var], command, app_dir, {"PYTHONUNBUFFERED": "1"})
+        planned = {
+            endpoint: ports[f"{names[var]}/{endpoint}"]
+            for endpoint, _, port, _ in _declared_endpoints(args, configuration[var]) if port is None}
+        process.endpoints = _resource_endpoints(args, configuration[var], process.env, planned=planned)
+        process.checks = _resource_checks(process.name, process.endpoints, configuration[var])
+        process.restart = (restart_policies or {}).get(var)
+        if method == "AddUvicornApp" and process.endpoints:
+            process.args += ["--port", next(iter(process.endpoints.values())).rpartition(":")[2]]
+        processes[var] = process
+
+    def resource(value: Any) -> str:
+        return value["resource"] if isinstance(value, dict) and "resource" in value else ""
+
+    def value_of(var: str) -> str:
+        method, args = declarations[var]
+        name = names[var]
+        if method == "AddParameter":
+            value = args.get("value")
+            return value if isinstance(value, str) else environ.get(f"Parameters__{name}", "")
+        if method == "AddConnectionString":
+            return environ.get(args.get("environmentVariableName") or f"ConnectionStrings__{name}", "")
+        if method == "AddExternalService":
+            url = args.get("url")
+            return url if isinstance(url, str) else value_of(resource(args.get("urlParameter")))
+        return next(iter(processes[var].endpoints.values()), "")
+
+    for var, process in processes.items():
+        for name, options in configuration[var]:
+            if name == "WithCommand":
+                process.args[0] = options["command"]
+            elif name == "WithWorkingDirectory":
+                process.working_dir = directory(options["workingDirectory"])
+            elif name == "WithArgs":
+                process.args.extend(options["args"] or ())
+            elif name == "WithEnvironment":
+                variable = options.get("name") or options.get("envVarName")
+                value = next(value for key, value in options.items() if key not in ("name", "envVarName"))
+                process.env[variable] = value_of(resource(value)) if resource(value) else str(value or "")
+            elif name == "WithReference":
+                source = resource(options.get("source") or options.get("externalService"))
+                method = declarations[source][0]
+                if source in processes:
+                    service = options.get("name") or names[source]
+                    for endpoint, url in processes[source].endpoints.items():
+                        process.env[f"services__{service}__{endpoint}__0"] = url
+                        process.env[f"{service}_{endpoint}".upper().replace("-", "_")] = url
+                elif method == "AddExternalService":
+                    process.env[f"services__{names[source]}__default__0"] = value_of(source)
+                else:
+                    process.env[f"ConnectionStrings__{options.get('connectionName') or names[source]}"] = value_of(source)
+            elif name in ("WaitFor", "WaitForStart", "WaitForCompletion"):
+                if (dependency := resource(options.get("dependency"))) in processes:
+                    exit_code = options.get("exitCode", 0) if name == "WaitForCompletion" else None
+                    process.waits.append((names[dependency], exit_code))
+    return {process.name: process for process in processes.values()}
+
+
+class HttpClientPool:
+    '''A minimal asyncio HTTP/1.1 client for health checks, that keeps connections alive between requests.
+
+    Idle connections are pooled per host and port, and at most ``max_connections_per_host`` requests
+    are in flight to one host at a time. HTTPS certificates are not verified, as the checked endpoints
+    are local development endpoints.
+    '''
+
+    def __init__(self, *, max_connections_per_host: int = 4) -> None:
+        self.max_connections_per_host = max_connections_per_host
+        self.connections_opened = 0
+        self._idle: dict[tuple[str, str, int], list[tuple[Any, Any]]] = {}
+        self._limits: dict[tuple[str, str, int], Any] = {}
+
+    async def get(self, url: str, *, timeout: float = 1.0) -> int:
+        '''Sends a GET request and returns the status code of the response.'''
+        return await self._send("GET", url, timeout)
+
+    async def head(self, url: str, *, timeout: float = 1.0) -> int:
+        '''Sends a HEAD request and returns the status code of the response.'''
+        return await self._send("HEAD", url, timeout)
+
+    async def _send(self, method: str, url: str, timeout: float) -> int:
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname or "localhost", parts.port or (443 if parts.scheme == "https" else 80))
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        limit = self._limits.setdefault(key, asyncio.Semaphore(self.max_connections_per_host))
+        async with limit:
+            return await asyncio.wait_for(self._request(key, method, target), timeout)
+
+    async def _request(self, key: tuple[str, str, int], method: str, target: str) -> int:
+        idle = self._idle.setdefault(key, [])
+        while True:
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await self._connect(key)
+            try:
+                host = key[1] if key[2] in (80, 443) else f"{key[1]}:{key[2]}"
+                writer.write(f"{method} {target} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode())
+                await writer.drain()
+                status, keep_alive = await self._read_response(reader, head=method == "HEAD")
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                writer.close()
+                if reused:
+                    # The server may have closed the idle connection; retry once on a new one.
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+            return status
+
+    async def _connect(self, key: tuple[str, str, int]) -> tuple[Any, Any]:
+        import ssl
+        context = None
+        if key[0] == "https":
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        connection = await asyncio.open_connection(key[1], key[2], ssl=context)
+        self.connections_opened += 1
+        return connection
+
+    @staticmethod
+    async def _read_response(reader: Any, *, head: bool = False) -> tuple[int, bool]:
+        while True:
+            # The reason phrase after the status code is optional.
+            version, _, status = (await reader.readline()).decode("latin-1").partition(" ")
+            status = status.strip().partition(" ")[0]
+            if not version.startswith("HTTP/") or len(status) != 3 or not status.isdigit():
+                raise ValueError(f"Invalid HTTP status line: {version} {status}")
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip().lower()
+            # Interim 1xx responses, such as 100 Continue, precede the final response.
+            if not status.startswith("1") or status == "101":
+                break
+        keep_alive = headers.get("connection") != "close" and (version != "HTTP/1.0" or headers.get("connection") == "keep-alive")
+        if head or status.startswith("1") or status in ("204", "304"):
+            # These responses never have a body, whatever their headers say.
+            return int(status), keep_alive
+        if headers.get("transfer-encoding") == "chunked":
+            while size := int((await reader.readline()).split(b";")[0], 16):
+                await reader.readexactly(size + 2)
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+        elif "content-length" in headers:
+            await reader.readexactly(int(headers["content-length"]))
+        else:
+            await reader.read()
+            return int(status), False
+        return int(status), keep_alive
+
+    def close(self) -> None:
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class Histogram:
+    '''Cumulative bucket counts, sums and counts of observations, per tuple of label values.'''
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, labels: tuple[str, ...], buckets: Iterable[float] = BUCKETS) -> None:
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.series: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            # The bucket counts, followed by the sum and the count.
+            series = self.series[labels] = [0.0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, name: str, help: str) -> list[str]:
+        '''Returns the histogram in the Prometheus text format.'''
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            common = [f'{key}="{_prometheus_escape(value)}"' for key, value in zip(self.labels, labels)]
+            for bound, count in (*zip(self.buckets, series), (float("inf"), series[-1])):
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{name}_bucket{{{','.join([*common, le])}}} {count:g}")
+            suffix = f"{{{','.join(common)}}}" if common else ""
+            lines.append(f"{name}_sum{suffix} {series[-2]:g}")
+            lines.append(f"{name}_count{suffix} {series[-1]:g}")
+        return lines
+
+
+def _prometheus_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+@dataclass(frozen=True)
+class HealthTransition:
+    '''A change of the health state of a resource, at a ``time.perf_counter()`` time.'''
+    resource: str
+    previous: str
+    state: str
+    time: float
+
+
+class HealthMonitor:
+    '''Evaluates the health checks of running resources concurrently, on one event loop and one client.
+
+    Each check is polled quickly at first, every ``min_interval`` seconds, and then backs off by doubling
+    the interval up to the period of the check; it is polled quickly again after its result changes.
+    A resource is ``"starting"`` until all of its non-liveness checks pass, after which it is
+    ``"healthy"``, or ``"unhealthy"`` once one of its checks fails; resources without checks are healthy
+    when they start. State changes are recorded in ``transitions`` and passed to ``on_transition``.
+    '''
+
+    def __init__(
+            self,
+            *,
+            client: HttpClientPool | None = None,
+            min_interval: float = 0.05,
+            on_transition: Callable[[HealthTransition], None] | None = None) -> None:
+        self.client = client or HttpClientPool()
+        self.min_interval = min_interval
+        self.on_transition = on_transition
+        self.states: dict[str, str] = {}
+        self.transitions: list[HealthTransition] = []
+        self.check_durations = Histogram(("resource", "kind"))
+        self.timeline: StartupTimeline | None = None
+        self._results: dict[str, dict[HealthCheck, bool | None]] = {}
+        self._tasks: dict[str, list[Any]] = {}
+        self._waiters: dict[str, list[Any]] = {}
+        self._healthy: set[str] = set()
+
+    def watch(self, resource: str, checks: Iterable[HealthCheck]) -> None:
+        '''Starts evaluating the checks of a resource that has just started.'''
+        self.forget(resource, state=None)
+        self._results[resource] = dict.fromkeys(checks)
+        self._healthy.discard(resource)
+        self._set_state(resource, "starting")
+        self._tasks[resource] = [asyncio.create_task(self._poll(check)) for check in self._results[resource]]
+        self._update(resource)
+
+    def forget(self, resource: str, *, state: str | None = "stopped") -> None:
+        '''Stops evaluating the checks of a resource, which is now in ``state``.'''
+        for task in self._tasks.pop(resource, ()):
+            task.cancel()
+        self._results.pop(resource, None)
+        if state is not None and resource in self.states:
+            self._set_state(resource, state)
+
+    async def wait_healthy(self, resource: str) -> bool:
+        '''Waits until the resource is, or has been, healthy and returns True, or returns False if it stops first.'''
+        while resource not in self._healthy:
+            if self.states.get(resource) == "stopped":
+                return False
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(resource, []).append(waiter)
+            await waiter
+        return True
+
+    async def close(self) -> None:
+        tasks = [task for tasks in self._tasks.values() for task in tasks]
+        for resource in list(self._tasks):
+            self.forget(resource)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.client.close()
+
+    async def _poll(self, check: HealthCheck) -> None:
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(check.initial_delay)
+        deadline = loop.time() + check.period * check.failure_threshold
+        interval, successes, failures = self.min_interval, 0, 0
+        results = self._results[check.resource]
+        while True:
+            checked = perf_counter()
+            try:
+                passed = await self._check(check)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                passed = False
+            self.check_durations.observe(perf_counter() - checked, check.resource, check.kind)
+            if passed and self.timeline is not None:
+                self.timeline.health_passed(check.resource, perf_counter())
+            successes, failures = (successes + 1, 0) if passed else (0, failures + 1)
+            result = results[check]
+            if passed and successes >= check.success_threshold:
+                result = True
+            elif not passed and result is not None and failures >= check.failure_threshold:
+                result = False
+            elif not passed and result is None and check.kind in ("startup", "liveness") and loop.time() >= deadline:
+                # Until a check has passed once it is polled faster than its period, so the failure
+                # threshold of startup and liveness probes is applied as a duration instead.
+                result = False
+            if result != results[check]:
+                results[check] = result
+                self._update(check.resource)
+                interval = self.min_interval
+            elif result:
+                interval = check.period
+            else:
+                interval = min(interval * 2, check.period)
+            if check.kind == "startup" and result:
+                return
+            await asyncio.sleep(interval)
+
+    async def _check(self, check: HealthCheck) -> bool:
+        if check.url.startswith("tcp://"):
+            host, _, port = check.url[len("tcp://"):].rpartition(":")
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), check.timeout)
+            writer.close()
+            await writer.wait_closed()
+            return True
+        return check.passes(await self.client.get(check.url, timeout=check.timeout))
+
+    def _update(self, resource: str) -> None:
+        results = self._results[resource]
+        if any(result is False for result in results.values()):
+            self._set_state(resource, "unhealthy")
+        elif all(result for check, result in results.items() if check.kind != "liveness"):
+            self._set_state(resource, "healthy")
+
+    def _set_state(self, resource: str, state: str) -> None:
+        previous = self.states.get(resource, "")
+        if previous == state:
+            return
+        self.states[resource] = state
+        if state == "healthy":
+            self._healthy.add(resource)
+        transition = HealthTransition(resource, previous, state, perf_counter())
+        self.transitions.append(transition)
+        if state == "healthy" and self.timeline is not None:
+            self.timeline.healthy(resource, transition.time)
+        if self.on_transition is not None:
+            self.on_transition(transition)
+        for waiter in self._waiters.pop(resource, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+_LOG_WORD = compile(r"\w+")
+
+
+@dataclass(frozen=True)
+class LogRecord:
+    '''A line of output of a resource, numbered per resource, at a ``time.time()`` time.'''
+    resource: str
+    sequence: int
+    time: float
+    line: str
+
+
+class LogBuffer:
+    '''The latest output lines of one resource, bounded to ``max_bytes`` bytes of text.
+
+    Older lines are evicted as new ones arrive; with a ``spill_dir`` they are appended to a gzip
+    compressed ``<resource>.log.gz`` file there first, which is rotated to ``<resource>.1.log.gz`` and
+    so on when it has taken ``spill_max_bytes`` bytes of text, keeping ``spill_files`` rotated files.
+    With ``max_lines_per_second``, lines beyond that rate (after a burst of as many lines) are
+    dropped and counted, and the next line that is kept is preceded by a line saying how many were.
+
+    The words of the kept lines are indexed as they arrive, and evicted lines are removed from the
+    index in batches. ``search`` matches whole words, so the lines it looks at are those that have
+    every word of the query, and it only looks at every line for a query without a word.
+    '''
+
+    def __init__(
+            self,
+            resource: str,
+            *,
+            max_bytes: int = 1024 * 1024,
+            spill_dir: str | os.PathLike[str] | None = None,
+            spill_max_bytes: int = 16 * 1024 * 1024,
+            spill_files: int = 3,
+            max_lines_per_second: float | None = None) -> None:
+        if max_bytes < 1 or spill_max_bytes < 1 or spill_files < 0:
+            raise ValueError("Log buffer sizes must be positive, and the number of spill files not negative.")
+        if max_lines_per_second is not None and max_lines_per_second <= 0:
+            raise ValueError("The log line rate must be positive.")
+        self.resource = resource
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else None
+        self.spill_max_bytes = spill_max_bytes
+        self.spill_files = spill_files
+        self.max_lines_per_second = max_lines_per_second
+        self.size = 0
+        self.dropped = 0
+        self.evicted = 0
+        self._records: list[tuple[LogRecord, int]] = []
+        self._sequence = 0
+        self._tokens = max_lines_per_second or 0.0
+        self._refilled = perf_counter()
+        self._unreported = 0
+        self._spill: Any = None
+        self._spilled = 0
+        self._index: dict[str, int | deque[int]] = {}
+        self._stale = 0
+        self._waiters: list[Any] = []
+        self.finished = False
+
+    def append(self, line: str, timestamp: float | None = None) -> LogRecord | None:
+        '''Adds a line and returns its record, or returns None if the rate limiter dropped it.'''
+        if self.max_lines_per_second is not None:
+            now = perf_counter()
+            self._tokens = min(self.max_lines_per_second, self._tokens + (now - self._refilled) * self.max_lines_per_second)
+            self._refilled = now
+            if self._tokens < 1:
+                self.dropped += 1
+                self._unreported += 1
+                return None
+            self._tokens -= 1
+        timestamp = time.time() if timestamp is None else timestamp
+        if self._unreported:
+            unreported, self._unreported = self._unreported, 0
+            self._add(f"[{unreported} lines dropped by the log rate limit]", timestamp)
+        return self._add(line, timestamp)
+
+    def records(self, after: int = 0) -> list[LogRecord]:
+        '''Returns the buffered records, or only those with a sequence number above ``after``.'''
+        start = self._stale
+        if after > 0 and start < len(self._records):
+            start += max(after - self._records[start][0].sequence + 1, 0)
+        return [record for record, _ in self._records[start:]]
+
+    def search(self, query: str, *, since: float | None = None) -> list[LogRecord]:
+        '''Returns the buffered records whose line has ``query`` as whole words, ignoring case, from ``since`` on.'''
+        query = query.lower()
+        words = set(_LOG_WORD.findall(query))
+        if not words:
+            return [
+                record for record in self.records()
+                if (since is None or record.time >= since) and query in record.line.lower()]
+        if not all(word in self._index for word in words):
+            return []
+        postings = sorted(
+            ((postings,) if type(postings := self._index[word]) is int else postings for word in words), key=len)
+        sequences = set(postings[0]).intersection(*postings[1:])
+        offset = self._stale - self._records[self._stale][0].sequence
+        # The query may not start or end in the middle of a word of the line.
+        pattern = compile(
+            ("(?<!\\w)" if _LOG_WORD.match(query) else "") + escape(query)
+            + ("(?!\\w)" if _LOG_WORD.match(query[-1]) else ""))
+        return [
+            record for record in (
+                self._records[sequence + offset][0] for sequence in sorted(sequences) if sequence + offset >= self._stale)
+            if (since is None or record.time >= since) and pattern.search(record.line.lower())]
+
+    async def follow(self, *, after: int = 0) -> AsyncIterator[LogRecord]:
+        '''Yields the buffered records after ``after`` and then new ones as they arrive, until ``finish()``.'''
+        while True:
+            for record in self.records(after):
+                after = record.sequence
+                yield record
+            if self.finished:
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+    def finish(self) -> None:
+        '''Marks that no more lines will arrive, which ends ``follow``.'''
+        self.finished = True
+        self._wake()
+
+    def _wake(self) -> None:
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def _add(self, line: str, timestamp: float) -> LogRecord:
+        self._sequence += 1
+        record = LogRecord(self.resource, self._sequence, timestamp, line)
+        size = len(line.encode("utf-8", "replace"))
+        self._records.append((record, size))
+        self.size += size
+        index = self._index
+        for word in set(_LOG_WORD.findall(line.lower())):
+            # Most words occur in one line only, so their posting is a bare sequence number.
+            postings = index.get(word)
+            if postings is None:
+                index[word] = record.sequence
+            elif type(postings) is int:
+                index[word] = deque((postings, record.sequence))
+            else:
+                postings.append(record.sequence)
+        while self.size > self.max_bytes and len(self._records) - self._stale > 1:
+            evicted, evicted_size = self._records[self._stale]
+            self.size -= evicted_size
+            self.evicted += 1
+            self._stale += 1
+            if self.spill_dir is not None:
+                self._write_spill(evicted, evicted_size)
+        if self._stale > len(self._records) - self._stale:
+            self._compact()
+        if self._waiters:
+            self._wake()
+        return record
+
+    def _compact(self) -> None:
+        # Evicted lines are removed from the records and the index in batches, when there are more of
+        # them than lines in the buffer, which is cheaper than tokenizing every evicted line again and
+        # keeps the records a list that is indexed by sequence number.
+        del self._records[:self._stale]
+        first = self._records[0][0].sequence
+        for word, postings in list(self._index.items()):
+            if type(postings) is int:
+                if postings < first:
+                    del self._index[word]
+                continue
+            while postings and postings[0] < first:
+                postings.popleft()
+            if len(postings) <= 1:
+                if postings:
+                    self._index[word] = postings[0]
+                else:
+                    del self._index[word]
+        self._stale = 0
+
+    def _write_spill(self, record: LogRecord, size: int) -> None:
+        import gzip
+        path = self.spill_dir / f"{self.resource}.log.gz"
+        if self._spill is not None and self._spilled + size > self.spill_max_bytes:
+            self._spill.close()
+            self._spill = None
+            rotated = [path, *(self.spill_dir / f"{self.resource}.{index}.log.gz" for index in range(1, self.spill_files + 1))]
+            rotated[-1].unlink(missing_ok=True)
+            for source, target in reversed(list(zip(rotated, rotated[1:]))):
+                if source.exists():
+                    os.replace(source, target)
+        if self._spill is None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            self._spill = gzip.open(path, "at", encoding="utf-8", errors="replace")
+            self._spilled = 0
+        self._spill.write(f"{record.time:.6f} {record.line}\n")
+        self._spilled += size
+
+
+class LogStore:
+    '''The log buffers of the resources of a run, created on first use with the same limits.'''
+
+    def __init__(self, **limits: Any) -> None:
+        LogBuffer("", **limits)  # Validates the limits.
+        self.limits = limits
+        self.buffers: dict[str, LogBuffer] = {}
+
+    def buffer(self, resource: str) -> LogBuffer:
+        if (buffer := self.buffers.get(resource)) is None:
+            buffer = self.buffers[resource] = LogBuffer(resource, **self.limits)
+        return buffer
+
+    def append(self, resource: str, line: str) -> LogRecord | None:
+        return self.buffer(resource).append(line)
+
+    def search(
+            self,
+            query: str,
+            *,
+            resources: Iterable[str] | None = None,
+            since: float | None = None) -> list[LogRecord]:
+        '''Searches the buffers of the resources (by default, all of them) and returns the matches by time.'''
+        buffers = self.buffers.values() if resources is None else [self.buffer(resource) for resource in resources]
+        return list(heapq.merge(
+            *(buffer.search(query, since=since) for buffer in buffers), key=lambda record: (record.time, record.sequence)))
+
+    @property
+    def dropped(self) -> dict[str, int]:
+        return {resource: buffer.dropped for resource, buffer in self.buffers.items() if buffer.dropped}
+
+    def close(self) -> None:
+        for buffer in self.buffers.values():
+            buffer.close()
+
+
+class SampleRing:
+    '''A fixed number of the latest (time, CPU percent, RSS bytes) samples, in preallocated arrays.'''
+
+    def __init__(self, capacity: int) -> None:
+        if capacity < 1:
+            raise ValueError("The sample capacity must be positive.")
+        self.capacity = capacity
+        self.count = 0
+        self.times = array("d", bytes(8 * capacity))
+        self.cpu = array("d", bytes(8 * capacity))
+        self.rss = array("Q", bytes(8 * capacity))
+
+    def append(self, time: float, cpu: float, rss: int) -> None:
+        index = self.count % self.capacity
+        self.times[index], self.cpu[index], self.rss[index] = time, cpu, rss
+        self.count += 1
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    def samples(self) -> list[tuple[float, float, int]]:
+        '''Returns the samples in the ring, oldest first.'''
+        start = self.count - len(self)
+        return [
+            (self.times[index % self.capacity], self.cpu[index % self.capacity], self.rss[index % self.capacity])
+            for index in range(start, self.count)]
+
+
+@dataclass(frozen=True)
+class ResourceMetrics:
+    '''A summary of the CPU and memory use of the process tree of a resource.
+
+    The CPU percentiles are over the samples still in the ring, where 100 is one fully used core;
+    the peak RSS is over the whole run.
+    '''
+    resource: str
+    samples: int
+    cpu_p50: float
+    cpu_p95: float
+    peak_rss: int
+    last_rss: int
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(len(ordered) * percent / 100) - 1)]
+
+
+def _process_tree(pid: int) -> list[int]:
+    tree, pending = [], [pid]
+    while pending:
+        tree.append(current := pending.pop())
+        try:
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pending.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+    return tree
+
+
+def _read_process(pid: int) -> tuple[int, int, int, int] | None:
+    '''Returns the CPU clock ticks used by a process and the children it waited for, its resident set
+    size in bytes, its parent and its start time in clock ticks since boot.'''
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as stat:
+            fields = stat.read().rpartition(b")")[2].split()
+        rss = 0
+        with open(f"/proc/{pid}/status", "rb") as status:
+            for line in status:
+                if line.startswith(b"VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        return None
+    return sum(int(ticks) for ticks in fields[11:15]), rss, int(fields[1]), int(fields[19])
+
+
+def _uptime_ticks() -> int | None:
+    try:
+        with open("/proc/uptime", "rb") as uptime:
+            return int(float(uptime.read().split()[0]) * os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ProcessSampler:
+    '''Samples the CPU and memory use of the process trees of running resources from ``/proc``.
+
+    Every ``interval`` seconds, the CPU time of each process and its descendants is read from
+    ``/proc/<pid>/stat`` and the RSS from ``/proc/<pid>/status``, and the last ``capacity`` samples
+    of every resource are kept in a ``SampleRing``. Sampling does nothing where there is no ``/proc``.
+
+    Processes that started since the last sample are counted from their start, and processes that
+    exited are counted through the children CPU time of the process of the tree that waited for them,
+    so short-lived children are included. The CPU time that a process used since the last sample is
+    lost if it exits without being waited for by the tree, as when its parent exited before it or
+    ignores ``SIGCHLD``, and so is that of the processes that started before the first sample.
+    '''
+
+    def __init__(self, *, interval: float = 1.0, capacity: int = 3600) -> None:
+        if interval <= 0:
+            raise ValueError("The sample interval must be positive.")
+        SampleRing(capacity)
+        self.interval = interval
+        self.capacity = capacity
+        self.rings: dict[str, SampleRing] = {}
+        self.peak_rss: dict[str, int] = {}
+        self._processes: dict[int, tuple[int, int, int]] = {}
+        self._trees: dict[str, set[int]] = {}
+        self._uptime: int | None = None
+        self._sampled: float | None = None
+
+    async def run(self, pids: Callable[[], Mapping[str, int]]) -> None:
+        '''Samples the processes returned by ``pids``, by resource name, until cancelled.'''
+        if not os.path.exists("/proc/self/stat"):
+            return
+        while True:
+            self.sample(pids())
+            await asyncio.sleep(self.interval)
+
+    def sample(self, pids: Mapping[str, int]) -> None:
+        now = perf_counter()
+        elapsed = None if self._sampled is None else now - self._sampled
+        self._sampled = now
+        ticks_per_second = os.sysconf("SC_CLK_TCK")
+        previous, self._uptime = self._uptime, _uptime_ticks()
+        processes: dict[int, tuple[int, int, int]] = {}
+        trees: dict[str, set[int]] = {}
+        for resource, pid in pids.items():
+            used, rss, tree = 0, 0, trees.setdefault(resource, set())
+            for member in _process_tree(pid):
+                if (usage := _read_process(member)) is None:
+                    continue
+                ticks, size, parent, start = usage
+                processes[member] = start, ticks, parent
+                tree.add(member)
+                rss += size
+                if (seen := self._processes.get(member)) is not None and seen[0] == start:
+                    used += ticks - seen[1]
+                elif previous is not None and start >= previous:
+                    used += ticks
+            # An exited process that was waited for by the tree is now in the children CPU time of the
+            # process that waited, including the part that was counted while it ran.
+            for member in self._trees.get(resource, set()) - tree:
+                waiter = self._processes[member][2]
+                while waiter not in tree and waiter in self._processes and waiter not in processes:
+                    waiter = self._processes[waiter][2]
+                if waiter in tree:
+                    used -= self._processes[member][1]
+            if elapsed is None:
+                continue
+            ring = self.rings.get(resource)
+            if ring is None:
+                ring = self.rings[resource] = SampleRing(self.capacity)
+            ring.append(time.time(), 100 * max(used, 0) / ticks_per_second / elapsed, rss)
+            self.peak_rss[resource] = max(self.peak_rss.get(resource, 0), rss)
+        self._processes, self._trees = processes, trees
+
+    def metrics(self) -> dict[str, ResourceMetrics]:
+        metrics = {}
+        for resource, ring in self.rings.items():
+            samples = ring.samples()
+            cpu = [sample[1] for sample in samples]
+            metrics[resource] = ResourceMetrics(
+                resource, len(samples), _percentile(cpu, 50), _percentile(cpu, 95),
+                self.peak_rss.get(resource, 0), samples[-1][2] if samples else 0)
+        return metrics
+
+    def to_json(self, *, include_samples: bool = False) -> str:
+        '''Returns the metrics, and optionally the samples, of every resource as JSON.'''
+        data = {}
+        for resource, metrics in self.metrics().items():
+            data[resource] = asdict(metrics)
+            del data[resource]["resource"]
+            if include_samples:
+                data[resource]["series"] = [
+                    {"time": time, "cpu": cpu, "rss": rss} for time, cpu, rss in self.rings[resource].samples()]
+        return json.dumps({"interval": self.interval, "resources": data}, indent=2)
+
+
+@dataclass
+class DependencyWait:
+    '''A wait of a resource for a dependency to be ``condition``, ``"healthy"`` or ``"exit code N"``.'''
+    dependency: str
+    condition: str
+    start: float
+    end: float | None = None
+    satisfied: bool = False
+
+
+@dataclass
+class ResourceTimeline:
+    '''The ``time.perf_counter()`` times of the first start of a resource, None until they happen.'''
+    resource: str
+    queued: float | None = None
+    waits: list[DependencyWait] = field(default_factory=list)
+    launching: float | None = None
+    started: float | None = None
+    first_health_pass: float | None = None
+    ready: float | None = None
+    restarts: list[float] = field(default_factory=list)
+    exited: float | None = None
+    exit_code: int | None = None
+
+
+class StartupTimeline:
+    '''The startup timelines of the resources of a run, exported as Chrome trace events.
+
+    Each resource is a track, with a ``startup`` slice from being queued until it is ready, containing
+    a slice for each dependency wait, ``spawn`` for creating the process and ``starting`` until its
+    health checks pass. Satisfied waits are linked by a flow arrow from the resource waited on.
+    '''
+
+    def __init__(self) -> None:
+        self.origin = perf_counter()
+        self.resources: dict[str, ResourceTimeline] = {}
+
+    def resource(self, name: str) -> ResourceTimeline:
+        if (timeline := self.resources.get(name)) is None:
+            timeline = self.resources[name] = ResourceTimeline(name)
+        return timeline
+
+    def queue(self, names: Iterable[str]) -> None:
+        '''Starts the timeline, with the resources queued now.'''
+        self.origin = perf_counter()
+        self.resources = {name: ResourceTimeline(name, queued=self.origin) for name in names}
+
+    def health_passed(self, name: str, time: float) -> None:
+        timeline = self.resource(name)
+        if timeline.first_health_pass is None:
+            timeline.first_health_pass = time
+
+    def healthy(self, name: str, time: float) -> None:
+        timeline = self.resource(name)
+        if timeline.ready is None and timeline.started is not None:
+            timeline.ready = time
+
+    def to_trace(self) -> dict[str, Any]:
+        '''Returns the timelines in the Chrome trace event format, which Perfetto opens.'''
+        now = perf_counter()
+        tids = {name: index for index, name in enumerate(self.resources, 1)}
+        events: list[dict[str, Any]] = [{"ph": "M", "pid": 1, "name": "process_name", "args": {"name": "aspyre run"}}]
+
+        def us(time: float) -> float:
+            return round((time - self.origin) * 1e6, 3)
+
+        def span(name: str, tid: int, start: float, end: float | None, category: str, **args: Any) -> None:
+            event = {"ph": "X", "pid": 1, "tid": tid, "name": name, "cat": category, "ts": us(start), "dur": us(end or now) - us(start)}
+            if args:
+                event["args"] = args
+            events.append(event)
+
+        def instant(name: str, tid: int, time: float, **args: Any) -> None:
+            event = {"ph": "i", "s": "t", "pid": 1, "tid": tid, "name": name, "cat": "lifecycle", "ts": us(time)}
+            if args:
+                event["args"] = args
+            events.append(event)
+
+        for name, timeline in self.resources.items():
+            tid = tids[name]
+            events.append({"ph": "M", "pid": 1, "tid": tid, "name": "thread_name", "args": {"name": name}})
+            events.append({"ph": "M", "pid": 1, "tid": tid, "name": "thread_sort_index", "args": {"sort_index": tid}})
+            if timeline.queued is None:
+                continue
+            span("startup", tid, timeline.queued, timeline.ready or timeline.started or timeline.exited, "lifecycle")
+            for wait in timeline.waits:
+                span(f"wait for {wait.dependency}", tid, wait.start, wait.end, "dependency",
+                     resource=wait.dependency, condition=wait.condition, satisfied=wait.satisfied)
+            if timeline.launching is not None:
+                span("spawn", tid, timeline.launching, timeline.started or timeline.exited, "lifecycle")
+            if timeline.started is not None:
+                span("starting", tid, timeline.started, timeline.ready or timeline.exited, "lifecycle")
+                span("running", tid, timeline.started, timeline.exited, "lifecycle")
+            for label, time in (("first health pass", timeline.first_health_pass), ("ready", timeline.ready)):
+                if time is not None:
+                    instant(label, tid, time)
+            for time in timeline.restarts:
+                instant("restart", tid, time)
+            if timeline.exited is not None:
+                instant("exited", tid, timeline.exited, exit_code=timeline.exit_code)
+
+        flow = 0
+        for name, timeline in self.resources.items():
+            for wait in timeline.waits:
+                dependency = self.resources.get(wait.dependency)
+                if not wait.satisfied or wait.end is None or dependency is None:
+                    continue
+                source = dependency.ready if wait.condition == "healthy" else dependency.exited
+                if source is None:
+                    continue
+                flow += 1
+                # Flow events bind to the slice enclosing their time, so both ends are put just inside
+                # the slices they link: the starting or running slice of the dependency, and the wait.
+                events.append({
+                    "ph": "s", "pid": 1, "tid": tids[wait.dependency], "id": flow, "name": f"{wait.dependency} {wait.condition}",
+                    "cat": "dependency", "ts": max(us(source) - 0.001, us(dependency.started or source))})
+                events.append({
+                    "ph": "f", "bp": "e", "pid": 1, "tid": tids[name], "id": flow, "name": f"{wait.dependency} {wait.condition}",
+                    "cat": "dependency", "ts": max(us(wait.end) - 0.001, us(wait.start))})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def to_json(self) -> str:
+        '''Returns ``to_trace()`` as JSON.'''
+        return json.dumps(self.to_trace())
+
+
+class MetricsServer:
+    '''Serves the text returned by ``render`` on ``/metrics`` over HTTP, as an asyncio server.'''
+
+    def __init__(self, render: Callable[[], str], *, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.render = render
+        self.host = host
+        self.port = port
+        self.url: str | None = None
+        self._server: Any = None
+
+    async def start(self) -> str:
+        '''Starts serving and returns the URL of the metrics, with the port that was bound.'''
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"http://{self.host}:{port}/metrics"
+        return self.url
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: Any, writer: Any) -> None:
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request) >= 2 and request[0] in ("GET", "HEAD") and request[1].partition("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", self.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + (body if request[:1] != ["HEAD"] else b""))
+            await writer.drain()
+        except (OSError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+
+class ProcessSupervisor:
+    '''Runs local processes with asyncio, starting each one as soon as the resources it waits for allow it.
+
+    Processes that do not wait for each other are started concurrently. Waiting for a resource waits
+    until ``health`` reports it healthy, or for its exit code with ``WaitForCompletion``. A process is
+    not started when a resource it waits for stops first, or completes with another exit code than
+    expected. Processes with a ``RestartPolicy`` are restarted as it says; a restarting resource is not
+    healthy, so resources that wait for it stay gated until it is healthy again.
+
+    Output lines are captured in ``logs``, and the lines that its rate limit keeps are passed to
+    ``on_output`` with the resource name, or printed with the name as prefix. With a ``sampler``, the
+    CPU and memory use of the running processes is sampled. With a ``metrics_port`` (0 for any free
+    port), ``prometheus()`` is served on ``metrics_url`` while the processes run, and the URL is passed
+    to ``on_output`` as a line of ``aspyre`` when the run starts. The startup of the resources is
+    recorded in ``timeline``.
+    '''
+
+    def __init__(
+            self,
+            processes: Iterable[LocalProcess],
+            *,
+            on_output: Callable[[str, str], None] | None = None,
+            health: HealthMonitor | None = None,
+            logs: LogStore | None = None,
+            sampler: ProcessSampler | None = None,
+            metrics_port: int | None = None,
+            timeline: StartupTimeline | None = None,
+            shutdown_timeout: float = 10.0) -> None:
+        self.processes = {process.name: process for process in processes}
+        self.health = health or HealthMonitor()
+        self.timeline = timeline if timeline is not None else StartupTimeline()
+        self.health.timeline = self.timeline
+        self.logs = logs if logs is not None else LogStore()
+        self.sampler = sampler
+        self.metrics_port = metrics_port
+        self.metrics_url: str | None = None
+        self.on_output = on_output or (lambda name, line: print(f"{name} | {line}", flush=True))
+        self.shutdown_timeout = shutdown_timeout
+        self.exit_codes: dict[str, int | None] = {}
+        self.restarts: dict[str, int] = {}
+        # Set once the metrics are served and the processes are being started by run().
+        self.running = asyncio.Event()
+
+    async def run(self) -> dict[str, int | None]:
+        '''Runs the processes until all have exited, and returns their exit codes (None if never started).'''
+        loop = asyncio.get_running_loop()
+        self._started = {name: loop.create_future() for name in self.processes}
+        self._exited = {name: loop.create_future() for name in self.processes}
+        self._running: dict[str, asyncio.subprocess.Process] = {}
+        self._run_started = perf_counter()
+        self.timeline.queue(self.processes)
+        server = None
+        if self.metrics_port is not None:
+            server = MetricsServer(self.prometheus, port=self.metrics_port)
+            self.metrics_url = await server.start()
+            self.on_output("aspyre", f"Serving Prometheus metrics on {self.metrics_url}")
+        tasks = [asyncio.create_task(self._supervise(process)) for process in self.processes.values()]
+        sampling = None
+        if self.sampler is not None:
+            sampling = asyncio.create_task(self.sampler.run(
+                lambda: {name: child.pid for name, child in self._running.items() if child.returncode is None}))
+        self.running.set()
+        try:
+            # Shielded so that cancelling the run stops the running processes below before their tasks
+            # are cancelled and forget them.
+            await asyncio.shield(supervising := asyncio.gather(*tasks))
+        finally:
+            if sampling is not None:
+                sampling.cancel()
+            for task in tasks:
+                task.cancel()
+            await self._stop()
+            await asyncio.gather(supervising, return_exceptions=True)
+            await self.health.close()
+            self.logs.close()
+            if server is not None:
+                await server.close()
+        return self.exit_codes
+
+    def prometheus(self) -> str:
+        '''Returns the states, startup latencies, restarts, health checks and resource use in the Prometheus format.'''
+        lines = [
+            "# HELP aspyre_resource_state Whether the resource is in the state.",
+            "# TYPE aspyre_resource_state gauge",
+        ]
+        states = ("waiting", "starting", "healthy", "unhealthy", "restarting", "crash-loop", "stopped")
+        for name in self.processes:
+            current = self.health.states.get(name, "waiting")
+            label = _prometheus_escape(name)
+            lines.extend(f'aspyre_resource_state{{resource="{label}",state="{state}"}} {int(state == current)}' for state in states)
+        start, ready = Histogram(("resource",)), Histogram(("resource",))
+        starting: dict[str, float] = {}
+        for transition in self.health.transitions:
+            if transition.state == "starting":
+                starting[transition.resource] = transition.time
+                start.observe(transition.time - self._run_started, transition.resource)
+            elif transition.state == "healthy" and transition.resource in starting:
+                ready.observe(transition.time - starting.pop(transition.resource), transition.resource)
+        lines += start.render("aspyre_resource_start_seconds", "Seconds from the start of the run until the resource was started.")
+        lines += ready.render("aspyre_resource_ready_seconds", "Seconds from the start of the resource until it was healthy.")
+        lines += ["# HELP aspyre_resource_restarts_total Restarts of the resource.", "# TYPE aspyre_resource_restarts_total counter"]
+        lines.extend(
+            f'aspyre_resource_restarts_total{{resource="{_prometheus_escape(name)}"}} {self.restarts.get(name, 0)}'
+            for name in self.processes)
+        lines += self.health.check_durations.render(
+            "aspyre_health_check_duration_seconds", "Seconds taken by health check requests.")
+        lines += [
+            "# HELP aspyre_log_lines_dropped_total Output lines dropped by the log rate limit.",
+            "# TYPE aspyre_log_lines_dropped_total counter"]
+        lines.extend(
+            f'aspyre_log_lines_dropped_total{{resource="{_prometheus_escape(name)}"}} {buffer.dropped}'
+            for name, buffer in self.logs.buffers.items())
+        if self.sampler is not None:
+            metrics = self.sampler.metrics()
+            for name, help, value in (
+                    ("aspyre_process_cpu_percent", "CPU use of the process tree, where 100 is one core.", lambda m, ring: ring.samples()[-1][1]),
+                    ("aspyre_process_resident_memory_bytes", "Resident memory of the process tree.", lambda m, ring: m.last_rss),
+                    ("aspyre_process_peak_resident_memory_bytes", "Peak resident memory of the process tree.", lambda m, ring: m.peak_rss)):
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+                lines.extend(
+                    f'{name}{{resource="{_prometheus_escape(resource)}"}} {value(resource_metrics, self.sampler.rings[resource])}'
+                    for resource, resource_metrics in metrics.items() if resource_metrics.samples)
+        return "\n".join(lines) + "\n"
+
+    async def _supervise(self, process: LocalProcess) -> None:
+        started, exited = self._started[process.name], self._exited[process.name]
+        timeline = self.timeline.resource(process.name)
+        try:
+            for dependency, exit_code in process.waits:
+                wait = DependencyWait(dependency, "healthy" if exit_code is None else f"exit code {exit_code}", perf_counter())
+                timeline.waits.append(wait)
+                wait.satisfied = await self._started[dependency] and (
+                    await self.health.wait_healthy(dependency) if exit_code is None
+                    else await self._exited[dependency] == exit_code)
+                wait.end = perf_counter()
+                if not wait.satisfied:
+                    break
+            else:
+                policy = process.restart or RestartPolicy("no")
+                loop = asyncio.get_running_loop()
+                failures = 0
+                while True:
+                    if timeline.launching is None:
+                        timeline.launching = perf_counter()
+                    child = await asyncio.create_subprocess_exec(
+                        *process.args,
+                        cwd=process.working_dir,
+                        env={**os.environ, **process.env},
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.STDOUT)
+                    launched = loop.time()
+                    if timeline.started is None:
+                        timeline.started = perf_counter()
+                    self._running[process.name] = child
+                    self.health.watch(process.name, process.checks)
+                    if not started.done():
+                        started.set_result(True)
+                    assert child.stdout is not None
+                    await self._read_output(process.name, child.stdout)
+                    exit_code = self.exit_codes[process.name] = await child.wait()
+                    if loop.time() - launched >= policy.reset_after:
+                        failures = 0
+                    if not policy.should_restart(exit_code):
+                        break
+                    if policy.max_retries is not None and failures >= policy.max_retries:
+                        self._output(process.name, f"Exited with {exit_code}, not restarted after {failures} restarts in a row.")
+                        break
+                    failures += 1
+                    self.restarts[process.name] = self.restarts.get(process.name, 0) + 1
+                    timeline.restarts.append(perf_counter())
+                    delay = policy.delay(failures)
+                    if failures >= policy.crash_loop_threshold:
+                        self.health.forget(process.name, state="crash-loop")
+                        self._output(process.name, f"Crash loop: exited with {exit_code} {failures} times in a row, restarting in {delay:g}s.")
+                    else:
+                        self.health.forget(process.name, state="restarting")
+                        self._output(process.name, f"Exited with {exit_code}, restarting in {delay:g}s.")
+                    await asyncio.sleep(delay)
+                timeline.exited, timeline.exit_code = perf_counter(), exit_code
+                exited.set_result(exit_code)
+                return
+        except OSError as error:
+            self._output(process.name, f"Failed to start: {error}")
+        finally:
+            self._running.pop(process.name, None)
+            self.health.forget(process.name)
+            self.logs.buffer(process.name).finish()
+            if not started.done():
+                started.set_result(False)
+            if not exited.done():
+                self.exit_codes.setdefault(process.name, None)
+                exited.set_result(None)
+
+    async def _read_output(self, name: str, stream: Any) -> None:
+        skipping = False
+        while True:
+            try:
+                line = await stream.readuntil(b"\n")
+            except asyncio.IncompleteReadError as error:
+                line = error.partial
+            except asyncio.LimitOverrunError as error:
+                # The line is longer than the stream limit, so it is dropped up to its end, in chunks.
+                if not skipping:
+                    self.logs.buffer(name).dropped += 1
+                    skipping = True
+                await stream.readexactly(error.consumed)
+                continue
+            if not line:
+                return
+            if skipping:
+                skipping = False
+                continue
+            self._output(name, line.decode(errors="replace").rstrip("\r\n"))
+
+    def _output(self, name: str, line: str) -> None:
+        if self.logs.append(name, line) is not None:
+            self.on_output(name, line)
+
+    async def _stop(self) -> None:
+        running = [child for child in self._running.values() if child.returncode is None]
+        for child in running:
+            child.terminate()
+        if running:
+            _, pending = await asyncio.wait([asyncio.create_task(child.wait()) for child in running], timeout=self.shutdown_timeout)
+            for child in running:
+                if child.returncode is None:
+                    child.kill()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+class ProcessRunner(AppHostRunner):
+    '''Runs the executable and Python app resources of an application as local processes, without .NET.
+
+    This is the runner of ``run(engine="python")``. Other resources than parameters, connection
+    strings and external services are not supported, and raise a ValueError. The output of the
+    resources is captured in ``logs`` if given, which is then set as ``log_store`` of the application,
+    and otherwise in the ``log_store`` of the application. Unless ``sample_interval`` is None, the CPU
+    and memory use of the processes is sampled at that interval by a ``ProcessSampler``, set as
+    ``sampler``. With a ``metrics_port`` (0 for any free port), Prometheus metrics of the run are
+    served on ``/metrics`` on that port, at the URL printed when the run starts and held by the
+    ``metrics_url`` of ``start()``. The startup of the resources is recorded in a ``StartupTimeline``,
+    set as ``timeline``.
+    '''
+
+    def __init__(
+            self,
+            *,
+            on_output: Callable[[str, str], None] | None = None,
+            environ: Mapping[str, str] | None = None,
+            logs: LogStore | None = None,
+            sample_interval: float | None = 1.0,
+            metrics_port: int | None = None,
+            shutdown_timeout: float = 10.0) -> None:
+        self.on_output = on_output
+        self.environ = environ
+        self.logs = logs
+        self.sample_interval = sample_interval
+        self.metrics_port = metrics_port
+        self.shutdown_timeout = shutdown_timeout
+
+    def supervisor(self, app: DistributedApplication) -> ProcessSupervisor:
+        processes = _local_processes(
+            app.calls(), app.apphost_path.parent, os.environ if self.environ is None else self.environ, app.restart_policies)
+        app._endpoints.update((process.name, process.endpoints) for process in processes.values())
+        if self.logs is not None:
+            app.log_store = self.logs
+        app.sampler = None if self.sample_interval is None else ProcessSampler(interval=self.sample_interval)
+        app.timeline = StartupTimeline()
+        return ProcessSupervisor(
+            processes.values(),
+            on_output=self.on_output,
+            logs=app.log_store,
+            sampler=app.sampler,
+            metrics_port=self.metrics_port,
+            timeline=app.timeline,
+            shutdown_timeout=self.shutdown_timeout)
+
+    def run(self, app: DistributedApplication) -> int:
+        import signal
+        import threading
+        supervisor = self.supervisor(app)
+
+        async def main() -> dict[str, int | None]:
+            task = asyncio.current_task()
+            if threading.current_thread() is threading.main_thread() and task is not None:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+            return await supervisor.run()
+
+        try:
+            exit_codes = asyncio.run(main())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            return 130
+        return next((1 if code is None else code for code in exit_codes.values() if code != 0), 0)
+
+
+class RunningApplication:
+    '''An application started by ``DistributedApplication.start()``, whose processes are supervised by ``supervisor``.
+
+    The output of the resources is read with ``logs`` and ``search_logs``, their startup is recorded in
+    ``timeline``, and the Prometheus metrics of the run are served on ``metrics_url`` if the runner was
+    given a ``metrics_port``.
+    '''
+
+    def __init__(self, app: DistributedApplication, supervisor: ProcessSupervisor) -> None:
+        self.app = app
+        self.supervisor = supervisor
+        self._task: asyncio.Task[dict[str, int | None]] | None = None
+
+    @property
+    def metrics_url(self) -> str | None:
+        return self.supervisor.metrics_url
+
+    @property
+    def timeline(self) -> StartupTimeline:
+        return self.supervisor.timeline
+
+    @property
+    def exit_codes(self) -> dict[str, int | None]:
+        '''The exit codes of the processes that have exited, by resource name.'''
+        return self.supervisor.exit_codes
+
+    def logs(self, resource: str | Resource) -> AsyncIterator[LogRecord]:
+        '''Iterates over the output of a resource, following it until the resource stops.'''
+        return self.app.logs(resource)
+
+    def search_logs(
+            self,
+            query: str,
+            *,
+            resources: Iterable[str | Resource] | None = None,
+            since: float | None = None) -> list[LogRecord]:
+        '''Returns the captured lines that have ``query`` as whole words, see ``DistributedApplication.search_logs``.'''
+        return self.app.search_logs(query, resources=resources, since=since)
+
+    async def wait_until_healthy(self, *resources: str | Resource, timeout: float = 60.0) -> dict[str, float]:
+        '''Waits until the resources are ready, see ``DistributedApplication.wait_until_healthy``.
+
+        Raises a RuntimeError if all processes exit first.
+        '''
+        waiting = asyncio.ensure_future(self.app.wait_until_healthy(*resources, timeout=timeout))
+        await asyncio.wait({waiting, self._running()}, return_when=asyncio.FIRST_COMPLETED)
+        if not waiting.done():
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+            raise RuntimeError("The processes of the application exited before the resources were healthy.")
+        return waiting.result()
+
+    async def wait(self) -> dict[str, int | None]:
+        '''Waits until all processes have exited, and returns their exit codes (None if never started).'''
+        return await asyncio.shield(self._running())
+
+    async def stop(self) -> dict[str, int | None]:
+        '''Stops the processes that are still running, and returns the exit codes.'''
+        task = self._running()
+        task.cancel()
+        await asyncio.wait({task})
+        if not task.cancelled() and (error := task.exception()) is not None:
+            raise error
+        return self.supervisor.exit_codes
+
+    async def _start(self) -> None:
+        self._task = asyncio.create_task(self.supervisor.run())
+        running = asyncio.create_task(self.supervisor.running.wait())
+        await asyncio.wait({self._task, running}, return_when=asyncio.FIRST_COMPLETED)
+        running.cancel()
+        if self._task.done():
+            self._task.result()
+
+    def _running(self) -> asyncio.Task[dict[str, int | None]]:
+        if self._task is None:
+            raise ValueError("The application is not started; use 'async with app.start() as running:'.")
+        return self._task
+
+
+class DistributedApplication:
+
+    def __init__(
+            self,
+            apphost_path: Path,
+            changes: TopologyDiff | None = None,
+            *,
+            calls: list[dict[str, Any]] | None = None,
+            restart_policies: Mapping[str, RestartPolicy] | None = None) -> None:
+        self.apphost_path = apphost_path
+        self.changes = changes
+        self.restart_policies = dict(restart_policies or {})
+        self._calls = calls
+        # The endpoints of resources whose ports were assigned when they were run.
+        self._endpoints: dict[str, dict[str, str]] = {}
+        # The output, resource use and startup of the resources, when they are run by the python engine.
+        self.log_store = LogStore()
+        self.sampler: ProcessSampler | None = None
+        self.timeline: StartupTimeline | None = None
+
+    def calls(self) -> list[dict[str, Any]]:
+        '''Returns the calls of the apphost, as structured by the data-driven topology.'''
+        if self._calls is not None:
+            return self._calls
+        topology_path = self.apphost_path.with_name(_TOPOLOGY_FILE)
+        if topology_path.exists():
+            return json.loads(topology_path.read_text())["calls"]
+        raise ValueError(f"The topology of '{self.apphost_path}' is not known; build it with build() or data_driven=True.")
+
+    def readiness_checks(self, *resources: str | Resource) -> dict[str, list[HealthCheck]]:
+        '''Returns the checks that tell when each resource (by default, each one that can be checked) is ready.
+
+        These are the HTTP health checks, and startup and readiness probes of the resource, or if it has
+        none, a TCP connect to each of its endpoints with a known port.
+        '''
+        declarations, configuration, names = _topology_resources(self.calls())
+        variables = {name: var for var, name in names.items()}
+        selected = []
+        for resource in resources:
+            key = resource if isinstance(resource, str) else resource.name
+            if (var := variables.get(key, key)) not in declarations:
+                raise ValueError(f"Resource '{key}' not found.")
+            selected.append(var)
+        checks = {}
+        for var in selected or declarations:
+            name = names[var]
+            endpoints = self._endpoints.get(name) or _resource_endpoints(declarations[var][1], configuration[var])
+            ready = [check for check in _resource_checks(name, endpoints, configuration[var]) if check.kind != "liveness"]
+            ready = ready or [HealthCheck(name, "tcp://" + url.partition("://")[2]) for url in endpoints.values()]
+            if ready:
+                checks[name] = ready
+            elif selected:
+                raise ValueError(f"Resource '{name}' has no health checks or endpoints with a known port to check.")
+        return checks
+
+    async def wait_until_healthy(self, *resources: str | Resource, timeout: float = 60.0) -> dict[str, float]:
+        '''Waits until all of the resources (by default, all that can be checked) are ready, checking them concurrently.
+
+        Returns the seconds it took for each resource to become ready, or raises a TimeoutError naming
+        the resources that were not ready after ``timeout`` seconds.
+        '''
+        checks = self.readiness_checks(*resources)
+        monitor = HealthMonitor()
+        start = perf_counter()
+        for name, resource_checks in checks.items():
+            monitor.watch(name, resource_checks)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(monitor.wait_healthy(name) for name in checks)), timeout)
+        except asyncio.TimeoutError:
+            pending = [name for name in checks if monitor.states.get(name) != "healthy"]
+            raise TimeoutError(f"Resources not healthy after {timeout} seconds: {', '.join(pending)}") from None
+        finally:
+            await monitor.close()
+        ready = {t.resource: t.time - start for t in reversed(monitor.transitions) if t.state == "healthy"}
+        return {name: ready[name] for name in checks}
+
+    def logs(self, resource: str | Resource) -> AsyncIterator[LogRecord]:
+        '''Iterates over the output of a resource run by the python engine, following it until the resource stops.'''
+        return self.log_store.buffer(self._resource_name(resource)).follow()
+
+    def search_logs(
+            self,
+            query: str,
+            *,
+            resources: Iterable[str | Resource] | None = None,
+            since: float | None = None) -> list[LogRecord]:
+        '''Returns the captured lines that have ``query`` as whole words, ignoring case, ordered by time.
+
+        The search is limited to ``resources`` if given, and to lines captured at or after the
+        ``time.time()`` timestamp ``since``. Only the lines still held by the log buffers are searched.
+        '''
+        names = None if resources is None else [self._resource_name(resource) for resource in resources]
+        return self.log_store.search(query, resources=names, since=since)
+
+    def metrics(self) -> dict[str, ResourceMetrics]:
+        '''Returns the CPU and memory use of the resources run by the python engine, by resource name.'''
+        return self._sampler().metrics()
+
+    def metrics_json(self, *, include_samples: bool = False) -> str:
+        '''Returns ``metrics()`` as JSON, optionally with the samples they summarize.'''
+        return self._sampler().to_json(include_samples=include_samples)
+
+    def startup_trace_json(self) -> str:
+        '''Returns the startup timeline of the resources run by the python engine as Chrome trace JSON.
+
+        The JSON opens in Perfetto (ui.perfetto.dev) or chrome://tracing, with a track per resource.
+        '''
+        if self.timeline is None:
+            raise ValueError("The startup timeline is only recorded when the application is run with engine='python'.")
+        return self.timeline.to_json()
+
+    def _sampler(self) -> ProcessSampler:
+        if self.sampler is None:
+            raise ValueError("Metrics are only sampled when the application is run with engine='python'.")
+        return self.sampler
+
+    def _resource_name(self, resource: str | Resource) -> str:
+        if isinstance(resource, str):
+            return resource
+        _, _, names = _topology_resources(self.calls())
+        return names.get(resource.name, resource.name)
+
+    def wait_until_healthy_sync(self, *resources: str | Resource, timeout: float = 60.0) -> dict[str, float]:
+        '''Blocking version of ``wait_until_healthy``, for code that does not run an event loop.'''
+        return asyncio.run(self.wait_until_healthy(*resources, timeout=timeout))
+
+    def run(self, runner: AppHostRunner | None = None, *, engine: Literal["dotnet", "python"] | None = None) -> int:
+        '''Runs the distributed application and returns its exit code.
+
+        The application is run by ``runner``, or by the default runner of ``engine``: a ``DotnetRunner``
+        for ``"dotnet"`` (the default), or a ``ProcessRunner`` for ``"python"``.
+        '''
+        if runner is not None and engine is not None:
+            raise ValueError("Only one of runner and engine can be given.")
+        if runner is None:
+            if engine not in (None, "dotnet", "python"):
+                raise ValueError(f"Invalid engine '{engine}', expected 'dotnet' or 'python'.")
+            runner = ProcessRunner() if engine == "python" else DotnetRunner()
+        elif not isinstance(runner, AppHostRunner):
+            raise TypeError("runner must have a run(app) method, see AppHostRunner.")
+        return runner.run(self)
+
+    @asynccontextmanager
+    async def start(
+            self,
+            runner: ProcessRunner | None = None,
+            *,
+            engine: Literal["python"] = "python") -> AsyncIterator[RunningApplication]:
+        '''Starts the resources as local processes, which run until the ``async with`` block ends.
+
+        This runs the application like ``run(engine="python")``, by ``runner`` or a default
+        ``ProcessRunner``, without blocking the event loop::
+
+            async with app.start() as running:
+                await running.wait_until_healthy()
+                print(running.metrics_url)
+        '''
+        if engine != "python":
+            raise ValueError(f"Invalid engine '{engine}', only 'python' can be started without blocking.")
+        running = RunningApplication(self, (runner or ProcessRunner()).supervisor(self))
+        await running._start()
+        try:
+            yield running
+        finally:
+            await running.stop()
+
+
+class BuilderModule:
+    '''A namespaced part of a builder, typically owned by one team.
+
+    The ``add_*`` methods of a module prefix the resource name with ``<prefix>-``. When the module is
+    created with a ``contribute`` function, that function is only called to add the resources of the
+    module once one of them is looked up with ``resource()``, or when the module is selected by a build.
+    '''
+
+    def __init__(
+            self,
+            builder: DistributedApplicationBuilder,
+            prefix: str,
+            contribute: Callable[[BuilderModule], None] | None = None) -> None:
+        self.prefix = prefix
+        self._parent = builder
+        self._contribute = contribute
+        self._owners: list[str] = []
+
+    @property
+    def materialized(self) -> bool:
+        return self._contribute is None
+
+    def materialize(self) -> Self:
+        '''Adds the resources of the module to the builder, if that has not happened yet.'''
+        if contribute := self._contribute:
+            self._contribute = None
+            writer = self._parent._builder
+            start = len(writer.owners())
+            contribute(self)
+            self._owners.extend(owner for owner in writer.owners()[start:] if owner not in self._owners)
+        return self
+
+    def owners(self) -> list[str]:
+        '''Returns the variables of the resources added by the module.'''
+        return list(self._owners)
+
+    def resource(self, name: str, /) -> Resource:
+        '''Returns a resource of the module by its name without the prefix, adding the module if needed.'''
+        self.materialize()
+        var_name = _valid_var_name(f"{self.prefix}-{name}")
+        if var_name not in self._owners:
+            raise ValueError(f"Unknown resource '{name}' in module '{self.prefix}'.")
+        return self._parent._builder.resources[var_name]
+
+    def module(self, prefix: str, contribute: Callable[[BuilderModule], None] | None = None, /) -> BuilderModule:
+        return self._parent.module(f"{self.prefix}-{prefix}", contribute)
+
+    def __getattr__(self, attr: str) -> Any:
+        if not attr.startswith("add_"):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attr}'")
+        add = getattr(self._parent, attr)
+
+        @wraps(add)
+        def add_namespaced(name: str, /, *args: Any, **kwargs: Any) -> Any:
+            if not isinstance(name, str):
+                raise TypeError("No matching overload found.")
+            result = add(f"{self.prefix}-{name}", *args, **kwargs)
+            if result.name not in self._owners:
+                self._owners.append(result.name)
+            return result
+        return add_namespaced
+
+
+class BuilderStats:
+    '''Call counts and timings recorded by the writer of an instrumented builder.
+
+    ``calls`` maps each apphost method, and ``build``, to its call count and cumulative time. The time of
+    a call is measured from the previous statement to the end of its own, so it includes the validation
+    and formatting of its arguments, and whatever the script does in between. ``phases`` splits that time
+    into generation, before the statement is written, and emission, which is the time spent writing it.
+    When memory tracing is enabled, ``memory`` holds the bytes allocated by the last ``build()``.
+    '''
+
+    def __init__(self, *, trace_memory: bool = False) -> None:
+        self.trace_memory = trace_memory
+        self.calls: dict[str, list] = {}
+        self.phases: dict[str, float] = dict.fromkeys(("generation", "emission"), 0.0)
+        self.memory: dict[str, int] = {}
+        self._written = perf_counter()
+
+    def record(self, name: str, elapsed: float) -> None:
+        if (call := self.calls.get(name)) is None:
+            self.calls[name] = [1, elapsed]
+        else:
+            call[0] += 1
+            call[1] += elapsed
+
+    def record_write(self, method: str | None, start: float) -> None:
+        '''Records a statement whose writing started at ``start``, which is a call of ``method`` unless it is None.'''
+        written = perf_counter()
+        self.phases["generation"] += start - self._written
+        self.phases["emission"] += written - start
+        if method is not None:
+            self.record(method, written - self._written)
+        self._written = written
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "calls": {name: {"count": count, "seconds": seconds} for name, (count, seconds) in self.calls.items()},
+            "phases": dict(self.phases),
+            "memory": dict(self.memory),
+        }
+
+    def report(self) -> str:
+        width = max((len(name) for name in (*self.calls, *self.phases)), default=0)
+        lines = [f"{'Method':<{width}}  {'Calls':>8}  {'Total ms':>10}"]
+        for name, (count, seconds) in sorted(self.calls.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<{width}}  {count:>8}  {seconds * 1000:>10.2f}")
+        lines.append("")
+        lines.append(f"{'Phase':<{width}}  {'':>8}  {'Total ms':>10}")
+        for phase, seconds in self.phases.items():
+            lines.append(f"{phase:<{width}}  {'':>8}  {seconds * 1000:>10.2f}")
+        if self.memory:
+            lines.append("")
+            lines.append(
+                f"build() allocated {self.memory['allocated'] / 1024:.1f} KiB, "
+                f"peak {self.memory['peak'] / 1024:.1f} KiB")
+        return "\n".join(lines)
+
+
+@dataclass(frozen=True)
+class MethodCall:
+    '''A call of an apphost method written by the builder, as seen by hooks and middleware.
+
+    ``target`` is the variable the method is called on, ``builder`` or that of a resource, and ``args``
+    maps the name of each argument to its value, structured as in ``topology.json``. A call that adds a
+    resource has the variable of the new resource in ``assign``.
+    '''
+    target: str
+    method: str
+    args: Mapping[str, Any]
+    assign: str | None = None
+
+
+class _Hooks:
+    def __init__(self) -> None:
+        self.resource_added: list[Callable[[Resource], None]] = []
+        self.method_call: list[Callable[[MethodCall], None]] = []
+        self.before_build: list[Callable[[DistributedApplicationBuilder], None]] = []
+        self.middleware: list[Callable[[MethodCall, Callable[[MethodCall], None]], None]] = []
+
+
+@contextmanager
+def _recorded_build(stats: BuilderStats | None):
+    if stats is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        with _traced_memory(stats):
+            yield
+    finally:
+        stats.record("build", perf_counter() - start)
+        # The build is not part of the generation time of the next call.
+        stats._written = perf_counter()
+
+
+@contextmanager
+def _traced_memory(stats: BuilderStats):
+    if not stats.trace_memory:
+        yield
+        return
+    import tracemalloc
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    try:
+        yield
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        stats.memory = {"allocated": current - before, "peak": peak - before}
+        if started:
+            tracemalloc.stop()
+
+
+class DistributedApplicationBuilder:
+    def __init__(
+            self,
+            *args,
+            payload_threshold: int | None = None,
+            port_planner: PortPlanner | None = None,
+            instrument: bool | None = None,
+            trace_memory: bool = False) -> None:
+        self._dependencies = []
+        self._placeholders: dict[str, Placeholder] = {}
+        self._modules: dict[str, BuilderModule] = {}
+        self._builder = _ApphostWriter(payload_threshold=payload_threshold, port_planner=port_planner)
+        if instrument is None:
+            instrument = os.environ.get("ASPYRE_INSTRUMENT") in ("1", "memory")
+            trace_memory = trace_memory or os.environ.get("ASPYRE_INSTRUMENT") == "memory"
+        if instrument:
+            self._builder.stats = BuilderStats(trace_memory=trace_memory)
+        self._builder.write(_APPHOST_HEADER)
+
+    def _hooks(self) -> _Hooks:
+        if self._builder.hooks is None:
+            self._builder.hooks = _Hooks()
+        return self._builder.hooks
+
+    def on_resource_added(self, callback: Callable[[Resource], None], /) -> Callable[[Resource], None]:
+        '''Registers a function called with every resource once it has been added, including child resources.'''
+        self._hooks().resource_added.append(callback)
+        return callback
+
+    def on_method_call(self, callback: Callable[[MethodCall], None], /) -> Callable[[MethodCall], None]:
+        '''Registers a function called with every apphost call the builder writes, before it is written.'''
+        self._hooks().method_call.append(callback)
+        return callback
+
+    def before_build(
+            self,
+            callback: Callable[[DistributedApplicationBuilder], None],
+            /) -> Callable[[DistributedApplicationBuilder], None]:
+        '''Registers a function called with the builder before it is built, sharded or frozen.'''
+        self._hooks().before_build.append(callback)
+        return callback
+
+    def use(
+            self,
+            middleware: Callable[[MethodCall, Callable[[MethodCall], None]], None],
+            /) -> Callable[[MethodCall, Callable[[MethodCall], None]], None]:
+        '''Adds a middleware around every apphost call the builder writes.
+
+        The middleware is called with the call and a function that writes a call. It can rewrite the call
+        with ``dataclasses.replace()``, skip it by not proceeding, or proceed with more calls on the same
+        or other resources, which are chained to the resource being added when they target it. Calls that
+        add a resource must proceed, and cannot be made by middleware. Middleware added first is the outermost.
+        '''
+        self._hooks().middleware.append(middleware)
+        return middleware
+
+    def _run_before_build(self) -> None:
+        if self._builder.hooks is not None:
+            for callback in self._builder.hooks.before_build:
+                callback(self)
+
+    def stats(self) -> BuilderStats:
+        '''Returns the call counts and timings recorded since the builder was created with ``instrument=True``.'''
+        if self._builder.stats is None:
+            raise ValueError("The builder is not instrumented, create it with instrument=True.")
+        return self._builder.stats
+
+    def to_json(self) -> str:
+        '''Serializes the topology, with every resource, option and call, so that it can be restored by ``from_json()``.
+
+        All modules are added first, as for a full build. ``resources`` maps the name of every resource to
+        its type. ``writer`` holds every call in the order it was written, structured as in ``topology.json``
+        with the planned ports and placeholders left open, which is what ``from_json()`` restores.
+        '''
+        self._materialize(None)
+        writer = self._builder
+        return json.dumps({
+            "schema": _BUILDER_SCHEMA,
+            "version": __VERSION__,
+            "packages": self._dependencies,
+            "placeholders": [placeholder.to_dict() for placeholder in self._placeholders.values()],
+            "resources": {name: {"type": type(resource).__name__} for name, resource in writer.resources.items()},
+            "writer": writer.to_dict(),
+        })
+
+    @classmethod
+    def from_json(cls, data: str | bytes) -> DistributedApplicationBuilder:
+        '''Restores a builder serialized by ``to_json()``, which can then be built or extended as usual.'''
+        state = json.loads(data)
+        if state.get("schema") != _BUILDER_SCHEMA or state.get("version") != __VERSION__:
+            raise ValueError(
+                f"Unsupported builder state (schema {state.get('schema')}, version {state.get('version')}), "
+                f"expected schema {_BUILDER_SCHEMA} and version {__VERSION__}.")
+        builder = cls.__new__(cls)
+        builder._dependencies = list(state["packages"])
+        builder._placeholders = {}
+        for index, placeholder in enumerate(state["placeholders"]):
+            builder._placeholders[placeholder["name"]] = Placeholder.from_dict(placeholder, index)
+        builder._modules = {}
+        builder._builder = _ApphostWriter.from_dict(
+            state["writer"], {name: resource["type"] for name, resource in state["resources"].items()})
+        return builder
+
+    def _add_resource(self, resource: Resource) -> None:
+        self._dependencies.append(resource.package)
+
+    def _closure(self, names: Iterable[str]) -> set[str]:
+        '''Returns the variables of the given resources and of everything they transitively refer to.'''
+        known = set(self._builder.owners())
+        pending = []
+        for name in names:
+            if modules := [module for prefix, module in self._modules.items() if _in_namespace(name, prefix)]:
+                for module in modules:
+                    pending.extend(module.owners())
+                continue
+            var_name = _valid_var_name(name)
+            if var_name not in known:
+                raise ValueError(f"Unknown resource '{name}'.")
+            pending.append(var_name)
+        closure: set[str] = set()
+        while pending:
+            var_name = pending.pop()
+            if var_name not in closure:
+                closure.add(var_name)
+                pending.extend(self._builder.references(var_name) - closure)
+        return closure
+
+    def _render(self, only: Iterable[str] | None) -> tuple[str, list[dict[str, Any]], list[str], Mapping[str, Any]]:
+        if only is not None:
+            only = list(only)
+        self._materialize(only)
+        if only is None:
+            return self._builder.render(), self._builder.topology(), self._dependencies, self._builder.payloads
+        # Only the selected resources and whatever they depend on are rendered, so the cost
+        # is proportional to the size of the closure rather than to the whole topology.
+        closure = self._closure(only)
+        source = self._builder.render(closure)
+        calls = self._builder.topology(closure)
+        packages = [self._builder.resources[var_name].package for var_name in closure]
+        payloads = {
+            key: value for key, value in self._builder.payloads.items() if key.partition(".")[0] in closure
+        }
+        return source, calls, packages, payloads
+
+    def build(
+            self,
+            *,
+            output_dir: str | None = None,
+            data_driven: bool = False,
+            only: Iterable[str] | None = None,
+            track_changes: bool | None = None,
+            lint: Literal["warn", "error"] | None = None) -> DistributedApplication:
+        if track_changes is None:
+            track_changes = os.environ.get("ASPYRE_TRACK_CHANGES") == "1"
+        self._run_before_build()
         if output_dir:
             output_path = Path(output_dir)
-            output_path.mkdir(parents=True, exist_ok=True)
-            with open(output_path / "apphost.cs", "w", encoding="utf-8") as f:
-                f.write(csharp)
         else:
-            cwd = Path.cwd()
-            output_path = cwd / ".aspire" / "aspyre_apphost"
-            output_path.mkdir(parents=True, exist_ok=True)
-            with open(output_path / "apphost.cs", "w", encoding="utf-8") as f:
-                f.write(csharp)
-        return DistributedApplication(apphost_path=output_path / "apphost.cs")
+            output_path = Path.cwd() / ".aspire" / "aspyre_apphost"
+        with _recorded_build(self._builder.stats):
+            source, calls, packages, payloads = self._render(only)
+            if lint is not None:
+                _report_findings(lint_state(_topology_state(calls)), lint)
+            _write_apphost(output_path, source, calls, packages, payloads, data_driven=data_driven)
+        changes = None
+        if track_changes:
+            # The state of the previous build is kept next to the apphost, so that the changes
+            # can be reported and only the affected resources need to be restarted.
+            state = _topology_state(calls)
+            state_path = output_path / _STATE_FILE
+            previous = {}
+            if state_path.exists():
+                with open(state_path, "r", encoding="utf-8") as f:
+                    previous = json.load(f)
+            changes = diff(previous, state)
+            if changes:
+                print(changes)
+            with open(state_path, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=2)
+                f.write("\n")
+        return DistributedApplication(
+            apphost_path=output_path / "apphost.cs",
+            changes=changes,
+            calls=calls,
+            restart_policies=self._builder.restart_policies)
+
+    def lint(self, rules: Iterable[LintRule] | None = None, *, only: Iterable[str] | None = None) -> list[LintFinding]:
+        '''Runs performance rules, by default ``LINT_RULES``, over the topology and returns what they found.'''
+        return lint_state(self.state(only=only), rules)
+
+    def graph(self) -> dict[str, list[str]]:
+        '''Returns the names of the resources each resource refers to, in declaration order.'''
+        self._materialize(None)
+        writer = self._builder
+        return {
+            owner.replace("_", "-"): sorted(
+                reference.replace("_", "-") for reference in writer.references(owner) if reference in writer.resources)
+            for owner in writer.owners()
+        }
+
+    def state(self, *, only: Iterable[str] | None = None) -> dict[str, Any]:
+        '''Returns the structure of the topology, with the properties of every resource, for ``diff()``.'''
+        _, calls, _, _ = self._render(only)
+        return _topology_state(calls)
+
+    def _materialize(self, names: list[str] | None) -> None:
+        '''Adds the modules that contain or are one of the selected names, or all modules.'''
+        pending = True
+        while pending:
+            # Adding a module can declare nested modules, which are matched on the next pass.
+            pending = False
+            for prefix, module in list(self._modules.items()):
+                if module.materialized:
+                    continue
+                if names is None or any(_in_namespace(prefix, name) or _in_namespace(name, prefix) for name in names):
+                    module.materialize()
+                    pending = True
+
+    def _assign_shards(self, partition_fn: Callable[[str], str | None]) -> dict[str, str | None]:
+        '''Maps the variable of every resource to its shard, or to ``None`` for a shared resource.'''
+        writer = self._builder
+        units: dict[str, str] = {}
+        for owner in writer.owners():
+            calls = writer.calls(owner)
+            target = calls[0]["target"] if calls and "assign" in calls[0] else "builder"
+            units[owner] = units.get(target, owner)
+        shared = {
+            owner for owner, unit in units.items()
+            if owner == unit and isinstance(writer.resources[owner], (ParameterResource, ConnectionStringResource))
+        }
+        adjacency: dict[str, dict[str, int]] = {unit: {} for unit in units.values() if unit not in shared}
+        for owner, unit in units.items():
+            for reference in writer.references(owner):
+                other = units.get(reference)
+                if unit in shared or other in shared or other is None or other == unit:
+                    continue
+                adjacency[unit][other] = adjacency[unit].get(other, 0) + 1
+                adjacency[other][unit] = adjacency[other].get(unit, 0) + 1
+        shards: dict[str, str] = {}
+        free = []
+        for unit in adjacency:
+            name = unit.replace("_", "-")
+            shard = partition_fn(name)
+            if shard is None:
+                free.append(unit)
+            elif not isinstance(shard, str):
+                raise TypeError(f"Invalid shard {shard!r} for resource '{name}'.")
+            elif not _VALID_NAME.match(shard):
+                raise ValueError(f"Invalid shard '{shard}' for resource '{name}'. Only alphanumeric characters and hyphens are allowed.")
+            else:
+                shards[unit] = shard
+        fallback = min(shards.values(), default="default")
+        # Resources without a shard are moved to the shard most of their neighbours are in until
+        # nothing changes, which greedily minimizes the number of cross-shard references.
+        for _ in range(8):
+            changed = False
+            for unit in free:
+                counts: dict[str, int] = {}
+                for neighbour, weight in adjacency[unit].items():
+                    if neighbour in shards:
+                        counts[shards[neighbour]] = counts.get(shards[neighbour], 0) + weight
+                shard = min(counts, key=lambda key: (-counts[key], key)) if counts else shards.get(unit, fallback)
+                if shards.get(unit) != shard:
+                    shards[unit] = shard
+                    changed = True
+            if not changed:
+                break
+        return {owner: None if unit in shared else shards[unit] for owner, unit in units.items()}
+
+    def build_sharded(
+            self,
+            partition_fn: Callable[[str], str | None],
+            output_dir: str | Path,
+            *,
+            data_driven: bool = False,
+            max_workers: int | None = None) -> dict[str, DistributedApplication]:
+        '''Splits the topology into one apphost per shard, each written to ``<output_dir>/<shard>``.
+
+        ``partition_fn`` is called with the name of every resource and returns its shard, or ``None`` to place
+        the resource in the shard it has the most references to. Child resources, such as databases, always
+        stay with their parent. Parameters and connection strings are copied into every shard that uses them.
+        A reference to a resource of another shard is replaced by a connection string, or by an external
+        service whose URL is read from a ``<name>-url`` parameter. Such a reference can only be waited for,
+        related to or referenced; other uses, such as ``wait_for_completion``, raise a ValueError.
+        '''
+        self._run_before_build()
+        self._materialize(None)
+        writer = self._builder
+        assignment = self._assign_shards(partition_fn)
+        members: dict[str, set[str]] = {}
+        for owner, shard in assignment.items():
+            if shard is not None:
+                members.setdefault(shard, set()).add(owner)
+        jobs = []
+        for shard, owners in sorted(members.items()):
+            selected = set(owners)
+            stubs = DistributedApplicationBuilder()
+            remote = []
+            pending = [reference for owner in owners for reference in writer.references(owner)]
+            while pending:
+                reference = pending.pop()
+                if reference in selected or reference not in assignment:
+                    continue
+                selected.add(reference)
+                if assignment[reference] is None:
+                    pending.extend(writer.references(reference))
+                else:
+                    remote.append(reference)
+            external = []
+            kinds = {
+                reference: "connection" if isinstance(writer.resources[reference], ResourceWithConnectionString) else "external"
+                for reference in remote}
+            for owner in sorted(selected.difference(remote)):
+                for call in writer.calls(owner):
+                    for argument, value in call["args"].items():
+                        for reference in _resource_references(value).intersection(remote):
+                            if (call["method"], argument) not in _SHARD_STUB_USES[kinds[reference]]:
+                                raise ValueError(
+                                    f"Cannot refer to resource '{reference.replace('_', '-')}' across shards with "
+                                    f"{call['method']}({argument}), place '{owner.replace('_', '-')}' in the same shard.")
+            for reference in sorted(remote):
+                name = reference.replace("_", "-")
+                if kinds[reference] == "connection":
+                    stubs.add_connection_string(name)
+                elif f"{reference}_url" in writer.resources:
+                    raise ValueError(f"Cannot refer to resource '{name}' across shards, '{name}-url' is already a resource.")
+                else:
+                    stubs.add_external_service(name, stubs.add_parameter(f"{name}-url"))
+                    external.append(reference)
+            local = selected.difference(remote)
+            rewrite = partial(_reference_external_services, set(external))
+            header, _, body = writer.render(local, rewrite).partition("\n")
+            source = header + "\n" + stubs._builder.getvalue().partition("\n")[2] + body
+            calls = stubs._builder.topology() + writer.topology(local, rewrite) if data_driven else None
+            packages = [writer.resources[owner].package for owner in local] + stubs._dependencies
+            payloads = {key: value for key, value in writer.payloads.items() if key.partition(".")[0] in local}
+            jobs.append((Path(output_dir) / shard, source, calls, tuple(packages), payloads, data_driven))
+        if max_workers == 1 or len(jobs) < 2:
+            paths = [_write_shard(job) for job in jobs]
+        else:
+            with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                paths = list(executor.map(_write_shard, jobs))
+        return {shard: DistributedApplication(apphost_path=path) for shard, path in zip(sorted(members), paths)}
+
+    def module(self, prefix: str, contribute: Callable[[BuilderModule], None] | None = None, /) -> BuilderModule:
+        '''Creates a sub-builder whose resource names are prefixed with ``<prefix>-``.
+
+        When ``contribute`` is given, it is called with the module the first time one of its resources is
+        looked up or the module is selected by a build, so modules that are never used cost nothing.
+        A full build, a sharded build or a freeze selects every module.
+        '''
+        _valid_var_name(prefix)
+        if prefix in self._modules:
+            raise ValueError(f"Module '{prefix}' is already declared.")
+        module = BuilderModule(self, prefix, contribute)
+        self._modules[prefix] = module
+        return module
+
+    def resource(self, name: str, /) -> Resource:
+        '''Returns a resource that was added to the builder by its name.'''
+        var_name = _valid_var_name(name)
+        if var_name not in self._builder.resources:
+            raise ValueError(f"Unknown resource '{name}'.")
+        return self._builder.resources[var_name]
+
+    def placeholder(self, name: str, value_type: type, /, *, default: Any = None) -> Any:
+        '''Declares a named value to be supplied when the frozen plan is rendered.'''
+        if name in self._placeholders:
+            raise ValueError(f"Placeholder '{name}' is already declared.")
+        placeholder = Placeholder(name, value_type, len(self._placeholders), default)
+        self._placeholders[name] = placeholder
+        return placeholder
+
+    def freeze(self, *, data_driven: bool = False) -> BuilderPlan:
+        '''Freezes the current topology into a plan that can be rendered with different placeholder values.'''
+        self._run_before_build()
+        self._materialize(None)
+        return BuilderPlan(
+            source=self._builder.render(),
+            packages=tuple(sorted(set(self._dependencies))),
+            payloads=dict(self._builder.payloads),
+            placeholders=tuple(self._placeholders.values()),
+            data_driven=data_driven,
+            calls=tuple(self._builder.topology()) if data_driven else (),
+        )
+
+    def planned_ports(self) -> dict[str, int]:
+        '''Returns the host port of every endpoint keyed by ``<resource>/<endpoint>``, when a port planner is set.'''
+        if self._builder.port_planner is None:
+            return {}
+        self._materialize(None)
+        return self._builder.port_planner.resolve()
 
     def add_connection_string(self, name: str, /, *, env_var_name: str | None = None, **kwargs: Unpack[ConnectionStringResourceOptions]) -> ResourceWithConnectionString:
         with _check_warnings(self._builder, kwargs, ConnectionStringResourceOptions, "add_connection_string"):
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddConnectionString(name: {_format_string(name, None)}, environmentVariableName: {_format_string(env_var_name, None)})')
             result = ConnectionStringResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     @overload
@@ -3433,7 +7229,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddContainer(name: {_format_string(name, None)}, image: {_format_string(image, None)})')
                 result = ContainerResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         if _validate_tuple_types(args, (str, str, str,)):
             with _check_warnings(self._builder, kwargs, ContainerResourceOptions, "add_container"):
@@ -3441,7 +7237,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddContainer(name: {_format_string(name, None)}, image: {_format_string(image, None)}, tag: {_format_string(tag, None)})')
                 result = ContainerResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         raise TypeError("No matching overload found.")
 
@@ -3450,15 +7246,15 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddDockerfile(name: {_format_string(name, None)}, contextPath: {_format_string(context_path, None)}, dockerfilePath: {_format_string(dockerfile_path, None)}, stage: {_format_string(stage, None)})')
             result = ContainerResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_executable(self, name: str, command: str, working_dir: str, args: Iterable[str] | None, /, **kwargs: Unpack[ExecutableResourceOptions]) -> ExecutableResource:
         with _check_warnings(self._builder, kwargs, ExecutableResourceOptions, "add_executable"):
             var_name = _valid_var_name(name)
-            self._builder.write(f'\nvar {var_name} = builder.AddExecutable(name: {_format_string(name, None)}, command: {_format_string(command, None)}, workingDirectory: {_format_string(working_dir, None)}, args: {_format_string_array(args)})')
+            self._builder.write(f'\nvar {var_name} = builder.AddExecutable(name: {_format_string(name, None)}, command: {_format_string(command, None)}, workingDirectory: {_format_string(working_dir, None)}, args: {_format_args(self._builder, var_name, args)})')
             result = ExecutableResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     @overload
@@ -3474,7 +7270,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddExternalService(name: {_format_string(name, None)}, url: {_format_string(url, None)})')
                 result = ExternalServiceResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         if _validate_tuple_types(args, (str, ParameterResource,)):
             with _check_warnings(self._builder, kwargs, ExternalServiceResourceOptions, "add_external_service"):
@@ -3482,7 +7278,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddExternalService(name: {_format_string(name, None)}, urlParameter: {url_parameter.name})')
                 result = ExternalServiceResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         raise TypeError("No matching overload found.")
 
@@ -3500,7 +7296,7 @@ class DistributedApplicationBuilder:
                 secret = kwargs.pop("secret", None)
                 self._builder.write(f'\nvar {var_name} = builder.AddParameter(name: {_format_string(name, None)}, secret: {_format_bool(secret, False)})')
                 result = ParameterResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         if _validate_tuple_types(args, (str, str,)):
             with _check_warnings(self._builder, kwargs, ParameterResourceOptions, "add_parameter"):
@@ -3510,7 +7306,7 @@ class DistributedApplicationBuilder:
                 secret = kwargs.pop("secret", None)
                 self._builder.write(f'\nvar {var_name} = builder.AddParameter(name: {_format_string(name, None)}, value: {_format_string(value, None)}, publishValueAsDefault: {_format_bool(publish_value_as_default, False)}, secret: {_format_bool(secret, False)})')
                 result = ParameterResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         raise TypeError("No matching overload found.")
 
@@ -3519,7 +7315,7 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddParameterFromConfiguration(name: {_format_string(name, None)}, configurationKey: {_format_string(config_key, None)}, secret: {_format_bool(secret, False)})')
             result = ParameterResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     @overload
@@ -3535,7 +7331,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddProject(name: {_format_string(name, None)}, projectPath: {_format_string(project_path, None)})')
                 result = ProjectResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         if _validate_tuple_types(args, (str, str, str,)):
             with _check_warnings(self._builder, kwargs, ProjectResourceOptions, "add_project"):
@@ -3543,7 +7339,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddProject(name: {_format_string(name, None)}, projectPath: {_format_string(project_path, None)}, launchProfileName: {_format_string(launch_profile_name, None)})')
                 result = ProjectResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
         raise TypeError("No matching overload found.")
 
@@ -3553,7 +7349,7 @@ class DistributedApplicationBuilder:
                 var_name = _valid_var_name(name)
                 self._builder.write(f'\nvar {var_name} = builder.AddCSharpApp(name: {_format_string(name, None)}, path: {_format_string(path, None)})')
                 result = ProjectResource(var_name, self._builder, **kwargs)
-                self._dependencies.append(result.package)
+                self._add_resource(result)
                 return result
 
     def add_certificate_authority_collection(self, name: str, /, **kwargs: Unpack[CertificateAuthorityCollectionOptions]) -> CertificateAuthorityCollection:
@@ -3561,15 +7357,15 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddCertificateAuthorityCollection(name: {_format_string(name, None)})')
             result = CertificateAuthorityCollection(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_postgres(self, name: str, /, *, port: int | None = None, **kwargs: Unpack[PostgresServerResourceOptions]) -> PostgresServerResource:
         with _check_warnings(self._builder, kwargs, PostgresServerResourceOptions, "add_postgres"):
             var_name = _valid_var_name(name)
-            self._builder.write(f'\nvar {var_name} = builder.AddPostgres(name: {_format_string(name, None)}, port: {_format_value(port, None)})')
+            self._builder.write(f'\nvar {var_name} = builder.AddPostgres(name: {_format_string(name, None)}, port: {_format_port(self._builder, var_name, "tcp", port)})')
             result = PostgresServerResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_python_app(self, name: str, app_dir: str, script_path: str, /, **kwargs: Unpack[PythonAppResourceOptions]) -> PythonAppResource:
@@ -3577,7 +7373,7 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddPythonApp(name: {_format_string(name, None)}, appDirectory: {_format_string(app_dir, None)}, scriptPath: {_format_string(script_path, None)})')
             result = PythonAppResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_python_module(self, name: str, app_dir: str, module_name: str, /, **kwargs: Unpack[PythonAppResourceOptions]) -> PythonAppResource:
@@ -3585,7 +7381,7 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddPythonModule(name: {_format_string(name, None)}, appDirectory: {_format_string(app_dir, None)}, moduleName: {_format_string(module_name, None)})')
             result = PythonAppResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_python_executable(self, name: str, app_dir: str, executable_name: str, /, **kwargs: Unpack[PythonAppResourceOptions]) -> PythonAppResource:
@@ -3593,7 +7389,7 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddPythonExecutable(name: {_format_string(name, None)}, appDirectory: {_format_string(app_dir, None)}, executableName: {_format_string(executable_name, None)})')
             result = PythonAppResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_uvicorn_app(self, name: str, app_dir: str, app: str, /, **kwargs: Unpack[UvicornAppResourceOptions]) -> UvicornAppResource:
@@ -3601,17 +7397,406 @@ class DistributedApplicationBuilder:
             var_name = _valid_var_name(name)
             self._builder.write(f'\nvar {var_name} = builder.AddUvicornApp(name: {_format_string(name, None)}, appDirectory: {_format_string(app_dir, None)}, app: {_format_string(app, None)})')
             result = UvicornAppResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
     def add_redis(self, name: str, /, *, port: int | None = None, **kwargs: Unpack[RedisResourceOptions]) -> RedisResource:
         with _check_warnings(self._builder, kwargs, RedisResourceOptions, "add_redis"):
             var_name = _valid_var_name(name)
-            self._builder.write(f'\nvar {var_name} = builder.AddRedis(name: {_format_string(name, None)}, port: {_format_value(port, None)})')
+            self._builder.write(f'\nvar {var_name} = builder.AddRedis(name: {_format_string(name, None)}, port: {_format_port(self._builder, var_name, "tcp", port)})')
             result = RedisResource(var_name, self._builder, **kwargs)
-            self._dependencies.append(result.package)
+            self._add_resource(result)
             return result
 
 
-def build_distributed_application(*args) -> DistributedApplicationBuilder:
-    return DistributedApplicationBuilder(*args)
+def diff(
+        old_state: Mapping[str, Any] | DistributedApplicationBuilder,
+        new_state: Mapping[str, Any] | DistributedApplicationBuilder) -> TopologyDiff:
+    '''Compares two topology states, as returned by ``DistributedApplicationBuilder.state()``, or two builders.'''
+    if isinstance(old_state, DistributedApplicationBuilder):
+        old_state = old_state.state()
+    if isinstance(new_state, DistributedApplicationBuilder):
+        new_state = new_state.state()
+    old = old_state.get("resources", {})
+    new = new_state.get("resources", {})
+    modified = {}
+    for name in sorted(old.keys() & new.keys()):
+        before, after = old[name], new[name]
+        if changed := tuple(sorted(key for key in before.keys() | after.keys() if before.get(key) != after.get(key))):
+            modified[name] = changed
+    return TopologyDiff(
+        added=tuple(sorted(new.keys() - old.keys())),
+        removed=tuple(sorted(old.keys() - new.keys())),
+        modified=modified,
+    )
+
+
+def build_distributed_application(
+        *args,
+        payload_threshold: int | None = None,
+        port_planner: PortPlanner | None = None,
+        instrument: bool | None = None,
+        trace_memory: bool = False) -> DistributedApplicationBuilder:
+    return DistributedApplicationBuilder(
+        *args,
+        payload_threshold=payload_threshold,
+        port_planner=port_planner,
+        instrument=instrument,
+        trace_memory=trace_memory)
+
+
+def _snapshot(paths: Iterable[Path]) -> dict[Path, int]:
+    '''Returns the modification time of each of the given files, and of the Python files under the given directories.'''
+    snapshot = {}
+    for path in paths:
+        for file in (path.rglob("*.py") if path.is_dir() else (path,)):
+            try:
+                snapshot[file] = file.stat().st_mtime_ns
+            except FileNotFoundError:
+                pass
+    return snapshot
+
+
+def watch(
+        script: str | Path,
+        /,
+        *,
+        paths: Iterable[str | Path] = (),
+        interval: float = 0.5,
+        debounce: float = 0.2,
+        max_runs: int | None = None) -> None:
+    '''Runs a builder script, and runs it again whenever it or a Python file under ``paths`` changes.
+
+    Changes are detected by polling modification times. A run only starts once nothing has changed for
+    ``debounce`` seconds, so saving several files at once triggers a single run. The script runs in a new
+    interpreter with ``ASPYRE_TRACK_CHANGES=1``, so that ``build()`` prints the resources that changed.
+    '''
+    import subprocess
+
+    script = Path(script)
+    watched = [script, *(Path(path) for path in paths)]
+    env = dict(os.environ, ASPYRE_TRACK_CHANGES="1")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (str(Path(__file__).parent), env.get("PYTHONPATH"))))
+    runs = 0
+    while True:
+        snapshot = _snapshot(watched)
+        result = subprocess.run([sys.executable, str(script)], env=env, check=False)
+        runs += 1
+        print(f"Ran {script} (exit code {result.returncode}).", flush=True)
+        if max_runs is not None and runs >= max_runs:
+            return
+        while (current := _snapshot(watched)) == snapshot:
+            time.sleep(interval)
+        while True:
+            time.sleep(debounce)
+            if (latest := _snapshot(watched)) == current:
+                break
+            current = latest
+
+
+def _split_spec(spec: str) -> tuple[str, str]:
+    '''Splits a builder spec into the script or module, and the name of the builder in it.'''
+    location, _, name = spec.rpartition(":")
+    if not location or not _IDENTIFIER.match(name):
+        return spec, "builder"
+    return location, name
+
+
+def _is_script(location: str) -> bool:
+    return location.endswith(".py") or "/" in location or os.sep in location
+
+
+def build_script(
+        spec: str,
+        /,
+        *,
+        output_dir: str | None = None,
+        data_driven: bool = False,
+        only: Iterable[str] | None = None,
+        cache_dir: str | Path | None = None,
+        cache_max_bytes: int = 64 * 1024 * 1024) -> Path:
+    '''Runs a builder script or module, as the command line does, builds it and returns the apphost path.
+
+    With a ``cache_dir``, the generated files are cached in a ``GenerationCache``, keyed by the script,
+    the options, the library and the Python version. While the script and the modules it reaches through its
+    imports and globals are unchanged, a later build restores them without running the script. Modules of
+    the standard library and installed packages, environment variables and other inputs the script reads
+    are not part of the key.
+    '''
+    output_path = Path(output_dir) if output_dir else Path.cwd() / ".aspire" / "aspyre_apphost"
+    cache = None
+    if cache_dir is not None:
+        cache = GenerationCache(cache_dir, max_bytes=cache_max_bytes)
+        key = cache.key(spec, {"data_driven": data_driven, "only": sorted(only) if only else None})
+        if (files := cache.get(key)) is not None:
+            _write_apphost_files(output_path, files)
+            return output_path / "apphost.cs"
+    builder, namespace = _run_builder(spec)
+    app = builder.build(output_dir=str(output_path), data_driven=data_driven, only=only)
+    if cache is not None:
+        files = {}
+        for name in ("apphost.cs", _TOPOLOGY_FILE if data_driven else None, _PAYLOADS_FILE):
+            if name is not None and (output_path / name).exists():
+                files[name] = (output_path / name).read_text(encoding="utf-8")
+        location, _ = _split_spec(spec)
+        cache.put(key, files, _reached_modules(namespace, location if _is_script(location) else namespace.get("__file__")))
+    return app.apphost_path
+
+
+def _load_builder(spec: str, *, reload: bool = False) -> DistributedApplicationBuilder:
+    '''Runs a builder script or module and returns its builder.
+
+    ``spec`` is a path to a script or a module name, optionally followed by ``:name`` to name the builder,
+    or a function returning it, instead of the default ``builder``. Scripts run with ``__name__`` set to
+    ``"__aspyre__"``, so a ``build()`` guarded by ``if __name__ == "__main__"`` is skipped.
+    '''
+    return _run_builder(spec, reload=reload)[0]
+
+
+def _run_builder(spec: str, *, reload: bool = False) -> tuple[DistributedApplicationBuilder, Mapping[str, Any]]:
+    '''Runs a builder script or module as ``_load_builder()`` does, and returns its builder and its globals.'''
+    import importlib
+    import runpy
+
+    location, name = _split_spec(spec)
+    if _is_script(location):
+        namespace = runpy.run_path(location, run_name="__aspyre__")
+    else:
+        if os.getcwd() not in sys.path:
+            sys.path.insert(0, os.getcwd())
+        module = importlib.import_module(location)
+        namespace = vars(importlib.reload(module) if reload else module)
+    if name not in namespace:
+        raise ValueError(f"'{location}' does not define '{name}'.")
+    builder = namespace[name]
+    if callable(builder) and not isinstance(builder, DistributedApplicationBuilder):
+        builder = builder()
+    if not isinstance(builder, DistributedApplicationBuilder):
+        raise TypeError(f"'{spec}' is not a DistributedApplicationBuilder.")
+    return builder, namespace
+
+
+def _reached_modules(namespace: Mapping[str, Any], path: str | None) -> list[str]:
+    '''Returns the file of a script or module at ``path`` and of the modules it reaches, through its imports and globals.
+
+    The modules imported by the file, and the modules of its global values, are followed transitively. Modules of the standard library and of installed packages are left out, because their
+    versions are part of the cache key or are not expected to change between builds.
+    '''
+    import ast
+    import sysconfig
+    from importlib.util import resolve_name
+
+    excluded = tuple({
+        os.path.join(os.path.realpath(directory), "")
+        for directory in (sysconfig.get_path(name) for name in ("stdlib", "platstdlib", "purelib", "platlib")) if directory})
+    files = [path] if path is not None and os.path.isfile(path) else []
+    seen: set[str] = set()
+    pending: list[tuple[Mapping[str, Any], str | None]] = [(namespace, path)]
+    while pending:
+        namespace, path = pending.pop()
+        names = set()
+        for value in list(namespace.values()):
+            if isinstance(value, ModuleType):
+                names.add(value.__name__)
+                continue
+            try:
+                # Classes and functions, and instances through their class, name the module defining them.
+                module_name = getattr(value, "__module__", None)
+            except Exception:
+                continue
+            if isinstance(module_name, str):
+                names.add(module_name)
+        if path is not None and path.endswith(".py"):
+            try:
+                with open(path, "rb") as f:
+                    tree = ast.parse(f.read())
+            except (OSError, SyntaxError, ValueError):
+                tree = None
+            package = namespace.get("__package__") or ""
+            for node in ast.walk(tree) if tree is not None else ():
+                if isinstance(node, ast.Import):
+                    names.update(alias.name for alias in node.names)
+                elif isinstance(node, ast.ImportFrom):
+                    base = node.module or ""
+                    if node.level:
+                        try:
+                            base = resolve_name("." * node.level + base, package)
+                        except (ImportError, ValueError):
+                            continue
+                    names.add(base)
+                    names.update(f"{base}.{alias.name}" for alias in node.names)
+        for name in names:
+            module = sys.modules.get(name)
+            if module is None or name in seen:
+                continue
+            seen.add(name)
+            file = getattr(module, "__file__", None)
+            if not isinstance(file, str) or not os.path.isfile(file) or os.path.realpath(file).startswith(excluded):
+                continue
+            files.append(file)
+            pending.append((vars(module), file))
+    return sorted(set(files))
+
+
+def _load_state(spec: str) -> Mapping[str, Any]:
+    if spec.endswith(".json") and os.path.isfile(spec):
+        with open(spec, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return _load_builder(spec).state()
+
+
+def _bench(spec: str, repeat: int) -> None:
+    import statistics
+
+    timings: dict[str, list[float]] = {"load": [], "build": []}
+    with tempfile.TemporaryDirectory() as output_dir:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            builder = _load_builder(spec, reload=True)
+            loaded = time.perf_counter()
+            builder.build(output_dir=output_dir)
+            timings["load"].append(loaded - start)
+            timings["build"].append(time.perf_counter() - loaded)
+    for phase, values in timings.items():
+        print(
+            f"{phase}: min {min(values) * 1000:.2f} ms, median {statistics.median(values) * 1000:.2f} ms, "
+            f"max {max(values) * 1000:.2f} ms ({repeat} runs)")
+
+
+def _instrumented_build(spec: str, output_dir: str | None, *, trace_memory: bool = False) -> BuilderStats:
+    # Builders created by the script pick up instrumentation from the environment.
+    previous = os.environ.get("ASPYRE_INSTRUMENT")
+    os.environ["ASPYRE_INSTRUMENT"] = "memory" if trace_memory else "1"
+    try:
+        builder = _load_builder(spec)
+    finally:
+        if previous is None:
+            del os.environ["ASPYRE_INSTRUMENT"]
+        else:
+            os.environ["ASPYRE_INSTRUMENT"] = previous
+    with tempfile.TemporaryDirectory() as temp_dir:
+        builder.build(output_dir=output_dir or temp_dir)
+    return builder.stats()
+
+
+def _graph_dot(graph: Mapping[str, Iterable[str]]) -> str:
+    lines = ["digraph aspyre {"]
+    for name, references in graph.items():
+        lines.append(f"  {json.dumps(name)};")
+        lines.extend(f"  {json.dumps(name)} -> {json.dumps(reference)};" for reference in references)
+    lines.append("}")
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> int:
+    '''Runs the ``aspyre`` command line. Heavier modules are only imported by the command that needs them.'''
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="aspyre", description="Python AppHost for Aspire.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    spec_help = "A builder script or module, optionally followed by ':name' of the builder or a function returning it."
+
+    build_command = commands.add_parser("build", help="Generate the apphost of a builder.")
+    build_command.add_argument("spec", help=spec_help)
+    build_command.add_argument("-o", "--output-dir", help="The directory to write the apphost to.")
+    build_command.add_argument("--only", action="append", help="Only build this resource and its dependencies.")
+    build_command.add_argument("--data-driven", action="store_true", help="Generate a generic apphost and topology.json.")
+    build_command.add_argument("--cache-dir", help="A directory to cache generated files in, to skip running unchanged scripts.")
+    build_command.add_argument("--track-changes", action="store_true", default=None, help="Print the changed resources.")
+    build_command.add_argument("--lint", choices=("warn", "error"), help="Check the topology for performance problems.")
+
+    graph_command = commands.add_parser("graph", help="Print the resources and what they refer to.")
+    graph_command.add_argument("spec", help=spec_help)
+    graph_command.add_argument("--format", choices=("dot", "json"), default="dot")
+
+    manifest_command = commands.add_parser("manifest", help="Print the topology state of a builder as JSON.")
+    manifest_command.add_argument("spec", help=spec_help)
+    manifest_command.add_argument("--only", action="append", help="Only include this resource and its dependencies.")
+    manifest_command.add_argument("-o", "--output", help="The file to write the manifest to.")
+
+    bench_command = commands.add_parser("bench", help="Time loading and building a builder.")
+    bench_command.add_argument("spec", help=spec_help)
+    bench_command.add_argument("-n", "--repeat", type=int, default=10, help="The number of runs.")
+
+    stats_command = commands.add_parser("stats", help="Build a builder with instrumentation and report where time goes.")
+    stats_command.add_argument("spec", help=spec_help)
+    stats_command.add_argument("--format", choices=("text", "json"), default="text")
+    stats_command.add_argument("--memory", action="store_true", help="Also trace the memory allocated by build().")
+    stats_command.add_argument("-o", "--output-dir", help="The directory to write the apphost to.")
+
+    diff_command = commands.add_parser("diff", help="Print the changes between two builders or manifests; exits with 1 if there are any.")
+    diff_command.add_argument("old", help="A manifest JSON file, or a builder as for the other commands.")
+    diff_command.add_argument("new", help="A manifest JSON file, or a builder as for the other commands.")
+
+    run_command = commands.add_parser("run", help="Build a builder and run its apphost.")
+    run_command.add_argument("spec", help=spec_help)
+    run_command.add_argument("-o", "--output-dir", help="The directory to write the apphost to.")
+    run_command.add_argument("--command", dest="apphost_command", help="The command used instead of dotnet to build and run the apphost.")
+    run_command.add_argument("--engine", choices=("dotnet", "python"), default="dotnet", help="Run the apphost, or run executables and Python apps directly.")
+    run_command.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on this port; needs --engine python.")
+    run_command.add_argument("--trace", help="Write the startup timeline as Chrome trace JSON to this file; needs --engine python.")
+
+    watch_command = commands.add_parser("watch", help="Run a builder script again whenever it changes.")
+    watch_command.add_argument("script", help="The builder script to run.")
+    watch_command.add_argument("--path", action="append", default=[], help="Another file or directory to watch.")
+    watch_command.add_argument("--interval", type=float, default=0.5, help="Seconds between polls.")
+    watch_command.add_argument("--debounce", type=float, default=0.2, help="Seconds without changes before a run.")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        if args.cache_dir is not None and (args.track_changes or args.lint):
+            parser.error("--cache-dir cannot be combined with --track-changes or --lint")
+        if args.cache_dir is not None:
+            apphost_path = build_script(
+                args.spec, output_dir=args.output_dir, data_driven=args.data_driven, only=args.only, cache_dir=args.cache_dir)
+        else:
+            apphost_path = _load_builder(args.spec).build(
+                output_dir=args.output_dir,
+                data_driven=args.data_driven,
+                only=args.only,
+                track_changes=args.track_changes,
+                lint=args.lint).apphost_path
+        print(apphost_path)
+    elif args.command == "graph":
+        graph = _load_builder(args.spec).graph()
+        print(json.dumps(graph, indent=2) if args.format == "json" else _graph_dot(graph))
+    elif args.command == "manifest":
+        manifest = json.dumps(_load_builder(args.spec).state(only=args.only), indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                f.write(manifest + "\n")
+        else:
+            print(manifest)
+    elif args.command == "bench":
+        _bench(args.spec, args.repeat)
+    elif args.command == "stats":
+        stats = _instrumented_build(args.spec, args.output_dir, trace_memory=args.memory)
+        print(json.dumps(stats.to_dict(), indent=2) if args.format == "json" else stats.report())
+    elif args.command == "diff":
+        changes = diff(_load_state(args.old), _load_state(args.new))
+        print(changes)
+        return 1 if changes else 0
+    elif args.command == "run":
+        app = _load_builder(args.spec).build(output_dir=args.output_dir)
+        if args.engine != "python" and (args.metrics_port is not None or args.trace):
+            parser.error("--metrics-port and --trace need --engine python")
+        if args.engine != "python":
+            return app.run(DotnetRunner(args.apphost_command))
+        try:
+            return app.run(ProcessRunner(metrics_port=args.metrics_port))
+        finally:
+            if args.trace and app.timeline is not None:
+                with open(args.trace, "w", encoding="utf-8") as f:
+                    f.write(app.startup_trace_json())
+    elif args.command == "watch":
+        try:
+            watch(args.script, paths=args.path, interval=args.interval, debounce=args.debounce)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    # Builder scripts import ``aspyre``, which needs to resolve to this module rather than a second copy.
+    sys.modules.setdefault("aspyre", sys.modules[__name__])
+    raise SystemExit(main())
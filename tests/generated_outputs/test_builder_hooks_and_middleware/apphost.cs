@@ -0,0 +1,17 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting.PostgreSQL@13.0.1.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var pg = builder.AddPostgres(name: "pg", port: null);
+pg.WithLifetime(lifetime: ContainerLifetime.Persistent);
+var orders = pg.AddDatabase(name: "orders", databaseName: (string?)null);
+var api = builder.AddContainer(name: "api", image: "myorg/api")
+    .WithOtlpExporter();
+api.WithLifetime(lifetime: ContainerLifetime.Persistent);
+api.WithImagePullPolicy(pullPolicy: ImagePullPolicy.Missing);
+var deployment_id = builder.AddParameter(name: "deployment-id", secret: false);
+
+builder.Build().Run();
@@ -0,0 +1,14 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting.PostgreSQL@13.0.1.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var frontend = builder.AddContainer(name: "frontend", image: "myorg/frontend");
+var billing_db = builder.AddPostgres(name: "billing-db", port: null);
+var billing_api = builder.AddContainer(name: "billing-api", image: "myorg/billing")
+    .WaitFor(dependency: billing_db);
+frontend.WaitFor(dependency: billing_api);
+
+builder.Build().Run();
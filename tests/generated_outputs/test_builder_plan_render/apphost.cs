@@ -0,0 +1,13 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var api = builder.AddProject(name: "api", projectPath: "../api/api.csproj")
+    .WithReplicas(replicas: 8);
+var web = builder.AddContainer(name: "web", image: "myorg/web")
+    .WithImagePullPolicy(pullPolicy: ImagePullPolicy.Missing);
+web.WithEnvironment(name: "IMAGE", value: "myorg/web");
+
+builder.Build().Run();
@@ -0,0 +1,18 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+using System.Text.Json;
+
+var aspyrePayloads = JsonDocument.Parse(File.ReadAllText(Path.Combine(AspyreSourceDirectory(), "apphost.payloads.json"))).RootElement;
+string[] AspyrePayloadArgs(string key) => aspyrePayloads.GetProperty(key).EnumerateArray().Select(item => item.GetString()!).ToArray();
+string AspyrePayloadString(string key) => aspyrePayloads.GetProperty(key).GetString()!;
+static string AspyreSourceDirectory([System.Runtime.CompilerServices.CallerFilePath] string path = "") => Path.GetDirectoryName(path)!;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var mycontainer = builder.AddContainer(name: "mycontainer", image: "nginx")
+    .WithEnvironment(name: "LARGE_CONFIG", value: AspyrePayloadString("mycontainer.env.LARGE_CONFIG"))
+    .WithArgs(args: AspyrePayloadArgs("mycontainer.args"));
+mycontainer.WithEnvironment(name: "SMALL", value: "value");
+
+builder.Build().Run();
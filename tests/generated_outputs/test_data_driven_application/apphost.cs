@@ -0,0 +1,176 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting.PostgreSQL@13.0.1.0
+#:package Aspire.Hosting.Python@13.0.0.0
+#:package Aspire.Hosting.Redis@13.0.0.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Reflection;
+using System.Runtime.CompilerServices;
+using System.Security.Cryptography.X509Certificates;
+using System.Text.Json;
+
+// Generic apphost generated by aspyre. The resources are read from topology.json at startup,
+// so editing the topology does not require this file to be recompiled.
+var builder = DistributedApplication.CreateBuilder(args);
+using var topology = JsonDocument.Parse(File.ReadAllText(Path.Combine(AspyreSourceDirectory(), "topology.json")));
+var extensions = new[] { "Aspire.Hosting.PostgreSQL", "Aspire.Hosting.Python", "Aspire.Hosting.Redis", "Aspire.Hosting" }
+    .Select(Assembly.Load)
+    .SelectMany(assembly => assembly.GetExportedTypes())
+    .Where(type => type.IsAbstract && type.IsSealed)
+    .SelectMany(type => type.GetMethods(BindingFlags.Public | BindingFlags.Static))
+    .Where(method => method.IsDefined(typeof(ExtensionAttribute), false))
+    .ToLookup(method => method.Name);
+var variables = new Dictionary<string, object> { ["builder"] = builder };
+foreach (var call in topology.RootElement.GetProperty("calls").EnumerateArray())
+{
+    var target = variables[call.GetProperty("target").GetString()!];
+    var result = AspyreInvoke(target, call.GetProperty("method").GetString()!, call.GetProperty("args"));
+    if (call.TryGetProperty("assign", out var assign))
+    {
+        variables[assign.GetString()!] = result!;
+    }
+}
+
+builder.Build().Run();
+
+object? AspyreInvoke(object target, string name, JsonElement args)
+{
+    var names = args.EnumerateObject().Select(arg => arg.Name).ToHashSet();
+    foreach (var candidate in extensions[name])
+    {
+        var method = candidate;
+        if (method.IsGenericMethodDefinition)
+        {
+            var resourceType = target.GetType().GetInterfaces()
+                .FirstOrDefault(type => type.IsGenericType && type.GetGenericTypeDefinition() == typeof(IResourceBuilder<>))
+                ?.GetGenericArguments()[0];
+            if (resourceType is null || method.GetGenericArguments().Length != 1)
+            {
+                continue;
+            }
+            try
+            {
+                method = method.MakeGenericMethod(resourceType);
+            }
+            catch (ArgumentException)
+            {
+                continue;
+            }
+        }
+        var parameters = method.GetParameters();
+        if (parameters.Length == 0 || !parameters[0].ParameterType.IsInstanceOfType(target))
+        {
+            continue;
+        }
+        if (!names.All(arg => parameters.Skip(1).Any(parameter => parameter.Name == arg)))
+        {
+            continue;
+        }
+        var values = new object?[parameters.Length];
+        values[0] = target;
+        var matched = true;
+        for (var index = 1; index < parameters.Length && matched; index++)
+        {
+            var parameter = parameters[index];
+            if (args.TryGetProperty(parameter.Name!, out var value))
+            {
+                matched = AspyreTryConvert(value, parameter.ParameterType, out values[index]);
+            }
+            else if (parameter.HasDefaultValue)
+            {
+                values[index] = parameter.DefaultValue;
+            }
+            else
+            {
+                matched = false;
+            }
+        }
+        if (matched)
+        {
+            return method.Invoke(null, values);
+        }
+    }
+    throw new InvalidOperationException($"No overload of '{name}' matches the arguments recorded in topology.json.");
+}
+
+bool AspyreTryConvert(JsonElement value, Type type, out object? result)
+{
+    var underlying = Nullable.GetUnderlyingType(type) ?? type;
+    result = null;
+    switch (value.ValueKind)
+    {
+        case JsonValueKind.Null:
+            return !type.IsValueType || underlying != type;
+        case JsonValueKind.True:
+        case JsonValueKind.False:
+            result = value.GetBoolean();
+            return underlying == typeof(bool);
+        case JsonValueKind.String:
+            result = value.GetString();
+            return underlying == typeof(string);
+        case JsonValueKind.Number:
+            if (!underlying.IsPrimitive || underlying == typeof(bool) || underlying == typeof(char))
+            {
+                return false;
+            }
+            result = Convert.ChangeType(value.GetDouble(), underlying);
+            return true;
+        case JsonValueKind.Array:
+            if (!type.IsAssignableFrom(typeof(string[])))
+            {
+                return false;
+            }
+            result = value.EnumerateArray().Select(item => item.GetString()!).ToArray();
+            return true;
+    }
+    if (value.TryGetProperty("enum", out var member))
+    {
+        var parts = member.GetString()!.Split('.');
+        if (!underlying.IsEnum || underlying.Name != parts[0])
+        {
+            return false;
+        }
+        result = Enum.Parse(underlying, parts[1]);
+        return true;
+    }
+    if (value.TryGetProperty("resource", out var variable))
+    {
+        result = variables[variable.GetString()!];
+        if (value.TryGetProperty("member", out var property))
+        {
+            result = result.GetType().GetProperty(property.GetString()!)!.GetValue(result);
+        }
+        return type.IsInstanceOfType(result);
+    }
+    if (value.TryGetProperty("base64", out var base64))
+    {
+        result = Convert.FromBase64String(base64.GetString()!);
+        return type.IsAssignableFrom(typeof(byte[]));
+    }
+    if (value.TryGetProperty("certificate", out var certificate))
+    {
+        result = X509CertificateLoader.LoadCertificate(Convert.FromBase64String(certificate.GetProperty("base64").GetString()!));
+        return type.IsInstanceOfType(result);
+    }
+    if (value.TryGetProperty("certificateFile", out var certificateFile))
+    {
+        result = X509CertificateLoader.LoadCertificateFromFile(certificateFile.GetString()!);
+        return type.IsInstanceOfType(result);
+    }
+    if (value.TryGetProperty("certificates", out var certificates))
+    {
+        var items = new List<X509Certificate2>();
+        foreach (var item in certificates.EnumerateArray())
+        {
+            if (!AspyreTryConvert(item, typeof(X509Certificate2), out var loaded))
+            {
+                return false;
+            }
+            items.Add((X509Certificate2)loaded!);
+        }
+        result = items;
+        return type.IsInstanceOfType(result);
+    }
+    throw new NotSupportedException($"Unsupported value in topology.json: {value}");
+}
+
+static string AspyreSourceDirectory([CallerFilePath] string path = "") => Path.GetDirectoryName(path)!;
@@ -0,0 +1,19 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+using System.Text.Json;
+
+var aspyrePayloads = JsonDocument.Parse(File.ReadAllText(Path.Combine(AspyreSourceDirectory(), "apphost.payloads.json"))).RootElement;
+string[] AspyrePayloadArgs(string key) => aspyrePayloads.GetProperty(key).EnumerateArray().Select(item => item.GetString()!).ToArray();
+string AspyrePayloadString(string key) => aspyrePayloads.GetProperty(key).GetString()!;
+static string AspyreSourceDirectory([System.Runtime.CompilerServices.CallerFilePath] string path = "") => Path.GetDirectoryName(path)!;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var worker = builder.AddExecutable(name: "worker", command: "python", workingDirectory: "/app", args: AspyrePayloadArgs("worker.args"))
+    .WithEnvironment(name: "SMALL", value: "value");
+worker.WithArgs(args: new string[] { "--verbose" });
+worker.WithArgs(args: AspyrePayloadArgs("worker.args.2"));
+worker.WithEnvironment(name: "LARGE_CONFIG", value: AspyrePayloadString("worker.env.LARGE_CONFIG"));
+
+builder.Build().Run();
@@ -0,0 +1,15 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var db_password = builder.AddParameter(name: "db-password", secret: true);
+var orders = builder.AddConnectionString(name: "orders", environmentVariableName: (string?)null);
+var cache = builder.AddContainer(name: "cache", image: "redis");
+var api = builder.AddContainer(name: "api", image: "myorg/api")
+    .WaitFor(dependency: cache);
+api.WithReference(source: orders, connectionName: (string?)null, optional: false);
+api.WithEnvironment(name: "DB_PASSWORD", parameter: db_password);
+
+builder.Build().Run();
@@ -0,0 +1,16 @@
+#:sdk Aspire.AppHost.Sdk@13.0.1.0
+#:package Aspire.Hosting.Redis@13.0.0.0
+#:package Aspire.Hosting@13.0.1.0
+using System.Security.Cryptography.X509Certificates;
+
+var builder = DistributedApplication.CreateBuilder(args);
+
+var api = builder.AddProject(name: "api", projectPath: "../api/api.csproj")
+    .WithReplicas(replicas: 3)
+    .WithHttpEndpoint(port: 20067, targetPort: null, name: "web", env: (string?)null, isProxied: true);
+var frontend = builder.AddContainer(name: "frontend", image: "nginx");
+frontend.WithHttpEndpoint(port: 20002, targetPort: null, name: (string?)null, env: (string?)null, isProxied: true);
+frontend.WithHttpsEndpoint(port: 8443, targetPort: null, name: (string?)null, env: (string?)null, isProxied: true);
+var cache = builder.AddRedis(name: "cache", port: 20079);
+
+builder.Build().Run();
@@ -2,9 +2,16 @@
 #   Copyright (c) Microsoft Corporation. All rights reserved.
 #   Licensed under the MIT License. See LICENSE in project root for information.
 #   ---------------------------------------------------------------------------------
+import dataclasses
+import json
 import os
+import sys
 
-from aspyre import build_distributed_application
+import pytest
+
+import aspyre
+
+from aspyre import build_distributed_application, diff, serial_wait_chains, AspyreLintWarning, ContainerResource, DistributedApplicationBuilder, GenerationCache, MethodCall, PortPlanner, build_script
 
 
 def test_empty_application(verify_dotnet_apphost):
@@ -12,3 +19,604 @@ def test_empty_application(verify_dotnet_apphost):
     builder = build_distributed_application()
     builder.build(output_dir=export_path)
     verify()
+
+
+def test_data_driven_application(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application()
+    password = builder.add_parameter("db-password", secret=True)
+    cache = builder.add_redis("cache")
+    api = builder.add_container("api", "myorg/api", "1.2",
+                                http_endpoint={"port": 8080},
+                                wait_for=(cache, "WaitOnResourceUnavailable"))
+    api.with_reference(cache).with_env("DB_PASSWORD", password).with_args(["--verbose"])
+    builder.build(output_dir=export_path, data_driven=True)
+    verify()
+
+
+def test_data_driven_apphost_is_stable(tmp_path):
+    first = build_distributed_application()
+    first.add_container("api", "nginx")
+    first.build(output_dir=tmp_path / "first", data_driven=True)
+    second = build_distributed_application()
+    second.add_redis("cache").with_args(["--appendonly", "yes"])
+    second.build(output_dir=tmp_path / "second", data_driven=True)
+    assert (tmp_path / "first" / "apphost.cs").read_text() == (tmp_path / "second" / "apphost.cs").read_text()
+    assert (tmp_path / "first" / "topology.json").read_text() != (tmp_path / "second" / "topology.json").read_text()
+
+
+def test_strings_round_trip_through_the_apphost_source(tmp_path):
+    values = [r"C:\temp\x41", r"^\d+\.\w*\\$", 'say "hi"', "tab\tnew\nline", "nul\0 and \u2028", "\\"]
+    builder = build_distributed_application()
+    api = builder.add_container("api", "nginx").with_args(values)
+    for index, value in enumerate(values):
+        api.with_env(f"VALUE_{index}", value)
+    builder.build(output_dir=tmp_path, data_driven=True)
+    calls = json.loads((tmp_path / "topology.json").read_text())["calls"]
+    assert {"method": "WithArgs", "target": "api", "args": {"args": values}} in calls
+    env = {call["args"]["name"]: call["args"]["value"] for call in calls if call["method"] == "WithEnvironment"}
+    assert env == {f"VALUE_{index}": value for index, value in enumerate(values)}
+    builder.build(output_dir=tmp_path)
+    assert 'WithArgs(args: new string[] { "C:\\\\temp\\\\x41", ' in (tmp_path / "apphost.cs").read_text()
+
+
+def test_data_driven_build_rejects_unsupported_expressions(tmp_path):
+    builder = build_distributed_application()
+    builder.add_container("api", "nginx").with_container_certificate_paths(default_certificate_bundle_paths=["/etc/ssl/ca.pem"])
+    with pytest.raises(ValueError, match="api.WithContainerCertificatePaths.*cannot evaluate"):
+        builder.build(output_dir=tmp_path, data_driven=True)
+
+
+def test_port_planner_assigns_endpoints(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application(port_planner=PortPlanner([(20000, 20099)]))
+    api = builder.add_project("api", "../api/api.csproj", replicas=3, http_endpoint={"name": "web"})
+    frontend = builder.add_container("frontend", "nginx").with_http_endpoint().with_https_endpoint(port=8443)
+    cache = builder.add_redis("cache")
+    builder.build(output_dir=export_path)
+    verify()
+
+
+def test_port_planner_is_deterministic():
+    def plan(*names):
+        builder = build_distributed_application(port_planner=PortPlanner([(30000, 30999)]))
+        for name in names:
+            builder.add_container(name, "nginx").with_http_endpoint()
+        return builder.planned_ports()
+
+    first = plan("api", "web", "worker")
+    second = plan("worker", "web", "api", "extra")
+    assert first == {key: second[key] for key in first}
+    assert len(set(second.values())) == len(second)
+
+
+def test_port_planner_reserves_replica_ranges():
+    builder = build_distributed_application(port_planner=PortPlanner([(40000, 40003)]))
+    builder.add_project("api", "../api/api.csproj", replicas=3).with_http_endpoint()
+    builder.add_container("web", "nginx").with_http_endpoint()
+    ports = builder.planned_ports()
+    api = ports["api/http"]
+    assert ports["web/http"] not in range(api, api + 3)
+
+
+def test_port_planner_detects_conflicts(tmp_path):
+    builder = build_distributed_application(port_planner=PortPlanner())
+    builder.add_container("first", "nginx").with_http_endpoint(port=8080)
+    builder.add_container("second", "nginx", http_endpoint={"port": 8080})
+    with pytest.raises(ValueError, match="port 8080"):
+        builder.build(output_dir=tmp_path)
+
+
+def test_partial_build_dependency_closure(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application()
+    password = builder.add_parameter("db-password", secret=True)
+    unused = builder.add_parameter("unused-secret", secret=True)
+    database = builder.add_connection_string("orders")
+    cache = builder.add_container("cache", "redis")
+    builder.add_container("unrelated", "nginx").with_env("SECRET", unused)
+    api = builder.add_container("api", "myorg/api", wait_for=cache)
+    api.with_reference(database).with_env("DB_PASSWORD", password)
+    builder.add_container("frontend", "myorg/frontend").wait_for(api)
+    builder.build(output_dir=export_path, only=["api"])
+    verify()
+
+
+def test_partial_build_unknown_resource(tmp_path):
+    builder = build_distributed_application()
+    builder.add_container("api", "nginx")
+    with pytest.raises(ValueError, match="Unknown resource 'missing'"):
+        builder.build(output_dir=tmp_path, only=["missing"])
+
+
+def test_builder_plan_render(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application()
+    replicas = builder.placeholder("replicas", int)
+    image = builder.placeholder("image", str, default="nginx")
+    policy = builder.placeholder("pull_policy", str, default="Missing")
+    builder.add_project("api", "../api/api.csproj", replicas=replicas)
+    builder.add_container("web", image, image_pull_policy=policy).with_env("IMAGE", image)
+    plan = builder.freeze()
+    plan.render(export_path, replicas=8, image="myorg/web")
+    verify()
+
+
+def test_builder_plan_render_many(tmp_path):
+    builder = build_distributed_application()
+    replicas = builder.placeholder("replicas", int)
+    builder.add_project("api", "../api/api.csproj").with_replicas(replicas)
+    plan = builder.freeze()
+    apps = plan.render_many([(tmp_path / str(count), {"replicas": count}) for count in (1, 2, 4)], max_workers=2)
+    for count, app in zip((1, 2, 4), apps):
+        assert f"WithReplicas(replicas: {count})" in app.apphost_path.read_text()
+
+
+def test_builder_plan_validates_values(tmp_path):
+    builder = build_distributed_application()
+    policy = builder.placeholder("pull_policy", str)
+    builder.add_container("web", "nginx", image_pull_policy=policy)
+    plan = builder.freeze()
+    with pytest.raises(TypeError, match="Invalid value for placeholder 'pull_policy'"):
+        plan.render(tmp_path, pull_policy="Sometimes")
+    with pytest.raises(TypeError, match="Missing value for placeholder 'pull_policy'"):
+        plan.render(tmp_path)
+    with pytest.raises(TypeError):
+        builder.add_container("other", "nginx", container_runtime_args=policy)
+
+
+def test_builder_plan_keeps_placeholders_out_of_payloads(tmp_path):
+    builder = build_distributed_application(payload_threshold=10)
+    tag = builder.placeholder("tag", str)
+    builder.add_container("web", "nginx").with_args(["--tag", tag, "--verbose"]).with_env("TAG", tag)
+    builder.freeze().render(tmp_path, tag="v1")
+    apphost = (tmp_path / "apphost.cs").read_text()
+    assert 'WithArgs(args: new string[] { "--tag", "v1", "--verbose" })' in apphost
+    assert 'WithEnvironment(name: "TAG", value: "v1")' in apphost
+    assert not (tmp_path / "apphost.payloads.json").exists()
+
+
+def test_builder_plan_rejects_booleans_for_ints(tmp_path):
+    builder = build_distributed_application()
+    replicas = builder.placeholder("replicas", int)
+    builder.add_project("api", "../api/api.csproj", replicas=replicas)
+    with pytest.raises(TypeError, match="Invalid value for placeholder 'replicas'"):
+        builder.freeze().render(tmp_path, replicas=True)
+    with pytest.raises(TypeError):
+        builder.add_project("other", "../other/other.csproj", replicas=builder.placeholder("enabled", bool))
+
+
+def test_build_sharded_stubs_cross_shard_references(tmp_path):
+    builder = build_distributed_application()
+    password = builder.add_parameter("db-password", secret=True)
+    postgres = builder.add_postgres("pg")
+    orders = postgres.add_database("orders")
+    api = builder.add_container("api", "myorg/api", wait_for=orders).with_env("DB_PASSWORD", password)
+    builder.add_container("frontend", "myorg/frontend").with_reference(api).wait_for(api)
+    shards = {"pg": "data", "orders": "web", "api": "backend", "frontend": "web"}
+    apps = builder.build_sharded(shards.get, tmp_path, max_workers=2)
+    assert sorted(apps) == ["backend", "data", "web"]
+    data = apps["data"].apphost_path.read_text()
+    assert 'var orders = pg.AddDatabase(name: "orders"' in data
+    backend = apps["backend"].apphost_path.read_text()
+    assert 'var orders = builder.AddConnectionString(name: "orders"' in backend
+    assert 'var db_password = builder.AddParameter(name: "db-password", secret: true);' in backend
+    assert "AddPostgres" not in backend
+    web = apps["web"].apphost_path.read_text()
+    assert 'var api_url = builder.AddParameter(name: "api-url", secret: false);' in web
+    assert 'var api = builder.AddExternalService(name: "api", urlParameter: api_url);' in web
+    assert "frontend.WithReference(externalService: api);" in web
+    assert "db_password" not in web
+
+
+def test_build_sharded_rejects_unsupported_cross_shard_references(tmp_path):
+    builder = build_distributed_application()
+    cache = builder.add_redis("cache")
+    migrate = builder.add_container("migrate", "myorg/migrate")
+    api = builder.add_container("api", "myorg/api").with_env("CACHE", cache).with_relationship(migrate, "Uses")
+    apps = builder.build_sharded({"cache": "data", "migrate": "data", "api": "web"}.get, tmp_path / "ok")
+    web = apps["web"].apphost_path.read_text()
+    assert 'var cache = builder.AddConnectionString(name: "cache"' in web
+    assert "api.WithRelationship(resource: migrate.Resource" in web
+    api.wait_for_completion(migrate)
+    with pytest.raises(ValueError, match=r"'migrate' across shards with WaitForCompletion\(dependency\), place 'api'"):
+        builder.build_sharded({"cache": "data", "migrate": "data", "api": "web"}.get, tmp_path / "failed")
+
+
+def test_build_sharded_places_unassigned_resources(tmp_path):
+    builder = build_distributed_application()
+    cache = builder.add_redis("cache")
+    queue = builder.add_container("queue", "rabbitmq")
+    builder.add_container("api", "myorg/api").with_reference(cache).wait_for(queue)
+    builder.add_container("worker", "myorg/worker").wait_for(cache)
+    builder.add_container("standalone", "nginx")
+    apps = builder.build_sharded({"cache": "data", "queue": "messaging"}.get, tmp_path, max_workers=1)
+    data = apps["data"].apphost_path.read_text()
+    assert 'var worker = builder.AddContainer(name: "worker"' in data
+    assert 'var standalone = builder.AddContainer(name: "standalone"' in data
+    assert 'var api = builder.AddContainer(name: "api"' in data
+    assert 'var queue = builder.AddExternalService(name: "queue", urlParameter: queue_url);' in data
+    with pytest.raises(ValueError, match="Invalid shard"):
+        builder.build_sharded(lambda name: "data/api", tmp_path)
+
+
+def test_builder_modules(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application()
+
+    def billing(module):
+        database = module.add_postgres("db")
+        module.add_container("api", "myorg/billing", wait_for=database)
+
+    def search(module):
+        module.add_container("api", "myorg/search")
+
+    billing_module = builder.module("billing", billing)
+    builder.module("search", search)
+    builder.add_container("frontend", "myorg/frontend").wait_for(billing_module.resource("api"))
+    builder.build(output_dir=export_path, only=["frontend"])
+    verify()
+
+
+def test_builder_modules_are_lazy(tmp_path):
+    builder = build_distributed_application()
+    contributed = []
+
+    def contribute(name):
+        def add(module):
+            contributed.append(name)
+            module.add_container("api", f"myorg/{name}")
+        return add
+
+    modules = {name: builder.module(name, contribute(name)) for name in ("billing", "search", "catalog")}
+    builder.add_container("frontend", "nginx")
+    builder.build(output_dir=tmp_path, only=["frontend"])
+    assert contributed == []
+    builder.build(output_dir=tmp_path, only=["search-api"])
+    assert contributed == ["search"]
+    assert 'AddContainer(name: "search-api", image: "myorg/search")' in (tmp_path / "apphost.cs").read_text()
+    builder.build(output_dir=tmp_path)
+    assert contributed == ["search", "billing", "catalog"]
+    with pytest.raises(ValueError, match="already declared"):
+        builder.module("billing")
+    with pytest.raises(ValueError, match="Unknown resource 'missing' in module 'search'"):
+        modules["search"].resource("missing")
+
+
+def _versioned_topology(api_version, log_level="info"):
+    builder = build_distributed_application()
+    cache = builder.add_redis("cache")
+    builder.add_container("api", "myorg/api", api_version).with_reference(cache).with_env("LOG_LEVEL", "info")
+    builder.add_container("worker", "myorg/worker").wait_for(cache).with_env("LOG_LEVEL", log_level)
+    return builder
+
+
+def test_topology_diff():
+    old = _versioned_topology("1.0")
+    new = _versioned_topology("1.1")
+    new.add_container("admin", "myorg/admin")
+    changes = diff(old.state(), new)
+    assert changes.added == ("admin",)
+    assert changes.removed == ()
+    assert changes.modified == {"api": ("AddContainer",)}
+    assert changes.affected == ("admin", "api")
+    assert not diff(old, _versioned_topology("1.0"))
+
+
+def test_build_tracks_changes(tmp_path, capsys):
+    first = _versioned_topology("1.0").build(output_dir=tmp_path, track_changes=True)
+    assert first.changes.added == ("api", "cache", "worker")
+    capsys.readouterr()
+    second = _versioned_topology("1.0", log_level="debug").build(output_dir=tmp_path, track_changes=True)
+    assert second.changes.modified == {"worker": ("WithEnvironment(LOG_LEVEL)",)}
+    assert capsys.readouterr().out == "Topology changes:\n  ~ worker: WithEnvironment(LOG_LEVEL)\n"
+    assert (tmp_path / "apphost.state.json").exists()
+
+
+CACHED_SCRIPT = '''
+import pathlib, sys
+sys.path.insert(0, {directory!r})
+from cached_helpers import IMAGE
+from aspyre import build_distributed_application
+
+runs = pathlib.Path({directory!r}) / "runs"
+runs.write_text(runs.read_text() + "run" if runs.exists() else "run")
+builder = build_distributed_application(payload_threshold=10)
+builder.add_container("api", IMAGE).with_args(["--input", "data.csv", "--output", "out.csv"])
+'''
+
+
+def test_build_script_restores_from_cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    (tmp_path / "cached_helpers.py").write_text("IMAGE = 'myorg/api'\n")
+    script = tmp_path / "app.py"
+    script.write_text(CACHED_SCRIPT.format(directory=str(tmp_path)))
+    first = build_script(str(script), output_dir=str(tmp_path / "first"), cache_dir=cache_dir)
+    second = build_script(str(script), output_dir=str(tmp_path / "second"), cache_dir=cache_dir)
+    assert (tmp_path / "runs").read_text() == "run"
+    assert second.read_text() == first.read_text()
+    payloads = "apphost.payloads.json"
+    assert (second.parent / payloads).read_text() == (first.parent / payloads).read_text()
+    [entry] = cache_dir.glob("*.json")
+    assert str(tmp_path / "cached_helpers.py") in json.loads(entry.read_text())["modules"]
+
+    sys.modules.pop("cached_helpers")
+    (tmp_path / "cached_helpers.py").write_text("IMAGE = 'myorg/api2'\n")
+    third = build_script(str(script), output_dir=str(tmp_path / "third"), cache_dir=cache_dir)
+    assert (tmp_path / "runs").read_text() == "runrun"
+    assert "myorg/api2" in third.read_text()
+    sys.modules.pop("cached_helpers")
+    build_script(str(script), output_dir=str(tmp_path / "fourth"), cache_dir=cache_dir, data_driven=True)
+    assert (tmp_path / "runs").read_text() == "runrunrun"
+    assert (tmp_path / "fourth" / "topology.json").exists()
+    sys.modules.pop("cached_helpers")
+
+
+def test_generation_cache_evicts_least_recently_used(tmp_path):
+    cache = GenerationCache(tmp_path, max_bytes=200)
+    cache.put("first", {"apphost.cs": "a" * 40})
+    cache.put("second", {"apphost.cs": "b" * 40})
+    os.utime(tmp_path / "first.json", ns=(0, 0))
+    os.utime(tmp_path / "second.json", ns=(1, 1))
+    assert cache.get("first") == {"apphost.cs": "a" * 40}
+    cache.put("third", {"apphost.cs": "c" * 40})
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_generation_cache_lists_entries_only_when_full(tmp_path, monkeypatch):
+    cache = GenerationCache(tmp_path, max_bytes=4096)
+    cache.put("first", {"apphost.cs": "a" * 40})
+    scans = []
+    evict = GenerationCache._evict
+    monkeypatch.setattr(GenerationCache, "_evict", lambda self: scans.append(self) or evict(self))
+    for index in range(20):
+        cache.put(f"entry-{index}", {"apphost.cs": "b" * 40})
+    cache.put("first", {"apphost.cs": "c" * 40})
+    assert scans == []
+    cache.put("large", {"apphost.cs": "d" * 4000})
+    assert len(scans) == 1
+    assert sum(path.stat().st_size for path in tmp_path.glob("*.json")) <= 4096
+    assert int((tmp_path / "size").read_text()) == sum(path.stat().st_size for path in tmp_path.glob("*.json"))
+
+
+def test_build_script_records_modules_imported_before_it_runs(tmp_path):
+    (tmp_path / "shared_images.py").write_text("import preloaded_helpers\nIMAGE = preloaded_helpers.IMAGE\n")
+    (tmp_path / "preloaded_helpers.py").write_text("IMAGE = 'myorg/api'\n")
+    (tmp_path / "unrelated_helpers.py").write_text("")
+    sys.path.insert(0, str(tmp_path))
+    try:
+        import preloaded_helpers, unrelated_helpers  # noqa: F401
+        script = tmp_path / "app.py"
+        script.write_text(
+            "from aspyre import build_distributed_application\n"
+            "from shared_images import IMAGE\n"
+            "builder = build_distributed_application()\n"
+            "builder.add_container('api', IMAGE)\n")
+        build_script(str(script), output_dir=str(tmp_path / "out"), cache_dir=tmp_path / "cache")
+        [entry] = (tmp_path / "cache").glob("*.json")
+        modules = json.loads(entry.read_text())["modules"]
+        assert str(tmp_path / "shared_images.py") in modules
+        assert str(tmp_path / "preloaded_helpers.py") in modules
+        assert str(tmp_path / "unrelated_helpers.py") not in modules
+    finally:
+        sys.path.remove(str(tmp_path))
+        for name in ("shared_images", "preloaded_helpers", "unrelated_helpers"):
+            sys.modules.pop(name, None)
+
+
+def test_builder_json_round_trip(tmp_path):
+    builder = build_distributed_application(payload_threshold=20, port_planner=PortPlanner())
+    password = builder.add_parameter("db-password", secret=True)
+    postgres = builder.add_postgres("pg")
+    orders = postgres.add_database("orders")
+    api = builder.add_container("api", "myorg/api", wait_for=orders, http_endpoint={"name": "web"})
+    api.with_env("DB_PASSWORD", password).with_args(["--workers", "4", "--log-level", "debug"])
+    builder.add_container("worker", "myorg/worker", container_runtime_args=["--privileged"])
+    state = json.loads(builder.to_json())
+    assert state["resources"]["api"] == {"type": "ContainerResource"}
+    calls = state["writer"]["calls"]
+    assert {
+        "target": "api", "method": "WithArgs", "args": {"args": ["--workers", "4", "--log-level", "debug"]},
+        "payloads": {"args": "api.args"}} in calls
+    assert {"target": "api", "method": "WaitFor", "args": {"dependency": {"resource": "orders"}}, "chained": True} in calls
+    assert {"plannedPort": 0} in [call["args"].get("port") for call in calls]
+    restored = DistributedApplicationBuilder.from_json(builder.to_json())
+    original = builder.build(output_dir=tmp_path / "original")
+    copy = restored.build(output_dir=tmp_path / "restored")
+    assert copy.apphost_path.read_text() == original.apphost_path.read_text()
+    payloads = "apphost.payloads.json"
+    assert (tmp_path / "restored" / payloads).read_text() == (tmp_path / "original" / payloads).read_text()
+    assert restored.planned_ports() == builder.planned_ports()
+    restored.add_container("admin", "myorg/admin").wait_for(restored.resource("orders"))
+    assert restored.graph()["admin"] == ["orders"]
+
+
+def test_builder_json_restores_placeholders(tmp_path):
+    builder = build_distributed_application()
+    policy = builder.placeholder("pull_policy", str, default="Missing")
+    builder.add_container("web", "nginx", image_pull_policy=policy)
+    restored = DistributedApplicationBuilder.from_json(builder.to_json())
+    plan = restored.freeze()
+    plan.render(tmp_path, pull_policy="Always")
+    assert "ImagePullPolicy.Always" in (tmp_path / "apphost.cs").read_text()
+    with pytest.raises(TypeError, match="Invalid value for placeholder 'pull_policy'"):
+        plan.render(tmp_path, pull_policy="Sometimes")
+    with pytest.raises(ValueError, match="Unsupported builder state"):
+        DistributedApplicationBuilder.from_json(builder.to_json().replace('"schema": 3', '"schema": 0'))
+
+
+def test_builder_json_restores_from_the_calls(tmp_path):
+    builder = build_distributed_application()
+    builder.add_container("api", "myorg/api", image_tag="1.0").with_env("MODE", "fast")
+    state = json.loads(builder.to_json())
+    for call in state["writer"]["calls"]:
+        if call["method"] == "WithEnvironment":
+            call["args"]["value"] = "slow"
+    restored = DistributedApplicationBuilder.from_json(json.dumps(state))
+    assert restored.state()["resources"]["api"]["WithEnvironment(MODE)"]["value"] == "slow"
+    source = restored.build(output_dir=tmp_path).apphost_path.read_text()
+    assert 'api.WithEnvironment(name: "MODE", value: "slow");' in source
+
+
+def test_import_does_not_load_the_run_engine():
+    import subprocess
+
+    # The modules only needed to run, check or serialize an application are imported when first used.
+    code = "import sys; before = set(sys.modules); import aspyre; print(' '.join(sorted(set(sys.modules) - before)))"
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(aspyre.__file__), capture_output=True, text=True, check=True)
+    imported = set(result.stdout.split())
+    assert "aspyre" in imported
+    assert not imported & {"asyncio", "concurrent.futures", "hashlib", "json", "subprocess", "tempfile"}
+
+
+def test_builder_stats(tmp_path):
+    builder = build_distributed_application(instrument=True)
+    cache = builder.add_redis("cache")
+    for index in range(3):
+        builder.add_container(f"api-{index}", "myorg/api").with_reference(cache).with_env("MODE", "fast")
+    builder.build(output_dir=tmp_path)
+    stats = builder.stats()
+    assert stats.calls["AddContainer"][0] == 3
+    assert stats.calls["WithEnvironment"][0] == 3
+    assert stats.calls["build"][0] == 1
+    assert set(stats.phases) == {"generation", "emission"} and all(seconds > 0 for seconds in stats.phases.values())
+    assert stats.memory == {}
+    assert "AddContainer" in stats.report()
+    with pytest.raises(ValueError, match="not instrumented"):
+        build_distributed_application().stats()
+
+
+def test_instrumentation_is_limited_to_instrumented_builders():
+    import threading
+
+    instrumented = build_distributed_application(instrument=True)
+    instrumented.add_container("api", "nginx")
+    stats = instrumented.stats()
+    phases = dict(stats.phases)
+    plain = build_distributed_application()
+    plain.add_container("api", "nginx").with_env("LOG_LEVEL", "debug")
+    assert stats.phases == phases and "WithEnvironment" not in stats.calls
+    assert not hasattr(ContainerResource.with_env, "__wrapped__") and not hasattr(aspyre._format_string, "__wrapped__")
+
+    builders = [build_distributed_application(instrument=True) for _ in range(4)]
+
+    def add(builder, count):
+        for index in range(count):
+            builder.add_container(f"c{index}", "nginx").with_env("LOG_LEVEL", "debug")
+
+    threads = [threading.Thread(target=add, args=(builder, 50 * (index + 1))) for index, builder in enumerate(builders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [builder.stats().calls["WithEnvironment"][0] for builder in builders] == [50, 100, 150, 200]
+
+
+
+def test_builder_hooks_and_middleware(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application()
+
+    @builder.on_resource_added
+    def persistent_lifetime(resource):
+        if isinstance(resource, ContainerResource):
+            resource.with_lifetime("Persistent")
+
+    def never_always_pull(call, proceed):
+        if call.method == "WithImagePullPolicy" and call.args["pullPolicy"] == {"enum": "ImagePullPolicy.Always"}:
+            call = dataclasses.replace(call, args={"pullPolicy": {"enum": "ImagePullPolicy.Missing"}})
+        proceed(call)
+        if call.method == "AddContainer":
+            proceed(MethodCall(call.assign, "WithOtlpExporter", {}))
+
+    builder.use(never_always_pull)
+    builder.before_build(lambda builder: builder.add_parameter("deployment-id"))
+    postgres = builder.add_postgres("pg")
+    postgres.add_database("orders")
+    builder.add_container("api", "myorg/api").with_image_pull_policy("Always")
+    builder.build(output_dir=export_path)
+    verify()
+
+
+def test_builder_hooks_observe_calls(tmp_path):
+    builder = build_distributed_application()
+    added, calls, builds = [], [], []
+    builder.on_resource_added(lambda resource: added.append(resource.name))
+    builder.on_method_call(lambda call: calls.append((call.target, call.method)))
+    builder.before_build(builds.append)
+    cache = builder.add_redis("cache")
+    builder.add_container("api", "myorg/api").with_reference(cache)
+    builder.build(output_dir=tmp_path)
+    assert added == ["cache", "api"]
+    assert calls == [("builder", "AddRedis"), ("builder", "AddContainer"), ("api", "WithReference")]
+    assert builds == [builder]
+    other = build_distributed_application()
+    other.add_container("web", "nginx").with_reference(other.add_redis("cache"))
+    assert len(calls) == 3
+
+
+def test_builder_middleware_defers_calls_on_other_resources(tmp_path):
+    builder = build_distributed_application()
+    cache = builder.add_redis("cache")
+
+    def wait_for_cache(call, proceed):
+        proceed(call)
+        if call.method == "AddContainer":
+            proceed(MethodCall("cache", "WithEnvironment", {"name": "CLIENT", "value": call.args["name"]}))
+            proceed(MethodCall(call.assign, "WaitFor", {"dependency": {"resource": "cache"}}))
+
+    builder.use(wait_for_cache)
+    builder.add_container("api", "myorg/api", explicit_start=True)
+    source = builder.build(output_dir=tmp_path).apphost_path.read_text()
+    assert (
+        'var api = builder.AddContainer(name: "api", image: "myorg/api")\n'
+        '    .WaitFor(dependency: cache)\n'
+        '    .WithExplicitStart();\n'
+        'cache.WithEnvironment(name: "CLIENT", value: "api");') in source
+    builder.use(lambda call, proceed: None)
+    with pytest.raises(ValueError, match="must proceed"):
+        builder.add_container("worker", "myorg/worker")
+
+
+def test_builder_lint():
+    builder = build_distributed_application()
+    postgres = builder.add_postgres("postgres")
+    orders = postgres.add_database("orders")
+    builder.add_redis("cache").with_lifetime("Persistent")
+    seed = builder.add_container("seed", "myorg/seed:latest", image_pull_policy="Always")
+    migrate = builder.add_container("migrate", "myorg/migrate", "1.2").wait_for(seed).with_http_health_check(path="/health")
+    worker = builder.add_container("worker", "myorg/worker@sha256:abc").wait_for(migrate)
+    builder.add_container("api", "registry:5000/myorg/api:2.0").wait_for(worker).wait_for(orders)
+    findings = {(finding.rule, finding.resource): finding for finding in builder.lint()}
+    assert sorted(findings) == [
+        ("pull-policy-always", "seed"),
+        ("serial-wait-chain", "api"),
+        ("session-database", "postgres"),
+        ("unpinned-image", "seed"),
+        ("wait-without-health-check", "seed"),
+        ("wait-without-health-check", "worker"),
+    ]
+    assert findings[("session-database", "postgres")].severity == "info"
+    assert findings[("wait-without-health-check", "worker")].message.startswith("Waited for by api,")
+    assert str(findings[("serial-wait-chain", "api")]) == (
+        "api: Starts after a chain of 4 resources started one by one: api -> worker -> migrate -> seed. "
+        "(serial-wait-chain)")
+    assert builder.lint([serial_wait_chains(max_length=4)]) == []
+    assert [finding.resource for finding in builder.lint(only=["migrate"])] == ["seed", "seed", "seed"]
+
+
+def test_build_lint(tmp_path):
+    builder = build_distributed_application()
+    builder.add_redis("cache")
+    with pytest.warns(AspyreLintWarning, match="cache: The database container"):
+        builder.build(output_dir=tmp_path, lint="error")
+    builder.add_container("api", "myorg/api")
+    with pytest.raises(ValueError, match="Performance lint failed:\n  api: The image 'myorg/api' is not pinned"):
+        builder.build(output_dir=tmp_path / "failed", lint="error")
+    assert not (tmp_path / "failed").exists()
+    with pytest.raises(ValueError, match="Invalid lint mode"):
+        builder.build(output_dir=tmp_path, lint="strict")
@@ -0,0 +1,164 @@
+#   ---------------------------------------------------------------------------------
+#   Copyright (c) Microsoft Corporation. All rights reserved.
+#   Licensed under the MIT License. See LICENSE in project root for information.
+#   ---------------------------------------------------------------------------------
+import json
+import sys
+import threading
+import time
+
+import pytest
+
+from aspyre import build_distributed_application, main, watch, DotnetRunner
+
+
+SCRIPT = '''
+from aspyre import build_distributed_application
+
+builder = build_distributed_application()
+builder.add_container("api", "{image}")
+builder.build(output_dir={output_dir!r})
+'''
+
+
+def test_unchanged_apphost_is_not_rewritten(tmp_path):
+    builder = build_distributed_application()
+    builder.add_container("api", "nginx")
+    apphost = builder.build(output_dir=tmp_path).apphost_path
+    modified = apphost.stat().st_mtime_ns
+    time.sleep(0.01)
+    builder.build(output_dir=tmp_path)
+    assert apphost.stat().st_mtime_ns == modified
+
+
+def test_watch_reruns_script_on_change(tmp_path, capfd):
+    output_dir = tmp_path / "out"
+    script = tmp_path / "apphost.py"
+    script.write_text(SCRIPT.format(image="nginx", output_dir=str(output_dir)))
+    thread = threading.Thread(target=watch, args=(script,), kwargs={"interval": 0.05, "debounce": 0.05, "max_runs": 2})
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not (output_dir / "apphost.state.json").exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    script.write_text(SCRIPT.format(image="myorg/api", output_dir=str(output_dir)))
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert 'image: "myorg/api"' in (output_dir / "apphost.cs").read_text()
+    assert "~ api: AddContainer" in capfd.readouterr().out
+
+
+APP = '''
+from aspyre import build_distributed_application
+
+def create(tag="1.0"):
+    builder = build_distributed_application()
+    cache = builder.add_redis("cache")
+    builder.add_container("api", "myorg/api", tag).with_reference(cache)
+    return builder
+
+builder = create()
+upgraded = lambda: create("2.0")
+'''
+
+
+def test_cli_build_and_graph(tmp_path, capsys):
+    script = tmp_path / "app.py"
+    script.write_text(APP)
+    assert main(["build", str(script), "-o", str(tmp_path / "out")]) == 0
+    assert capsys.readouterr().out.strip() == str(tmp_path / "out" / "apphost.cs")
+    assert 'AddContainer(name: "api", image: "myorg/api", tag: "1.0")' in (tmp_path / "out" / "apphost.cs").read_text()
+    assert main(["graph", f"{script}:upgraded", "--format", "json"]) == 0
+    assert json.loads(capsys.readouterr().out) == {"cache": [], "api": ["cache"]}
+    assert main(["graph", str(script)]) == 0
+    assert '"api" -> "cache";' in capsys.readouterr().out
+
+
+def test_cli_manifest_and_diff(tmp_path, capsys, monkeypatch):
+    (tmp_path / "team_app.py").write_text(APP)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    manifest = tmp_path / "manifest.json"
+    assert main(["manifest", "team_app", "-o", str(manifest)]) == 0
+    assert set(json.loads(manifest.read_text())["resources"]) == {"cache", "api"}
+    assert main(["diff", str(manifest), "team_app:builder"]) == 0
+    assert capsys.readouterr().out == "No topology changes.\n"
+    assert main(["diff", str(manifest), "team_app:upgraded"]) == 1
+    assert "~ api: AddContainer" in capsys.readouterr().out
+
+
+def test_cli_stats(tmp_path, capsys):
+    script = tmp_path / "app.py"
+    script.write_text(APP)
+    assert main(["stats", str(script), "--format", "json", "--memory"]) == 0
+    stats = json.loads(capsys.readouterr().out)
+    assert stats["calls"]["AddContainer"]["count"] == 1
+    assert stats["calls"]["WithReference"]["count"] == 1
+    assert set(stats["phases"]) == {"generation", "emission"}
+    assert stats["memory"]["peak"] > 0
+    assert main(["stats", str(script)]) == 0
+    assert "AddRedis" in capsys.readouterr().out
+
+
+DOTNET = '''
+import pathlib, sys
+
+with pathlib.Path(__file__).with_name("dotnet.log").open("a") as log:
+    log.write("build\\n" if sys.argv[1] == "build" else "run\\n")
+if sys.argv[1] == "build":
+    output = pathlib.Path(sys.argv[4])
+    output.mkdir(parents=True, exist_ok=True)
+    (output / "apphost.dll").write_text(pathlib.Path(sys.argv[2]).read_text())
+else:
+    print("running", pathlib.Path(sys.argv[1]).read_text().count("AddContainer"), "containers")
+    sys.exit(3)
+'''
+
+
+def test_run_reuses_compiled_apphost(tmp_path):
+    stub = tmp_path / "dotnet.py"
+    stub.write_text(DOTNET)
+    output = []
+    runner = DotnetRunner([sys.executable, stub], on_output=output.append)
+    builder = build_distributed_application()
+    builder.add_container("api", "nginx")
+    app = builder.build(output_dir=tmp_path / "out")
+    assert app.run(runner) == 3
+    assert app.run(runner) == 3
+    builder.add_container("web", "nginx")
+    assert builder.build(output_dir=tmp_path / "out").run(runner) == 3
+    assert output == ["running 1 containers", "running 1 containers", "running 2 containers"]
+    assert (tmp_path / "dotnet.log").read_text().split() == ["build", "run", "run", "build", "run"]
+    assert (tmp_path / "out" / ".apphost" / "fingerprint").read_text() == runner.fingerprint(app.apphost_path)
+
+
+def test_cli_run(tmp_path, capfd):
+    stub = tmp_path / "dotnet.py"
+    stub.write_text(DOTNET)
+    script = tmp_path / "app.py"
+    script.write_text(APP)
+    command = f"{sys.executable} {stub}"
+    assert main(["run", str(script), "-o", str(tmp_path / "out"), "--command", command]) == 3
+    assert "running 1 containers" in capfd.readouterr().out
+
+
+def test_cli_run_writes_startup_trace(tmp_path):
+    script = tmp_path / "local.py"
+    script.write_text(
+        "import sys\n"
+        "from aspyre import build_distributed_application\n"
+        "builder = build_distributed_application()\n"
+        "builder.add_executable('hello', sys.executable, '.', ['-c', 'print(1)'])\n")
+    trace = tmp_path / "trace.json"
+    assert main(["run", str(script), "-o", str(tmp_path / "out"), "--engine", "python", "--trace", str(trace)]) == 0
+    names = {event["name"] for event in json.loads(trace.read_text())["traceEvents"]}
+    assert {"startup", "spawn", "running", "exited"} <= names
+
+
+def test_run_accepts_any_runner(tmp_path):
+    class Runner:
+        def run(self, app):
+            return 7 if app.apphost_path.exists() else 1
+
+    app = build_distributed_application().build(output_dir=tmp_path)
+    assert app.run(Runner()) == 7
+    with pytest.raises(TypeError, match="runner must have a run"):
+        app.run(object())
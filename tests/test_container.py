@@ -900,3 +900,14 @@ def test_container_with_dockerfile_build(verify_dotnet_apphost):
 
     builder.build(output_dir=export_path)
     verify()
+
+
+def test_container_with_externalized_payloads(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application(payload_threshold=64)
+    container = builder.add_container("mycontainer", "nginx",
+                                      args=[f"--worker-{i}" for i in range(20)],
+                                      env=("LARGE_CONFIG", "y" * 100))
+    container.with_env("SMALL", "value")
+    builder.build(output_dir=export_path)
+    verify()
@@ -407,3 +407,15 @@ def test_executable_with_dockerfile_publishing(verify_dotnet_apphost):
 
     builder.build(output_dir=export_path)
     verify()
+
+
+def test_executable_with_externalized_payloads(verify_dotnet_apphost):
+    export_path, verify = verify_dotnet_apphost
+    builder = build_distributed_application(payload_threshold=64)
+    app = builder.add_executable("worker", "python", "/app",
+                                 ["worker.py"] + [f"--shard={i}" for i in range(10)],
+                                 env=("SMALL", "value"))
+    app.with_args(["--verbose"]).with_args([f"--topic=events-{i}" for i in range(10)])
+    app.with_env("LARGE_CONFIG", "x" * 100)
+    builder.build(output_dir=export_path)
+    verify()
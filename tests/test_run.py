@@ -0,0 +1,667 @@
+#   ---------------------------------------------------------------------------------
+#   Copyright (c) Microsoft Corporation. All rights reserved.
+#   Licensed under the MIT License. See LICENSE in project root for information.
+#   ---------------------------------------------------------------------------------
+import asyncio
+import json
+import os
+import sys
+import time
+
+import pytest
+
+from aspyre import build_distributed_application, HealthCheck, HealthMonitor, Histogram, LogBuffer, LogStore, ProcessRunner, RestartPolicy, SampleRing
+
+
+PRINT_ENV = "import os, sys; print(*(os.environ.get(name) for name in sys.argv[1:]))"
+
+
+def test_python_engine_runs_processes(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "seed.py").write_text("print('seeded')\n")
+    builder = build_distributed_application()
+    token = builder.add_parameter("token", "s3cr3t")
+    database = builder.add_connection_string("db")
+    seed = builder.add_python_app("seed", "src", "seed.py")
+    api = (builder.add_executable("api", sys.executable, ".", ["-c", PRINT_ENV])
+           .with_http_endpoint(port=8123, env="PORT")
+           .with_env("TOKEN", token)
+           .with_reference(database)
+           .with_args(["PORT", "TOKEN", "ConnectionStrings__db"])
+           .wait_for_completion(seed))
+    (builder.add_executable("web", sys.executable, ".", ["-c", PRINT_ENV, "services__api__http__0", "API_HTTP"])
+     .with_reference(api)
+     .wait_for(api))
+    output = []
+    runner = ProcessRunner(on_output=lambda name, line: output.append((name, line)), environ={"ConnectionStrings__db": "Host=db"})
+    assert builder.build(output_dir=tmp_path).run(runner) == 0
+    assert output.index(("seed", "seeded")) < output.index(("api", "8123 s3cr3t Host=db"))
+    assert ("web", "http://localhost:8123 http://localhost:8123") in output
+
+
+def test_python_engine_passes_args_verbatim(tmp_path):
+    builder = build_distributed_application()
+    builder.add_executable("echo", sys.executable, ".", ["-c", r"print('a\nb'); print(r'C:\temp\x41')"])
+    output = []
+    assert builder.build(output_dir=tmp_path).run(ProcessRunner(on_output=lambda name, line: output.append(line))) == 0
+    assert output == ["a", "b", r"C:\temp\x41"]
+
+
+def test_python_engine_starts_independent_processes_concurrently(tmp_path):
+    builder = build_distributed_application()
+    for index in range(4):
+        builder.add_executable(f"sleeper{index}", sys.executable, ".", ["-c", "import time; time.sleep(0.5)"])
+    app = builder.build(output_dir=tmp_path)
+    start = time.perf_counter()
+    assert app.run(ProcessRunner(on_output=print)) == 0
+    assert time.perf_counter() - start < 1.5
+
+
+def test_python_engine_skips_processes_after_failed_dependency(tmp_path):
+    builder = build_distributed_application()
+    migrate = builder.add_executable("migrate", sys.executable, ".", ["-c", "raise SystemExit(2)"])
+    builder.add_executable("api", sys.executable, ".", ["-c", "print('started')"]).wait_for_completion(migrate)
+    output = []
+    runner = ProcessRunner(on_output=lambda name, line: output.append(name))
+    supervisor = runner.supervisor(builder.build(output_dir=tmp_path))
+    assert asyncio.run(supervisor.run()) == {"migrate": 2, "api": None}
+    assert builder.build(output_dir=tmp_path).run(runner) == 2
+    assert "api" not in output
+
+
+def test_python_engine_drops_overlong_lines(tmp_path):
+    script = ("import sys, time; [(sys.stdout.write('x' * 50000), sys.stdout.flush(), time.sleep(0.02)) for _ in range(4)]; "
+              "print(); print('after')")
+    builder = build_distributed_application()
+    builder.add_executable("long", sys.executable, ".", ["-c", script])
+    output = []
+    app = builder.build(output_dir=tmp_path)
+    assert app.run(ProcessRunner(on_output=lambda name, line: output.append(line))) == 0
+    assert output == ["after"]
+    assert app.log_store.dropped == {"long": 1}
+
+
+def test_python_engine_rejects_containers(tmp_path):
+    builder = build_distributed_application()
+    builder.add_redis("cache")
+    with pytest.raises(ValueError, match="cannot be run as local processes: cache"):
+        builder.build(output_dir=tmp_path).run(engine="python")
+
+
+SERVER = '''
+import http.server, os, time
+
+started = time.monotonic()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        ready = time.monotonic() - started > float(os.environ.get("READY_AFTER", "0"))
+        self.send_response(200 if ready else 503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+http.server.ThreadingHTTPServer(("127.0.0.1", int(os.environ["PORT"])), Handler).serve_forever()
+'''
+
+
+def test_wait_for_waits_until_healthy(tmp_path):
+    (tmp_path / "server.py").write_text(SERVER)
+    builder = build_distributed_application()
+    server = (builder.add_executable("server", sys.executable, ".", ["server.py"])
+              .with_http_endpoint(env="PORT")
+              .with_env("READY_AFTER", "0.3")
+              .with_http_health_check(path="/health"))
+    builder.add_executable("client", sys.executable, ".", ["-c", "print('up')"]).wait_for(server)
+    supervisor = ProcessRunner(on_output=print).supervisor(builder.build(output_dir=tmp_path))
+
+    async def run_client():
+        task = asyncio.create_task(supervisor.run())
+        while "client" not in supervisor.exit_codes:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    start = time.perf_counter()
+    asyncio.run(run_client())
+    transitions = [(transition.resource, transition.state) for transition in supervisor.health.transitions]
+    assert transitions.index(("server", "healthy")) < transitions.index(("client", "starting"))
+    healthy = next(t.time for t in supervisor.health.transitions if t.state == "healthy" and t.resource == "server")
+    assert 0.3 < healthy - start < 2
+    assert supervisor.health.client.connections_opened <= 2
+
+
+def test_health_monitor_shares_keep_alive_connections(tmp_path):
+    import http.server
+    import threading
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            body = b"ok" if self.path == "/ready" else b"no"
+            self.send_response(200 if self.path == "/ready" else 500)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(body), body))
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    async def check():
+        monitor = HealthMonitor()
+        for index in range(200):
+            monitor.watch(f"ready{index}", [HealthCheck(f"ready{index}", url + "/ready")])
+        monitor.watch("live", [HealthCheck("live", url + "/live", "liveness", period=0.05, failure_threshold=2)])
+        await asyncio.wait_for(asyncio.gather(*(monitor.wait_healthy(f"ready{index}") for index in range(200))), 10)
+        while monitor.states["live"] != "unhealthy":
+            await asyncio.sleep(0.01)
+        await monitor.close()
+        return monitor
+
+    try:
+        monitor = asyncio.run(check())
+    finally:
+        server.shutdown()
+    assert monitor.client.connections_opened <= monitor.client.max_connections_per_host
+    assert [t.state for t in monitor.transitions if t.resource == "live"] == ["starting", "healthy", "unhealthy", "stopped"]
+
+
+def test_http_client_reads_responses_without_body():
+    responses = {
+        "/empty": b"HTTP/1.1 204 No Content\r\n\r\n",
+        "/bare": b"HTTP/1.1 200\r\nContent-Length: 2\r\n\r\nok",
+        "/continue": b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n",
+        "/head": b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\n",
+    }
+
+    async def handle(reader, writer):
+        while request := (await reader.readline()).split():
+            while await reader.readline() not in (b"\r\n", b""):
+                pass
+            writer.write(responses[request[1].decode()])
+            await writer.drain()
+        writer.close()
+
+    async def check():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        monitor = HealthMonitor()
+        try:
+            monitor.watch("api", [HealthCheck("api", url + "/empty")])
+            assert await asyncio.wait_for(monitor.wait_healthy("api"), 5)
+            client = monitor.client
+            statuses = [await client.get(url + path, timeout=1) for path in ("/empty", "/bare", "/continue")]
+            statuses.append(await client.head(url + "/head", timeout=1))
+            statuses.append(await client.get(url + "/bare", timeout=1))
+            return statuses, client.connections_opened
+        finally:
+            await monitor.close()
+            server.close()
+
+    statuses, connections_opened = asyncio.run(check())
+    assert statuses == [204, 200, 200, 200, 200]
+    assert connections_opened == 1
+
+
+def test_tcp_health_check_closes_its_connections():
+    opened, closed = [], []
+
+    async def handle(reader, writer):
+        opened.append(True)
+        await reader.read()
+        closed.append(True)
+        writer.close()
+
+    async def check():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monitor = HealthMonitor()
+        try:
+            monitor.watch("db", [HealthCheck("db", f"tcp://127.0.0.1:{port}", success_threshold=3)])
+            assert await asyncio.wait_for(monitor.wait_healthy("db"), 5)
+            await monitor.close()
+            await asyncio.sleep(0.05)
+        finally:
+            server.close()
+
+    asyncio.run(check())
+    assert len(opened) >= 3 and len(closed) == len(opened)
+
+
+def test_wait_until_healthy(tmp_path):
+    import socket
+    import subprocess
+
+    (tmp_path / "server.py").write_text(SERVER)
+    listener = socket.create_server(("127.0.0.1", 0))
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    builder = build_distributed_application()
+    api = (builder.add_executable("api", sys.executable, ".", ["server.py"])
+           .with_http_endpoint(port=port, env="PORT")
+           .with_http_health_check(path="/health"))
+    builder.add_redis("cache", port=listener.getsockname()[1])
+    builder.add_redis("offline", port=port + 1 if port < 65535 else port - 1)
+    app = builder.build(output_dir=tmp_path)
+    assert [check.url for check in app.readiness_checks(api)["api"]] == [f"http://localhost:{port}/health"]
+    server = subprocess.Popen([sys.executable, "server.py"], cwd=tmp_path, env={**os.environ, "PORT": str(port), "READY_AFTER": "0.3"})
+    try:
+        timings = app.wait_until_healthy_sync(api, "cache", timeout=10)
+        with pytest.raises(TimeoutError, match="not healthy after 0.2 seconds: offline"):
+            app.wait_until_healthy_sync("cache", "offline", timeout=0.2)
+    finally:
+        server.kill()
+        server.wait()
+        listener.close()
+    assert list(timings) == ["api", "cache"]
+    assert timings["cache"] < 0.3 < timings["api"] < 5
+    with pytest.raises(ValueError, match="Resource 'missing' not found"):
+        app.readiness_checks("missing")
+
+
+def test_wait_until_healthy_with_python_engine(tmp_path):
+    (tmp_path / "server.py").write_text(SERVER)
+    builder = build_distributed_application()
+    script = "import os; open('pid', 'w').write(str(os.getpid())); exec(open('server.py').read())"
+    builder.add_executable("server", sys.executable, ".", ["-c", script]).with_http_endpoint(env="PORT")
+    app = builder.build(output_dir=tmp_path)
+    supervisor = ProcessRunner(on_output=print).supervisor(app)
+
+    async def run_until_healthy():
+        task = asyncio.create_task(supervisor.run())
+        timings = await app.wait_until_healthy(timeout=10)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return timings
+
+    assert list(asyncio.run(run_until_healthy())) == ["server"]
+    with pytest.raises(ProcessLookupError):
+        os.kill(int((tmp_path / "pid").read_text()), 0)
+
+
+FLAKY = '''
+import pathlib, sys
+
+counter = pathlib.Path("attempts")
+attempts = int(counter.read_text()) + 1 if counter.exists() else 1
+counter.write_text(str(attempts))
+print("attempt", attempts)
+sys.exit(0 if attempts > int(sys.argv[1]) else 1)
+'''
+
+
+def test_restart_policy_restarts_with_backoff(tmp_path):
+    (tmp_path / "flaky.py").write_text(FLAKY)
+    builder = build_distributed_application()
+    policy = RestartPolicy(backoff_base=0.1, backoff_cap=0.15)
+    flaky = builder.add_executable("flaky", sys.executable, ".", ["flaky.py", "2"]).with_restart_policy(policy)
+    builder.add_executable("after", sys.executable, ".", ["-c", "print('started')"]).wait_for_completion(flaky)
+    output = []
+    supervisor = ProcessRunner(on_output=lambda name, line: output.append((name, line))).supervisor(builder.build(output_dir=tmp_path))
+    start = time.perf_counter()
+    assert asyncio.run(supervisor.run()) == {"flaky": 0, "after": 0}
+    assert time.perf_counter() - start > 0.25
+    assert supervisor.restarts == {"flaky": 2}
+    assert output == [
+        ("flaky", "attempt 1"),
+        ("flaky", "Exited with 1, restarting in 0.1s."),
+        ("flaky", "attempt 2"),
+        ("flaky", "Exited with 1, restarting in 0.15s."),
+        ("flaky", "attempt 3"),
+        ("after", "started"),
+    ]
+
+
+def test_restart_policy_reports_crash_loops(tmp_path):
+    (tmp_path / "flaky.py").write_text(FLAKY)
+    builder = build_distributed_application()
+    policy = RestartPolicy(max_retries=3, backoff_base=0.01, crash_loop_threshold=2)
+    crashing = (builder.add_executable("crashing", sys.executable, ".", ["flaky.py", "10"], restart=policy)
+                .with_http_endpoint()
+                .with_http_health_check())
+    builder.add_executable("api", sys.executable, ".", ["-c", "print('started')"]).wait_for(crashing)
+    output = []
+    supervisor = ProcessRunner(on_output=lambda name, line: output.append(line)).supervisor(builder.build(output_dir=tmp_path))
+    assert asyncio.run(supervisor.run()) == {"crashing": 1, "api": None}
+    assert supervisor.restarts == {"crashing": 3}
+    assert "Crash loop: exited with 1 2 times in a row, restarting in 0.02s." in output
+    assert output[-1] == "Exited with 1, not restarted after 3 restarts in a row."
+    assert "started" not in output
+    states = [t.state for t in supervisor.health.transitions if t.resource == "crashing"]
+    assert states == ["starting", "restarting", "starting", "crash-loop", "starting", "crash-loop", "starting", "stopped"]
+
+
+def test_restart_policy_validation():
+    with pytest.raises(ValueError, match="Invalid restart mode"):
+        RestartPolicy("sometimes")
+    with pytest.raises(ValueError, match="cap not below the base"):
+        RestartPolicy(backoff_base=2, backoff_cap=1)
+    assert [RestartPolicy(backoff_base=1, backoff_cap=5).delay(restarts) for restarts in range(1, 5)] == [1, 2, 4, 5]
+
+
+def test_log_buffer_is_bounded_and_spills(tmp_path):
+    import gzip
+
+    buffer = LogBuffer("api", max_bytes=100, spill_dir=tmp_path, spill_max_bytes=200, spill_files=2)
+    for index in range(100):
+        buffer.append(f"line {index:04d}", timestamp=index)
+    buffer.close()
+    assert buffer.size <= 100
+    assert [record.line for record in buffer.records()] == [f"line {index:04d}" for index in range(89, 100)]
+    assert buffer.records()[-1].sequence == 100
+    assert buffer.evicted == 89
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["api.1.log.gz", "api.2.log.gz", "api.log.gz"]
+    spilled = [gzip.open(tmp_path / name, "rt").read().splitlines() for name in ("api.2.log.gz", "api.1.log.gz", "api.log.gz")]
+    assert [len(lines) for lines in spilled] == [22, 22, 1]
+    assert spilled[0][0] == "44.000000 line 0044"
+    assert spilled[2][-1] == "88.000000 line 0088"
+
+
+def test_log_buffer_rate_limit(monkeypatch):
+    import aspyre
+
+    now = [0.0]
+    monkeypatch.setattr(aspyre, "perf_counter", lambda: now[0])
+    buffer = LogBuffer("api", max_lines_per_second=10)
+    kept = [buffer.append(f"line {index}") for index in range(25)]
+    assert sum(record is not None for record in kept) == 10
+    assert buffer.dropped == 15
+    now[0] = 0.5
+    buffer.append("after")
+    assert [record.line for record in buffer.records()][-2:] == ["[15 lines dropped by the log rate limit]", "after"]
+    with pytest.raises(ValueError, match="rate must be positive"):
+        LogBuffer("api", max_lines_per_second=0)
+
+
+def test_supervisor_captures_logs_with_flat_memory(tmp_path):
+    builder = build_distributed_application()
+    script = "import sys; sys.stdout.write('x' * 100000 + '\\n'); [print('chatty', i) for i in range(20000)]"
+    builder.add_executable("chatty", sys.executable, ".", ["-c", script])
+    printed = []
+    logs = LogStore(max_bytes=4096, max_lines_per_second=1000)
+    app = builder.build(output_dir=tmp_path)
+    assert app.run(ProcessRunner(on_output=lambda name, line: printed.append(line), logs=logs)) == 0
+    buffer = app.log_store.buffer("chatty")
+    assert app.log_store is logs
+    assert buffer.size <= 4096
+    assert buffer.dropped > 0 and logs.dropped == {"chatty": buffer.dropped}
+    assert len(printed) + buffer.dropped == 20001
+
+
+def test_logs_and_search(tmp_path):
+    builder = build_distributed_application()
+    ticker = builder.add_executable("ticker", sys.executable, ".", ["-c", "[print('tick', i, flush=True) for i in range(5)]"])
+    builder.add_executable("worker", sys.executable, ".", ["-c", "print('Connection refused by db'); print('retrying')"])
+    app = builder.build(output_dir=tmp_path)
+    supervisor = ProcessRunner(on_output=lambda name, line: None).supervisor(app)
+
+    async def follow():
+        task = asyncio.create_task(supervisor.run())
+        lines = [record.line async for record in app.logs(ticker)]
+        await task
+        return lines
+
+    assert asyncio.run(follow()) == [f"tick {index}" for index in range(5)]
+    [match] = app.search_logs("connection REFUSED")
+    assert (match.resource, match.line) == ("worker", "Connection refused by db")
+    assert [record.line for record in app.search_logs("tick 3", resources=[ticker])] == ["tick 3"]
+    assert app.search_logs("tick", resources=["worker"]) == []
+    assert len(app.search_logs("tick", since=match.time - 60)) == 5
+    assert app.search_logs("tick", since=time.time() + 60) == []
+
+
+def test_log_search_forgets_evicted_lines():
+    store = LogStore(max_bytes=200)
+    for index in range(2000):
+        store.append(f"service{index % 100}", f"request {index} id-{index:05d} status {500 if index % 7 == 0 else 200}")
+    assert [record.line for record in store.search("id-00003")] == []
+    assert [record.line for record in store.search("id-01903")] == ["request 1903 id-01903 status 200"]
+    errors = store.search("status 500", resources=[f"service{index}" for index in range(0, 100, 7)])
+    assert errors and all(record.line.endswith("500") for record in errors)
+    assert [record.time for record in errors] == sorted(record.time for record in errors)
+    assert store.search("") == sorted(store.search(""), key=lambda record: (record.time, record.sequence))
+
+
+def test_log_search_matches_whole_words():
+    buffer = LogBuffer("api", max_bytes=60)
+    for line in ["Connection refused by upstream", "ERROR: timeout", "retrying", "Connection refused by upstream"]:
+        buffer.append(line)
+    assert buffer.evicted == 1
+    for query in ["connection", "refused by", "Connection refused by upstream", "ERROR", "error: timeout", ": "]:
+        assert [record.sequence for record in buffer.search(query)] == (
+            [2] if "rror" in query.lower() or query == ": " else [4]), query
+    for query in ["conn", "rror", "used", "refused b", "n refused by u", "ERROR: TIME", "used by db"]:
+        assert buffer.search(query) == [], query
+    assert [record.sequence for record in buffer.records(after=2)] == [3, 4]
+
+
+def test_log_search_looks_only_at_lines_with_the_words():
+    looked_at = []
+
+    class Line(str):
+        def lower(self):
+            looked_at.append(self)
+            return super().lower()
+
+    buffer = LogBuffer("api")
+    for index in range(1000):
+        buffer.append(Line(f"GET /orders/{index} 200" if index % 100 else f"connection refused, error {index}"))
+    looked_at.clear()
+    assert len(buffer.search("error")) == 10
+    assert len(looked_at) == 10
+    looked_at.clear()
+    assert len(buffer.search("Connection refused")) == 10
+    assert len(looked_at) == 10
+
+
+def test_sample_ring_keeps_latest_samples():
+    ring = SampleRing(3)
+    for index in range(5):
+        ring.append(index, index * 10.0, index * 100)
+    assert len(ring) == 3
+    assert ring.samples() == [(2, 20.0, 200), (3, 30.0, 300), (4, 40.0, 400)]
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/stat"), reason="requires /proc")
+def test_metrics_sample_process_trees(tmp_path):
+    builder = build_distributed_application()
+    burn = "import time; end = time.time() + 0.8\nwhile time.time() < end: pass"
+    spawn = f"import subprocess, sys; subprocess.run([sys.executable, '-c', {burn!r}])"
+    builder.add_executable("busy", sys.executable, ".", ["-c", spawn])
+    builder.add_executable("hungry", sys.executable, ".", ["-c", "import time; data = bytearray(64 << 20); time.sleep(0.8)"])
+    app = builder.build(output_dir=tmp_path)
+    assert app.run(ProcessRunner(on_output=print, sample_interval=0.05)) == 0
+    metrics = app.metrics()
+    assert metrics["busy"].samples > 5 and metrics["busy"].cpu_p95 > 50
+    assert metrics["hungry"].cpu_p50 < 50
+    assert metrics["hungry"].peak_rss > 64 << 20 > metrics["busy"].peak_rss
+    exported = json.loads(app.metrics_json(include_samples=True))
+    assert exported["interval"] == 0.05
+    assert exported["resources"]["hungry"]["peak_rss"] == metrics["hungry"].peak_rss
+    assert len(exported["resources"]["busy"]["series"]) == metrics["busy"].samples
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/stat"), reason="requires /proc")
+def test_metrics_count_short_lived_children(tmp_path):
+    builder = build_distributed_application()
+    burn = "import time; end = time.time() + 0.05; all(iter(lambda: time.time() < end, False))"
+    spawn = f"import subprocess, sys; [subprocess.run([sys.executable, '-c', {burn!r}]) for _ in range(15)]"
+    builder.add_executable("forking", sys.executable, ".", ["-c", spawn])
+    app = builder.build(output_dir=tmp_path)
+    assert app.run(ProcessRunner(on_output=print, sample_interval=0.2)) == 0
+    metrics = app.metrics()["forking"]
+    assert metrics.samples >= 3 and metrics.cpu_p50 > 30
+
+
+def test_histogram_renders_prometheus_text():
+    histogram = Histogram(("resource",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'we"b')
+    histogram.observe(0.5, 'we"b')
+    assert histogram.render("latency_seconds", "Latency.") == [
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{resource="we\\"b",le="0.1"} 1',
+        'latency_seconds_bucket{resource="we\\"b",le="1"} 2',
+        'latency_seconds_bucket{resource="we\\"b",le="+Inf"} 2',
+        'latency_seconds_sum{resource="we\\"b"} 0.55',
+        'latency_seconds_count{resource="we\\"b"} 2',
+    ]
+
+
+def test_supervisor_serves_prometheus_metrics(tmp_path):
+    import urllib.error
+    import urllib.request
+
+    (tmp_path / "server.py").write_text(SERVER)
+    builder = build_distributed_application()
+    server = (builder.add_executable("server", sys.executable, ".", ["server.py"])
+              .with_http_endpoint(env="PORT")
+              .with_http_health_check(path="/health"))
+    builder.add_executable("client", sys.executable, ".", ["-c", "print('up')"]).wait_for(server)
+    app = builder.build(output_dir=tmp_path)
+    supervisor = ProcessRunner(on_output=print, sample_interval=0.05, metrics_port=0).supervisor(app)
+
+    async def scrape():
+        task = asyncio.create_task(supervisor.run())
+        await app.wait_until_healthy(timeout=10)
+        while "client" not in supervisor.exit_codes:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.2)
+        response = await asyncio.to_thread(urllib.request.urlopen, supervisor.metrics_url)
+        with pytest.raises(urllib.error.HTTPError, match="404"):
+            await asyncio.to_thread(urllib.request.urlopen, supervisor.metrics_url.replace("/metrics", "/"))
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return response.headers["Content-Type"], response.read().decode()
+
+    content_type, text = asyncio.run(scrape())
+    assert content_type.startswith("text/plain; version=0.0.4")
+    lines = text.splitlines()
+    assert 'aspyre_resource_state{resource="server",state="healthy"} 1' in lines
+    assert 'aspyre_resource_state{resource="client",state="stopped"} 1' in lines
+    assert 'aspyre_resource_ready_seconds_count{resource="server"} 1' in lines
+    assert 'aspyre_resource_start_seconds_count{resource="client"} 1' in lines
+    assert 'aspyre_resource_restarts_total{resource="server"} 0' in lines
+    assert any(line.startswith('aspyre_health_check_duration_seconds_count{resource="server",kind="health"}') for line in lines)
+    assert any(line.startswith('aspyre_process_resident_memory_bytes{resource="server"}') for line in lines)
+
+
+def test_start_runs_the_application_without_blocking(tmp_path):
+    (tmp_path / "server.py").write_text(SERVER)
+    builder = build_distributed_application()
+    server = (builder.add_executable("server", sys.executable, ".", ["server.py"])
+              .with_http_endpoint(env="PORT")
+              .with_http_health_check(path="/health"))
+    builder.add_executable("client", sys.executable, ".", ["-c", "print('client up')"]).wait_for(server)
+    app = builder.build(output_dir=tmp_path)
+    assert app.search_logs("up") == []
+
+    async def main():
+        async with app.start(ProcessRunner(on_output=lambda name, line: None)) as running:
+            client = asyncio.create_task(anext(aiter(app.logs("client"))))
+            assert set(await running.wait_until_healthy("server", timeout=10)) == {"server"}
+            assert (await client).line == "client up"
+            assert [record.resource for record in running.search_logs("client UP")] == ["client"]
+            assert running.timeline.resources["server"].ready is not None
+            while "client" not in running.exit_codes:
+                await asyncio.sleep(0.01)
+            assert "server" not in running.exit_codes
+        return running
+
+    running = asyncio.run(main())
+    assert running.exit_codes == {"client": 0, "server": None}
+    assert running.metrics_url is None
+    port = int(app._endpoints["server"]["http"].rpartition(":")[2])
+    assert 20000 <= port <= 29999
+    with pytest.raises(ValueError, match="only 'python'"):
+        asyncio.run(app.start(engine="dotnet").__aenter__())
+
+
+def test_start_exposes_and_prints_the_metrics_url(tmp_path):
+    import urllib.request
+
+    builder = build_distributed_application()
+    builder.add_executable("sleeper", sys.executable, ".", ["-c", "import time; time.sleep(30)"])
+    app = builder.build(output_dir=tmp_path)
+    output = []
+
+    async def main():
+        runner = ProcessRunner(on_output=lambda name, line: output.append((name, line)), metrics_port=0)
+        async with app.start(runner) as running:
+            response = await asyncio.to_thread(urllib.request.urlopen, running.metrics_url)
+            return running.metrics_url, response.read().decode()
+
+    url, text = asyncio.run(main())
+    assert url.startswith("http://127.0.0.1:") and url.endswith("/metrics")
+    assert output[0] == ("aspyre", f"Serving Prometheus metrics on {url}")
+    assert 'aspyre_resource_state{resource="sleeper",state="waiting"} 0' in text.splitlines()
+
+
+def test_startup_timeline_exports_chrome_trace(tmp_path):
+    (tmp_path / "server.py").write_text(SERVER)
+    builder = build_distributed_application()
+    migrate = builder.add_executable("migrate", sys.executable, ".", ["-c", "import time; time.sleep(0.2)"])
+    server = (builder.add_executable("server", sys.executable, ".", ["server.py"])
+              .with_http_endpoint(env="PORT")
+              .with_env("READY_AFTER", "0.3")
+              .with_http_health_check(path="/health"))
+    (builder.add_executable("client", sys.executable, ".", ["-c", "print('up')"])
+     .wait_for_completion(migrate)
+     .wait_for(server))
+    app = builder.build(output_dir=tmp_path)
+    supervisor = ProcessRunner(on_output=print).supervisor(app)
+
+    async def run_client():
+        task = asyncio.create_task(supervisor.run())
+        while "client" not in supervisor.exit_codes:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run_client())
+    server_timeline, client_timeline = app.timeline.resources["server"], app.timeline.resources["client"]
+    assert server_timeline.started < server_timeline.first_health_pass <= server_timeline.ready
+    assert server_timeline.ready - server_timeline.started > 0.3
+    assert [(wait.dependency, wait.condition, wait.satisfied) for wait in client_timeline.waits] == [
+        ("migrate", "exit code 0", True), ("server", "healthy", True)]
+    assert client_timeline.waits[-1].end <= client_timeline.launching < client_timeline.started
+    assert client_timeline.exit_code == 0
+
+    trace = json.loads(app.startup_trace_json())
+    events = trace["traceEvents"]
+    tracks = {event["args"]["name"]: event["tid"] for event in events if event["name"] == "thread_name"}
+    assert set(tracks) == {"migrate", "server", "client"}
+    spans = {(event["tid"], event["name"]): event for event in events if event["ph"] == "X"}
+    wait = spans[tracks["client"], "wait for server"]
+    assert wait["args"] == {"resource": "server", "condition": "healthy", "satisfied": True}
+    starting = spans[tracks["server"], "starting"]
+    assert abs(starting["ts"] + starting["dur"] - (wait["ts"] + wait["dur"])) < 50000
+    flows = {event["id"]: [] for event in events if event["ph"] == "s"}
+    for event in events:
+        if event["ph"] in ("s", "f"):
+            flows[event["id"]].append((event["ph"], event["tid"]))
+    assert sorted(flows.values()) == [
+        [("s", tracks["migrate"]), ("f", tracks["client"])], [("s", tracks["server"]), ("f", tracks["client"])]]
+
+
+def test_startup_trace_needs_python_engine(tmp_path):
+    app = build_distributed_application().build(output_dir=tmp_path)
+    with pytest.raises(ValueError, match="engine='python'"):
+        app.startup_trace_json()